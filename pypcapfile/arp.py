@@ -0,0 +1,60 @@
+"""
+ARP (Address Resolution Protocol) definition.
+"""
+
+import binascii
+import struct
+
+from pcapfile.protocols.network.ip import parse_ipv4
+
+arp_header = struct.Struct('!HHBBH')
+
+operations = {1: 'request', 2: 'reply', 3: 'reverse request', 4: 'reverse reply'}
+
+
+class ARP(object):
+    """
+    Represents an ARP packet.  The hardware and protocol addresses are kept as
+    integers, whatever their length.  The payload is whatever follows the
+    addresses, usually padding.
+    """
+
+    arp_header_size = 8
+
+    __slots__ = ('htype',    # hardware type
+                 'ptype',    # protocol type
+                 'hlen',     # hardware address length
+                 'plen',     # protocol address length
+                 'op',       # operation
+                 'sha',      # sender hardware address
+                 'spa',      # sender protocol address
+                 'tha',      # target hardware address
+                 'tpa',      # target protocol address
+                 'payload')
+
+    def __init__(self, packet, layers=0):
+        (self.htype, self.ptype, self.hlen, self.plen, self.op) = arp_header.unpack(packet[:self.arp_header_size])
+        offset = self.arp_header_size
+        (hlen, plen) = (self.hlen, self.plen)
+        self.sha = int.from_bytes(packet[offset:offset + hlen], 'big')
+        offset += hlen
+        self.spa = int.from_bytes(packet[offset:offset + plen], 'big')
+        offset += plen
+        self.tha = int.from_bytes(packet[offset:offset + hlen], 'big')
+        offset += hlen
+        self.tpa = int.from_bytes(packet[offset:offset + plen], 'big')
+        offset += plen
+
+        if type(packet) == memoryview:
+            self.payload = packet[offset:]
+        else:
+            self.payload = binascii.hexlify(packet[offset:])
+
+    def __str__(self):
+        if self.plen == 4:
+            (spa, tpa) = (parse_ipv4(self.spa).decode('ascii'), parse_ipv4(self.tpa).decode('ascii'))
+        else:
+            (spa, tpa) = ('%x' % self.spa, '%x' % self.tpa)
+        packet = 'arp %s from %s (%x) to %s (%x)'
+        packet = packet % (operations.get(self.op, self.op), spa, self.sha, tpa, self.tha)
+        return packet
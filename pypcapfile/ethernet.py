@@ -3,31 +3,33 @@ IP protocol definitions.
 """
 
 import binascii
-import ctypes
 import struct
 
+ethernet_header = struct.Struct('!HIHIH')
 
-class Ethernet(ctypes.Structure):
+
+class Ethernet(object):
     """
-    Represents an Ethernet frame.
+    Represents an Ethernet frame.  The addresses are kept as integers and are only
+    formatted by __str__.
     """
 
-    _fields_ = [('dst', ctypes.c_char_p),
-                ('src', ctypes.c_char_p),
-                ('type', ctypes.c_ushort)]
-
-    payload = None
+    __slots__ = ('dst',       # destination MAC address
+                 'src',       # source MAC address
+                 'type',      # EtherType
+                 'payload')
 
     def __init__(self, packet, layers=0):
-        (dst, src, self.type) = struct.unpack('!6s6sH', packet[:14])
-
-        dst = bytearray(dst)
-        src = bytearray(src)
-        self.dst = b':'.join([('%02x' % o).encode('ascii') for o in dst])
-        self.src = b':'.join([('%02x' % o).encode('ascii') for o in src])
+        (dst_high, dst_low, src_high, src_low, self.type) = ethernet_header.unpack(packet[:14])
+        self.dst = (dst_high << 32) | dst_low
+        self.src = (src_high << 32) | src_low
 
-        payload = binascii.hexlify(packet[14:])
-        self.payload = payload
+        if type(packet) == memoryview:
+            # Zero-copy mode: the payload is a view into the caller's buffer and is
+            # only copied if someone asks for its bytes.
+            self.payload = packet[14:]
+        else:
+            self.payload = binascii.hexlify(packet[14:])
 
         if layers:
             self.load_network(layers)
@@ -37,14 +39,16 @@ class Ethernet(ctypes.Structure):
         Given an Ethernet frame, determine the appropriate sub-protocol;
         If layers is greater than zerol determine the type of the payload
         and load the appropriate type of network packet. It is expected
-        that the payload be a hexified string. The layers argument determines
-        how many layers to descend while parsing the packet.
+        that the payload be a hexified string or, in zero-copy mode, a
+        memoryview. The layers argument determines how many layers to descend
+        while parsing the packet.
         """
         if layers:
             ctor = payload_type(self.type)[0]
             if ctor:
-                ctor = ctor
-                payload = binascii.unhexlify(self.payload)
+                payload = self.payload
+                if not type(payload) == memoryview:
+                    payload = binascii.unhexlify(payload)
                 self.payload = ctor(payload, layers - 1)
             else:
                 # if no type is found, do not touch the packet.
@@ -52,10 +56,17 @@ class Ethernet(ctypes.Structure):
 
     def __str__(self):
         frame = 'ethernet from %s to %s type %s'
-        frame = frame % (self.src, self.dst, payload_type(self.type)[1])
+        frame = frame % (format_mac(self.src), format_mac(self.dst), payload_type(self.type)[1])
         return frame
 
 
+def format_mac(address):
+    """
+    Given a MAC address as an integer, return it as colon-separated hex bytes.
+    """
+    return b':'.join([('%02x' % o).encode('ascii') for o in address.to_bytes(6, 'big')])
+
+
 def strip_ethernet(packet):
     """
     Strip the Ethernet frame from a packet.
@@ -66,28 +77,39 @@ def strip_ethernet(packet):
 
     if type(payload) == str:
         payload = binascii.unhexlify(payload)
+    elif type(payload) == memoryview:
+        payload = payload.tobytes()
     return payload
 
 
+# The (constructor, name) of each protocol a frame can carry, by EtherType
+ethertypes = {}
+
+unknown_type = (None, 'unknown')
+
+
+def register_ethertype(ethertype, ctor, name):
+    """
+    Decode the payload of frames of the given EtherType with ctor, which is
+    called as ctor(payload, layers) like the other protocol classes.
+    """
+    ethertypes[ethertype] = (ctor, name)
+
+
 def payload_type(ethertype):
     """
     Returns the appropriate payload constructor based on the supplied
     EtherType.
     """
-    if ethertype == 0x0800:
-        from pcapfile.protocols.network.ip import IP
-        return (IP, 'IPv4')
-    elif ethertype == 0x8100:
-        from pcapfile.protocols.linklayer.vlan import VLAN
-        return (VLAN, 'VLAN')
-#    elif ethertype == 0x0806:
-#        from pcapfile.protocols.network.arp import ARP
-#        return (ARP, 'ARP')
-#    elif ethertype == 0x0835:
-#        from pcapfile.protocols.network.rarp import RARP
-#        return (RARP, 'RARP')
-#    elif ethertype == 0x08DD:
-#        from pcapfile.protocols.network.ipv6 import IPv6
-#        return (IPv6, 'IPv6')
-    else:
-        return (None, 'unknown')
+    return ethertypes.get(ethertype, unknown_type)
+
+
+from pcapfile.protocols.network.ip import IP
+from pcapfile.protocols.network.ipv6 import IPv6
+from pcapfile.protocols.network.arp import ARP
+from pcapfile.protocols.linklayer.vlan import VLAN
+
+register_ethertype(0x0800, IP, 'IPv4')
+register_ethertype(0x0806, ARP, 'ARP')
+register_ethertype(0x8100, VLAN, 'VLAN')
+register_ethertype(0x86DD, IPv6, 'IPv6')
@@ -3,62 +3,62 @@ IP protocol definitions.
 """
 
 import binascii
-import ctypes
 import struct
 
+ipv4_header = struct.Struct('!BBHHHBBHII')
 
-class IP(ctypes.Structure):
+
+class IP(object):
     """
-    Represents an IP packet.
+    Represents an IP packet.  The addresses are kept as integers and are only
+    formatted by __str__; see parse_ipv4.
     """
 
     ipv4_header_size = 20
 
-    _fields_ = [('v', ctypes.c_ushort),         # version
-                ('hl', ctypes.c_ushort),        # internet header length
-                ('tos', ctypes.c_ubyte),        # type of service
-                ('len', ctypes.c_ushort),       # total length
-                ('id', ctypes.c_ushort),        # IPID
-                ('flags', ctypes.c_ushort, 3),  # flags
-                ('off', ctypes.c_ushort, 13),   # fragmentation offset
-                ('ttl', ctypes.c_ubyte),        # TTL
-                ('p', ctypes.c_ubyte),          # protocol
-                ('sum', ctypes.c_ushort),       # checksum
-                ('src', ctypes.c_char_p),       # source address
-                ('dst', ctypes.c_char_p),       # destination address
-                ('opt', ctypes.c_char_p),       # IP options
-                ('pad', ctypes.c_char_p)]       # padding bytes
+    __slots__ = ('v',           # version
+                 'hl',          # internet header length
+                 'tos',         # type of service
+                 'len',         # total length
+                 'id',          # IPID
+                 'flags',       # flags
+                 'off',         # fragmentation offset
+                 'ttl',         # TTL
+                 'p',           # protocol
+                 'sum',         # checksum
+                 'src',         # source address
+                 'dst',         # destination address
+                 'opt',         # IP options
+                 'opt_parsed',  # IP options we know about, by name
+                 'pad',         # padding bytes
+                 'payload')
 
     def __init__(self, packet, layers=0):
         # parse the required header first, deal with options later
-        magic = struct.unpack('!B',packet[0:1])[0]
-        assert ((magic >> 4) == 4 and
-                (magic & 0x0f) > 4), 'not an IPv4 packet.'
-
-        fields = struct.unpack('!BBHHHBBHII', packet[:self.ipv4_header_size])
-        self.v = fields[0] >> 4
-        self.hl = fields[0] & 0x0f
-        self.tos = fields[1]
-        self.len = fields[2]
-        self.id = fields[3]
-        self.flags = fields[4] >> 13
-        self.off = fields[4] & 0x1fff
-        self.ttl = fields[5]
-        self.p = fields[6]
-        self.sum = fields[7]
-        self.src = ctypes.c_char_p(parse_ipv4(fields[8]))
-        self.dst = ctypes.c_char_p(parse_ipv4(fields[9]))
+        (ver_hl, self.tos, self.len, self.id, flags_off, self.ttl, self.p, self.sum,
+         self.src, self.dst) = ipv4_header.unpack(packet[:self.ipv4_header_size])
+        self.v = ver_hl >> 4
+        self.hl = ver_hl & 0x0f
+        assert self.v == 4 and self.hl > 4, 'not an IPv4 packet.'
+        self.flags = flags_off >> 13
+        self.off = flags_off & 0x1fff
 
         if self.hl > 5:
             payload_start = self.hl * 4
-            self.opt = binascii.hexlify(packet[0x14:payload_start])
-            self.payload = binascii.hexlify(packet[payload_start:])
-            self.opt_parsed = parse_options(binascii.unhexlify(self.opt))
+            options = packet[0x14:payload_start]
+            self.opt = binascii.hexlify(options)
+            self.opt_parsed = parse_options(options)
         else:
+            payload_start = 0x14
             self.opt = b'\x00'
-            self.payload = binascii.hexlify(packet[0x14:])
             self.opt_parsed = { }
 
+        if type(packet) == memoryview:
+            # Zero-copy mode: keep a view of the payload instead of a hex copy
+            self.payload = packet[payload_start:]
+        else:
+            self.payload = binascii.hexlify(packet[payload_start:])
+
         self.pad = b'\x00'
 
         if layers:
@@ -68,15 +68,16 @@ class IP(ctypes.Structure):
         if layers:
             ctor = payload_type(self.p)[0]
             if ctor:
-                ctor = ctor
-                payload = binascii.unhexlify(self.payload)
+                payload = self.payload
+                if not type(payload) == memoryview:
+                    payload = binascii.unhexlify(payload)
                 self.payload = ctor(payload, layers - 1)
             else:
                 pass
 
     def __str__(self):
         packet = 'ipv4 packet from %s to %s type %s'
-        packet = packet % (self.src, self.dst, payload_type(self.p)[1])
+        packet = packet % (parse_ipv4(self.src), parse_ipv4(self.dst), payload_type(self.p)[1])
         return packet
 
 
@@ -107,18 +108,22 @@ def strip_ip(packet):
 def __call__(packet):
     return IP(packet)
 
+# The (constructor, name) of each protocol an IP packet can carry, by protocol number
+protocols = {}
+
+unknown_protocol = (None, 'unknown')
+
+
+def register_protocol(protocol, ctor, name):
+    """
+    Decode the payload of IPv4 and IPv6 packets of the given protocol with ctor,
+    which is called as ctor(payload, layers) like the other protocol classes.
+    """
+    protocols[protocol] = (ctor, name)
+
+
 def payload_type(protocol):
-    if protocol == 0x11:
-        from pcapfile.protocols.transport.udp import UDP
-        return (UDP, 'UDP')
-    elif protocol == 0x88:
-        from pcapfile.protocols.transport.udplite import UDPLITE
-        return (UDPLITE, 'UDPLITE')
-    elif protocol == 0x06:
-        from pcapfile.protocols.transport.tcp import TCP
-        return (TCP, 'TCP')
-    else:
-        return (None, 'unknown')
+    return protocols.get(protocol, unknown_protocol)
 
 def parse_options(opt_bytes):
     opts = { }
@@ -151,3 +156,12 @@ def parse_options(opt_bytes):
         l -= opt_len
 
     return opts
+
+
+from pcapfile.protocols.transport.tcp import TCP
+from pcapfile.protocols.transport.udp import UDP
+from pcapfile.protocols.transport.udplite import UDPLITE
+
+register_protocol(0x06, TCP, 'TCP')
+register_protocol(0x11, UDP, 'UDP')
+register_protocol(0x88, UDPLITE, 'UDPLITE')
@@ -0,0 +1,97 @@
+"""
+IPv6 protocol definitions.
+"""
+
+import binascii
+import socket
+import struct
+
+from pcapfile.protocols.network.ip import payload_type
+
+ipv6_header = struct.Struct('!IHBBQQQQ')
+
+# Extension headers whose length is given in 8 byte units after the next header
+# field: hop-by-hop options, routing and destination options
+extension_headers = (0, 43, 60)
+fragment_header = 44
+
+
+class IPv6(object):
+    """
+    Represents an IPv6 packet.  The addresses are kept as integers and are only
+    formatted by __str__; see parse_ipv6.  The extension headers are skipped, and
+    p is the protocol of the header that follows them, as in IP.
+    """
+
+    ipv6_header_size = 40
+
+    __slots__ = ('v',         # version
+                 'tc',        # traffic class
+                 'flow',      # flow label
+                 'len',       # payload length
+                 'nxt',       # next header
+                 'hlim',      # hop limit
+                 'src',       # source address
+                 'dst',       # destination address
+                 'p',         # protocol of the upper layer header
+                 'payload')
+
+    def __init__(self, packet, layers=0):
+        (ver_tc_flow, self.len, self.nxt, self.hlim, src_high, src_low, dst_high,
+         dst_low) = ipv6_header.unpack(packet[:self.ipv6_header_size])
+        self.v = ver_tc_flow >> 28
+        assert self.v == 6, 'not an IPv6 packet.'
+        self.tc = (ver_tc_flow >> 20) & 0xff
+        self.flow = ver_tc_flow & 0xfffff
+        self.src = (src_high << 64) | src_low
+        self.dst = (dst_high << 64) | dst_low
+
+        (self.p, payload_start) = skip_extension_headers(packet, self.nxt, self.ipv6_header_size)
+        if type(packet) == memoryview:
+            # Zero-copy mode: keep a view of the payload instead of a hex copy
+            self.payload = packet[payload_start:]
+        else:
+            self.payload = binascii.hexlify(packet[payload_start:])
+
+        if layers:
+            self.load_transport(layers)
+
+    def load_transport(self, layers=1):
+        if layers:
+            ctor = payload_type(self.p)[0]
+            if ctor:
+                payload = self.payload
+                if not type(payload) == memoryview:
+                    payload = binascii.unhexlify(payload)
+                self.payload = ctor(payload, layers - 1)
+
+    def __str__(self):
+        packet = 'ipv6 packet from %s to %s type %s'
+        packet = packet % (parse_ipv6(self.src), parse_ipv6(self.dst), payload_type(self.p)[1])
+        return packet
+
+
+def skip_extension_headers(packet, nxt, offset):
+    """
+    Skip the extension headers starting at offset.  Returns the protocol of the
+    header after them and its offset.  A fragment that is not the first of its
+    packet has no upper layer header, so its protocol is given as the fragment
+    header.
+    """
+    size = len(packet)
+    while True:
+        if nxt in extension_headers and offset + 2 <= size:
+            (nxt, offset) = (packet[offset], offset + 8 + 8 * packet[offset + 1])
+        elif nxt == fragment_header and offset + 8 <= size:
+            if (packet[offset + 2] << 8 | packet[offset + 3]) & 0xfff8:
+                return nxt, offset + 8
+            (nxt, offset) = (packet[offset], offset + 8)
+        else:
+            return nxt, min(offset, size)
+
+
+def parse_ipv6(address):
+    """
+    Given an IPv6 address as an integer, return it in the usual colon notation.
+    """
+    return socket.inet_ntop(socket.AF_INET6, address.to_bytes(16, 'big')).encode('ascii')
@@ -3,80 +3,70 @@ TCP transport definition
 """
 
 import binascii
-import ctypes
 import struct
 
-class TCP(ctypes.Structure):
+tcp_header = struct.Struct("!HHIIBBHHH")
+
+
+def flag(mask, name):
     """
-    Represents a TCP packet
+    Return a property that tells whether the flag with the given bit in flags is set.
     """
+    return property(lambda self: bool(self.flags & mask), doc=name)
 
-    _fields_ = [('src_port', ctypes.c_ushort),  # source port
-                ('dst_port', ctypes.c_ushort),  # destination port
-                ('seqnum', ctypes.c_uint),      # sequence number
-                ('acknum', ctypes.c_uint),      # acknowledgment number
-                ('data_offset', ctypes.c_uint), # data offset in bytes
-                ('reserved', ctypes.c_ushort),  # data offset in bytes
-                ('flags', ctypes.c_ushort),     # all the flas except ECN as one byte
-                ('ecn', ctypes.c_bool),         # ECN
-                ('cwr', ctypes.c_bool),         # CWR
-                ('ece', ctypes.c_bool),         # ECE
-                ('urg', ctypes.c_bool),         # URG
-                ('ack', ctypes.c_bool),         # ACK
-                ('psh', ctypes.c_bool),         # PSH
-                ('rst', ctypes.c_bool),         # RST
-                ('syn', ctypes.c_bool),         # SYN
-                ('fin', ctypes.c_bool),         # FIN
-                ('win', ctypes.c_ushort),       # window size
-                ('sum', ctypes.c_ushort),       # checksum
-                ('opt', ctypes.c_char_p),       # options
-                ('payload', ctypes.c_char_p)]   # packet payload
+
+class TCP(object):
+    """
+    Represents a TCP packet.  The individual flags are read from flags when they
+    are asked for.
+    """
+
+    __slots__ = ('src_port',     # source port
+                 'dst_port',     # destination port
+                 'seqnum',       # sequence number
+                 'acknum',       # acknowledgment number
+                 'data_offset',  # data offset in bytes
+                 'reserved',     # the 4 bits after the data offset; the last is the ECN flag
+                 'flags',        # all the flags except ECN as one byte
+                 'win',          # window size
+                 'sum',          # checksum
+                 'opt',          # hexified bytes or, in zero-copy mode, a memoryview of the packet
+                 'payload')      # likewise
 
     tcp_min_header_size = 20
 
+    cwr = flag(128, 'CWR')
+    ece = flag(64, 'ECE')
+    urg = flag(32, 'URG')
+    ack = flag(16, 'ACK')
+    psh = flag(8, 'PSH')
+    rst = flag(4, 'RST')
+    syn = flag(2, 'SYN')
+    fin = flag(1, 'FIN')
+
+    @property
+    def ecn(self):
+        """ECN"""
+        return bool(self.reserved & 1)
+
     def __init__(self, packet, layers=0):
-        fields = struct.unpack("!HHIIBBHHH", packet[:self.tcp_min_header_size])
-        self.src_port = fields[0]
-        self.dst_port = fields[1]
-        self.seqnum = fields[2]
-        self.acknum = fields[3]
-        
-        # Note: Data offset is stored in the first 4 bits of the 1 byte fields[4].  The next
-        # 3 bits are reserved and the last bit contains the ECN flag.
-        self.data_offset = 4 * (fields[4] >> 4)
-		
-        # Store the last 4 bits of fields[4] in reserved.  The last bit contains the ECN flag.
-        self.reserved = fields[4] & 0xf
-
-		# Get the flags from the 9 bits starting with the last bit of fields[4].
-        self.flags = fields[5] 
-        self.ecn = fields[4] & 1
-        self.cwr = fields[5] & 128
-        # 3 bits are reserved and the last bit contains the ECN flag.
-        self.reserved = fields[4] & 0xf
-
-		# Get the flags from the 9 bits starting with the last bit of field[4].
-        self.flags = fields[5] 
-        self.ecn = fields[4] & 1
-        self.cwr = fields[5] & 128
-        self.ece = fields[5] & 64
-        self.urg = fields[5] & 32
-        self.ack = fields[5] & 16
-        self.psh = fields[5] & 8
-        self.rst = fields[5] & 4
-        self.syn = fields[5] & 2
-        self.fin = fields[5] & 1
-
-        self.win = fields[6]
-        self.sum = fields[7]
-        urg_offset = 4 * fields[8] # rarely used
+        (self.src_port, self.dst_port, self.seqnum, self.acknum, offset_reserved, self.flags,
+         self.win, self.sum, urg_pointer) = tcp_header.unpack(packet[:self.tcp_min_header_size])
+
+        # Note: Data offset is stored in the first 4 bits of the 1 byte offset_reserved.  The
+        # next 3 bits are reserved and the last bit contains the ECN flag.
+        self.data_offset = 4 * (offset_reserved >> 4)
+        self.reserved = offset_reserved & 0xf
 
         if self.data_offset < 20:
             self.opt = b''
             self.payload = b''
+        elif type(packet) == memoryview:
+            self.opt = packet[20:self.data_offset]
+            self.payload = packet[self.data_offset:]
         else:
-            self.opt = ctypes.c_char_p(binascii.hexlify(packet[20:self.data_offset]))
-            self.payload = ctypes.c_char_p(binascii.hexlify(packet[self.data_offset:]))
+            self.opt = binascii.hexlify(packet[20:self.data_offset])
+            self.payload = binascii.hexlify(packet[self.data_offset:])
 
     def __str__(self):
         packet = 'tcp %s packet from port %d to port %d carrying %d bytes'
@@ -90,9 +80,19 @@ class TCP(ctypes.Structure):
         if self.cwr: str_flags += 'C'
         if self.ece: str_flags += 'E'
         if self.ecn: str_flags += 'N'
-        packet = packet % (str_flags, self.src_port, self.dst_port, (len(self.payload) / 2))
+        packet = packet % (str_flags, self.src_port, self.dst_port, payload_size(self.payload))
         return packet
 
     def __len__(self):
-        return max(self.data_offset, self.tcp_min_header_size) + len(self.payload) / 2
+        return max(self.data_offset, self.tcp_min_header_size) + payload_size(self.payload)
+
+
+def payload_size(payload):
+    """
+    Return the number of bytes in a hexified or zero-copy payload.  Shared by
+    the UDP and UDPLITE decoders.
+    """
+    if type(payload) == memoryview:
+        return len(payload)
+    return len(payload) // 2
 
@@ -0,0 +1,40 @@
+"""
+UDP transport definition
+"""
+
+import binascii
+import struct
+
+from pcapfile.protocols.transport.tcp import payload_size
+
+class UDP(object):
+    """
+    Represents a UDP packet
+    """
+
+    __slots__ = ('src_port',  # source port
+                 'dst_port',  # destination port
+                 'len',       # length of header and data
+                 'sum',       # checksum
+                 'payload')   # hexified bytes or, in zero-copy mode, a memoryview of the packet
+
+    udp_header_size = 8
+
+    def __init__(self, packet, layers=0):
+        fields = struct.unpack("!HHHH", packet[:self.udp_header_size])
+        self.src_port = fields[0]
+        self.dst_port = fields[1]
+        self.len = fields[2]
+        self.sum = fields[3]
+        if type(packet) == memoryview:
+            self.payload = packet[self.udp_header_size:]
+        else:
+            self.payload = binascii.hexlify(packet[self.udp_header_size:])
+
+    def __str__(self):
+        packet = 'udp packet from port %d to port %d carrying %d bytes'
+        packet = packet % (self.src_port, self.dst_port, payload_size(self.payload))
+        return packet
+
+    def __len__(self):
+        return self.udp_header_size + payload_size(self.payload)
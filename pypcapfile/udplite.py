@@ -4,19 +4,20 @@ This protocol is defined here: https://tools.ietf.org/html/rfc3828
 """
 
 import binascii
-import ctypes
 import struct
 
-class UDPLITE(ctypes.Structure):
+from pcapfile.protocols.transport.tcp import payload_size
+
+class UDPLITE(object):
     """
     Represents a UDPLITE packet
     """
 
-    _fields_ = [('src_port', ctypes.c_ushort),  # source port
-                ('dst_port', ctypes.c_ushort),  # destination port
-                ('coverage', ctypes.c_ushort),  # number of octets, starting with the header, that are covered by checksum
-                ('checksum', ctypes.c_ushort),  # checksum
-                ('payload', ctypes.c_char_p)]   # packet payload
+    __slots__ = ('src_port',  # source port
+                 'dst_port',  # destination port
+                 'coverage',  # number of octets, starting with the header, that are covered by checksum
+                 'checksum',  # checksum
+                 'payload')   # hexified bytes or, in zero-copy mode, a memoryview of the packet
 
     udp_header_size = 8
 
@@ -26,13 +27,15 @@ class UDPLITE(ctypes.Structure):
         self.dst_port = fields[1]
         self.coverage = fields[2]
         self.checksum = fields[3]
-        self.payload = ctypes.c_char_p(binascii.hexlify(packet[self.udp_header_size:]))
+        if type(packet) == memoryview:
+            self.payload = packet[self.udp_header_size:]
+        else:
+            self.payload = binascii.hexlify(packet[self.udp_header_size:])
 
     def __str__(self):
         packet = 'udplite packet from port %d to port %d carrying %d bytes'
-        packet = packet % (self.src_port, self.dst_port, (len(self.payload) / 2))
+        packet = packet % (self.src_port, self.dst_port, payload_size(self.payload))
         return packet
 
     def __len__(self):
-        return self.udp_header_size + len(self.payload)
-
+        return self.udp_header_size + payload_size(self.payload)
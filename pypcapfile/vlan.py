@@ -3,28 +3,28 @@ VLAN (Virtual Local Area Network) protocol definition.
 """
 
 import binascii
-import ctypes
 import struct
 
-from pcapfile.protocols.linklayer.ethernet import payload_type
 
-
-class VLAN(ctypes.Structure):
+class VLAN(object):
     """
     Represents a VLAN packet.
     """
-	
-    _fields_ = [('id', ctypes.c_ushort),       # identifier (first 3 bits are priority and 4th bit is DEI flag)
-                ('protocol', ctypes.c_ushort)] # protocol
 
-    payload = None
+    __slots__ = ('id',        # identifier (first 3 bits are priority and 4th bit is DEI flag)
+                 'protocol',  # protocol
+                 'payload')
+
     vlan_header_size = 4
 
     def __init__(self, packet, layers=0):
         fields = struct.unpack("!HH", packet[:self.vlan_header_size])
         self.id = fields[0]
         self.protocol = fields[1]
-        self.payload = binascii.hexlify(packet[self.vlan_header_size:])
+        if type(packet) == memoryview:
+            self.payload = packet[self.vlan_header_size:]
+        else:
+            self.payload = binascii.hexlify(packet[self.vlan_header_size:])
 		
         if layers:
             self.load_network(layers)
@@ -34,16 +34,18 @@ class VLAN(ctypes.Structure):
         Given a VLAN packet, determine the appropriate sub-protocol;
         If layers is greater than zero, determine the type of the payload
         and load the appropriate type of network packet. It is expected
-        that the payload is a hexified string. The layers argument determines
+        that the payload is a hexified string or, in zero-copy mode, a
+        memoryview. The layers argument determines
         how many layers to descend while parsing the packet. It isn't 
 		decremented here because VLAN comes after Ethernet, but they're both
 		part of the data link layer.
         """
         if layers:
-            ctor = payload_type(self.protocol)[0]
+            ctor = ethernet.payload_type(self.protocol)[0]
             if ctor:
-                ctor = ctor
-                payload = binascii.unhexlify(self.payload)
+                payload = self.payload
+                if not type(payload) == memoryview:
+                    payload = binascii.unhexlify(payload)
                 self.payload = ctor(payload, layers)
             else:
                 # if no type is found, do not touch the packet.
@@ -51,7 +53,7 @@ class VLAN(ctypes.Structure):
 
     def __str__(self):
         packet = 'vlan packet with id %d type %s'
-        packet = packet % (self.id, payload_type(self.protocol)[1])
+        packet = packet % (self.id, ethernet.payload_type(self.protocol)[1])
         return packet
 
     def __len__(self):
@@ -60,3 +62,7 @@ class VLAN(ctypes.Structure):
 def __call__(packet):
     return VLAN(packet)
 
+
+# Imported last: ethernet.py imports this module to register VLAN
+from pcapfile.protocols.linklayer import ethernet
+
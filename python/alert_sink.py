@@ -0,0 +1,329 @@
+# This module takes the anomalies found by anomaly_detect.py off the scoring loop.
+# Instead of two print calls per anomaly, reportAnomaly hands an Alert to a sink,
+# which only appends it to a list; a background thread formats and writes the alerts
+# in batches, every flushInterval seconds or as soon as batchSize of them are waiting.
+#
+# Sinks write the alerts as text in the format reportAnomaly always printed, as JSON
+# lines, as CSV with one column per field, or as a compact binary log that
+# readAlertLog reads back, or pass them to a callback.
+#
+# A Coalescer in front of a sink collapses repeated alerts: alerts whose highest
+# scoring field has the same (field, value) within window packets of the first of
+# them become one alert with a count, written when the window closes.
+
+import abc
+import collections
+import csv
+import json
+import struct
+import sys
+import threading
+
+# packet: number of the (first) anomalous packet; score: its anomaly score; fields:
+# its fields; count: number of alerts collapsed into this one; lastPacket: number of
+# the last of them; field: the [name, value] pair with the highest score, or None
+Alert = collections.namedtuple('Alert', 'packet score fields count lastPacket field')
+
+
+# Return a value in a form JSON and CSV can hold: addresses are bytes
+def plainValue(value):
+    return value.decode('ascii', 'replace') if isinstance(value, bytes) else value
+
+
+class AlertSink(abc.ABC):
+    """
+    Base class of the sinks.  write() only queues an alert; writeAlerts(), which
+    every sink must implement, is called with the queued alerts from a background
+    thread.  If the writer falls behind by more than maxPending alerts, write()
+    writes them itself, so memory stays bounded.
+    """
+
+    flushInterval = 0.5
+    batchSize = 4096
+    maxPending = 1 << 16
+
+    def __init__(self):
+        self.pending = []
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='alert sink')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, alert):
+        with self.lock:
+            self.pending.append(alert)
+            waiting = len(self.pending)
+        if waiting >= self.batchSize:
+            if waiting >= self.maxPending:
+                self.flush()
+            else:
+                self.wake.set()
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.flushInterval)
+            self.wake.clear()
+            self.flush()
+
+    # Write every queued alert.  Can be called from any thread.
+    def flush(self):
+        with self.writeLock:
+            with self.lock:
+                (alerts, self.pending) = (self.pending, [])
+            if alerts:
+                self.writeAlerts(alerts)
+            self.flushOutput()
+
+    @abc.abstractmethod
+    def writeAlerts(self, alerts):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def closeOutput(self):
+        pass
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        self.closeOutput()
+
+
+class FileSink(AlertSink):
+    """
+    Base class of the sinks that write to a file.  fname is a file name, or - for
+    standard output.
+    """
+
+    mode = 'w'
+
+    def __init__(self, fname):
+        if fname == '-':
+            self.fp = sys.stdout.buffer if 'b' in self.mode else sys.stdout
+        else:
+            self.fp = open(fname, self.mode, newline='' if 'b' not in self.mode else None)
+        super(FileSink, self).__init__()
+
+    def flushOutput(self):
+        self.fp.flush()
+
+    def closeOutput(self):
+        if self.fp not in (sys.stdout, sys.stdout.buffer):
+            self.fp.close()
+
+
+class TextSink(FileSink):
+    """
+    Writes alerts in the format reportAnomaly has always printed them, with a line
+    giving the count of alerts that were coalesced into one.
+    """
+
+    def writeAlerts(self, alerts):
+        lines = []
+        for alert in alerts:
+            lines.append("Packet  %s  had an anomaly score of  %s\n%s\n" % (alert.packet, alert.score, alert.fields))
+            if alert.count > 1:
+                lines.append("Repeated  %d  times up to packet  %d  on  %s\n" % (alert.count, alert.lastPacket,
+                                                                                 alert.field))
+        self.fp.write(''.join(lines))
+
+
+class JsonLinesSink(FileSink):
+    """Writes one JSON object per alert."""
+
+    def writeAlerts(self, alerts):
+        lines = []
+        for alert in alerts:
+            record = {
+                'packet': alert.packet,
+                'score': alert.score,
+                'count': alert.count,
+                'lastPacket': alert.lastPacket,
+                'field': alert.field[0] if alert.field else None,
+                'value': plainValue(alert.field[1]) if alert.field else None,
+                'fields': dict((name, plainValue(value)) for (name, value) in alert.fields or []),
+            }
+            lines.append(json.dumps(record))
+        self.fp.write('\n'.join(lines) + '\n')
+
+
+class CsvSink(FileSink):
+    """Writes one row per alert, with a column for each of the given field names."""
+
+    def __init__(self, fname, names):
+        super(CsvSink, self).__init__(fname)
+        self.names = names
+        self.writer = csv.writer(self.fp)
+        self.writer.writerow(['packet', 'score', 'count', 'last_packet', 'field', 'value'] + list(names))
+
+    def writeAlerts(self, alerts):
+        names = self.names
+        rows = []
+        for alert in alerts:
+            values = dict(alert.fields or [])
+            (field, value) = alert.field if alert.field else ('', '')
+            rows.append([alert.packet, alert.score, alert.count, alert.lastPacket, field, plainValue(value)] +
+                        [plainValue(values.get(name, '')) for name in names])
+        self.writer.writerows(rows)
+
+
+# The binary log starts with a header holding a magic number, a version and the
+# field names, as a length and the names separated by newlines.  Each alert is then
+# a record header (packet, last packet, score, count, index of the highest scoring
+# field in the fields or 0xffff, number of fields) followed by the fields, each an
+# index into the field names, a type (0 for an integer, 1 for bytes) and a value
+# (an unsigned 64 bit integer, or a length and the bytes).
+alertLogMagic = b'ADAL'
+alertLogVersion = 1
+alertLogHeader = struct.Struct('<4sII')
+alertRecord = struct.Struct('<QQdIHH')
+alertInteger = struct.Struct('<HBQ')
+alertBytes = struct.Struct('<HBH')
+
+
+class BinarySink(FileSink):
+    """Writes alerts to a compact binary log; see readAlertLog."""
+
+    mode = 'wb'
+
+    def __init__(self, fname, names):
+        super(BinarySink, self).__init__(fname)
+        self.names = list(names)
+        self.index = dict((name, i) for (i, name) in enumerate(self.names))
+        encoded = '\n'.join(self.names).encode('utf-8')
+        self.fp.write(alertLogHeader.pack(alertLogMagic, alertLogVersion, len(encoded)) + encoded)
+
+    def writeAlerts(self, alerts):
+        parts = []
+        for alert in alerts:
+            fields = alert.fields or []
+            keyIndex = 0xffff
+            if alert.field is not None and alert.field in fields:
+                keyIndex = fields.index(alert.field)
+            parts.append(alertRecord.pack(alert.packet, alert.lastPacket, alert.score, alert.count,
+                                          keyIndex, len(fields)))
+            for (name, value) in fields:
+                if isinstance(value, bytes):
+                    parts.append(alertBytes.pack(self.index[name], 1, len(value)))
+                    parts.append(value)
+                else:
+                    parts.append(alertInteger.pack(self.index[name], 0, value))
+        self.fp.write(b''.join(parts))
+
+
+# Yield the alerts of a binary log written by BinarySink
+def readAlertLog(fname):
+    with open(fname, 'rb') as fp:
+        data = fp.read()
+    (magic, version, namesLength) = alertLogHeader.unpack_from(data)
+    if magic != alertLogMagic or version != alertLogVersion:
+        raise ValueError(fname + " is not an alert log this version can read")
+    offset = alertLogHeader.size
+    names = data[offset:offset + namesLength].decode('utf-8').split('\n')
+    offset += namesLength
+    while offset < len(data):
+        (packet, lastPacket, score, count, keyIndex, numFields) = alertRecord.unpack_from(data, offset)
+        offset += alertRecord.size
+        fields = []
+        for i in range(numFields):
+            (nameIndex, kind) = struct.unpack_from('<HB', data, offset)
+            if kind == 0:
+                value = alertInteger.unpack_from(data, offset)[2]
+                offset += alertInteger.size
+            else:
+                length = alertBytes.unpack_from(data, offset)[2]
+                offset += alertBytes.size
+                value = data[offset:offset + length]
+                offset += length
+            fields.append([names[nameIndex], value])
+        field = fields[keyIndex] if keyIndex != 0xffff else None
+        yield Alert(packet, score, fields, count, lastPacket, field)
+
+
+class CallbackSink(AlertSink):
+    """Calls callback with each batch of alerts, a list of Alerts."""
+
+    def __init__(self, callback):
+        self.callback = callback
+        super(CallbackSink, self).__init__()
+
+    def writeAlerts(self, alerts):
+        self.callback(alerts)
+
+
+class Coalescer(object):
+    """
+    Collapses the alerts whose highest scoring (field, value) is the same within
+    window packets of the first of them into one alert with a count, and writes it to
+    sink when the window has closed.  Alerts without a field are passed on as they are.
+    """
+
+    def __init__(self, sink, window):
+        self.sink = sink
+        self.window = window
+        # (name, value) -> Alert being coalesced, oldest first
+        self.groups = collections.OrderedDict()
+
+    def write(self, alert):
+        self.expire(alert.packet)
+        if alert.field is None:
+            self.sink.write(alert)
+            return
+        key = (alert.field[0], alert.field[1])
+        first = self.groups.get(key)
+        if first is None:
+            self.groups[key] = alert
+        else:
+            self.groups[key] = first._replace(score=max(first.score, alert.score), count=first.count + alert.count,
+                                            lastPacket=alert.lastPacket)
+
+    # Write the alerts whose window has closed by packet.  Windows are only checked
+    # when an alert arrives, and the open ones are written by close().
+    def expire(self, packet):
+        groups = self.groups
+        while groups:
+            (key, alert) = next(iter(groups.items()))
+            if packet - alert.packet < self.window:
+                break
+            del groups[key]
+            self.sink.write(alert)
+
+    def flush(self):
+        self.sink.flush()
+
+    def close(self):
+        for alert in self.groups.values():
+            self.sink.write(alert)
+        self.groups.clear()
+        self.sink.close()
+
+
+# Return a sink for the given target (a file name, or - for standard output) and
+# format ('text', 'jsonl', 'csv' or 'binary'; by default the format is chosen by the
+# extension of the file name, .jsonl, .json, .csv, .bin or .alerts, and is text if
+# it has none of those).  Names are the fields that are scored.  If window is not 0,
+# alerts are coalesced over that many packets.
+def openSink(target='-', form=None, names=(), window=0):
+    if form is None:
+        form = 'text'
+        for (extension, extensionForm) in (('.jsonl', 'jsonl'), ('.json', 'jsonl'), ('.csv', 'csv'),
+                                           ('.bin', 'binary'), ('.alerts', 'binary')):
+            if target.endswith(extension):
+                form = extensionForm
+    if form == 'jsonl':
+        sink = JsonLinesSink(target)
+    elif form == 'csv':
+        sink = CsvSink(target, names)
+    elif form == 'binary':
+        sink = BinarySink(target, names)
+    else:
+        sink = TextSink(target)
+    if window:
+        sink = Coalescer(sink, window)
+    return sink
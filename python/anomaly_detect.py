@@ -7,163 +7,278 @@
 # obtained by dividing by maxTraining**2.
 # 
 # This program was tested on the input file maccdc2012_00000_trim.pcap, which was 
-# obtained by running the trim_file.py script on the PCAP file maccdc2012_00000.pcap 
-# obtained from the web page https://www.netresec.com/?page=MACCDC.  The file was
-# trimmed to 10,000,000 bytes.
+# obtained by running the trim_capture.py script with --bytes on the PCAP file
+# maccdc2012_00000.pcap obtained from the web page https://www.netresec.com/?page=MACCDC.
+# The file was trimmed to 10,000,000 bytes.
 #
 # This program allows a user to experiment with changing or extending the algorithm.
 
+import argparse
+import os
+import signal
 import sys
-from pcapfile import savefile
-
+import time
+from alert_sink import Alert, openSink
+from capture_set import CaptureSet, isCaptureSet
+from decay_store import DecayTable
+from field_summary import FieldSummaries
+from fields import allFields, compileExtractors, selectFields
+from flow_state import FlowTable
+from instrument import LatencyMeter, Metrics
+from live_stream import LiveStream, isLiveSource
+from load_shed import LoadShedder
+from model_store import loadModel, saveModel
+from pcap_index import MappedPcap
+import pcapfile
+from pcapfile.protocols.linklayer.ethernet import ethertypes
+from pcapfile.protocols.network.ip import protocols as ipProtocols
+from pcap_stream import PcapStream
+from pcapng_stream import PcapngStream, isPcapngFile
+from prefilter import compileFilter
+from sketch_store import SketchTable
+from state_store import FieldTable, ValueTable
+
+# fieldData and valueData are integer-keyed tables; see state_store.py.  In bounded
+# memory mode valueData is a SketchTable instead; see sketch_store.py, and in decayed
+# mode a DecayTable; see decay_store.py.
 maxFldId = 10
-fieldData = {}
-valueData = {}
+fieldData = FieldTable()
+valueData = ValueTable()
 
-sizePcap = 0
 numPackets = 0
 numTraining = 0
 maxPackets = 10000
 maxTraining = 400
 threshold = 0.9
+batchSize = 65536
 totalAnomalies = 0
 
-lastSeenIdx = 0
-totalSeenIdx = 1
+# The fields that are extracted and scored, and the functions that extract them
+# from each protocol layer; see setFields
+fieldNames = allFields
+fieldExtractors = compileExtractors(allFields)
+
+# Where and how often (in seconds) the trained state is saved; see saveSnapshot
+snapshotPath = None
+snapshotInterval = 60
+nextSnapshot = 0
+
+# The cursor of the loaded snapshot, from which a set of captures is resumed; see
+# capture_set.py
+resumeCursor = None
+
+# Set on SIGTERM during a run over a set of captures, to stop after the packet being
+# processed
+stopping = False
+
+# Where reportAnomaly sends alerts; see alert_sink.py.  If it is None they are printed.
+alertSink = None
+
+# In flow-aware mode, the flows of the packets and the Flow of the packet being
+# processed, if it has one; see flow_state.py
+flowTable = None
+currentFlow = None
+
+# Seconds in a unit of the fraction of a second of the packet timestamps
+timeScale = 1e-6
+
+# In decayed mode, the half-life in seconds of the counts in valueData, which is a
+# DecayTable, and the capture time of the packet being processed; see decay_store.py
+decayHalfLife = None
+currentTime = 0.0
+
+# If it is set, the heavy hitters and distinct counts of the fields processField adds;
+# see field_summary.py
+fieldSummaries = None
+
+# When reading a live source, the time from the arrival of each checked packet, and
+# of each anomalous packet, to the end of its scoring
+packetLatency = None
+alertLatency = None
+
+# When reading a live source with a latency target, what decides which packets are
+# shed; see load_shed.py
+loadShedder = None
 
 
 # This function can be used for debugging.
 def printFieldData():
     global fieldData
 
-    for fldKey in fieldData.keys():
-        print(fldKey, fieldData[fldKey])
+    for (fldKey, lastSeen, totalSeen) in fieldData.items():
+        print(fldKey, [lastSeen, totalSeen])
+
+
+# Choose the fields to extract and score.  include and exclude are lists of field
+# names or wildcards such as tcp_*; include=None selects every field.
+def setFields(include=None, exclude=None):
+    global fieldNames, fieldExtractors
+
+    fieldNames = selectFields(include, exclude)
+    fieldExtractors = compileExtractors(fieldNames)
+    print("Fields: ", ' '.join(fieldNames))
 
 
-# Open the PCAP file and return the object that holds the data
-def openPcapFile(fname):
-    global sizePcap
+# Open the PCAP file and return the object that streams its packets.  If useIndex is
+# set, the file is memory mapped and indexed so that the number of packets is known
+# up front and only the packets captured between startTime and endTime are read.  If
+# batchMode is set, packets are decoded in batches for runBatches instead of one at
+# a time for readPacket.  If rawRecords is set, the records are not decoded at all
+# and runParallel leaves that to its workers.  Standard input (-) and named pipes are
+# read as they are written, and so is a file if follow is set; see live_stream.py.
+def openPcapFile(fname, useIndex=False, startTime=None, endTime=None, batchMode=False, rawRecords=False,
+                 follow=False, cursor=None, accept=None):
+    global packets
 	
     print("PCAP file is ", fname)
 
-    fp = open(fname, 'rb')
-
-    # The following call to the pycapfile library parses packets in the given PCAP
-    # file down to the third  layer in the TCP/IP model: layer1 = data link (ethernet),
-    # layer2 = network (IP), layer3 = transport(TCP, UDP).  It saves the parsed packets
-    # in the list pcap.packets.
-    pcap = savefile.load_savefile(fp, layers=3)
-    sizePcap = len(pcap.packets) 
+    # Both readers parse packets in the given PCAP file down to the third layer in the
+    # TCP/IP model: layer1 = data link (ethernet), layer2 = network (IP), layer3 =
+    # transport(TCP, UDP).  Packets are parsed one at a time as they are read, so the
+    # whole file is never held in memory.
+    if useIndex or startTime is not None or endTime is not None:
+        pcap = MappedPcap.open(fname, layers=3)
+        (first, last) = pcap.timeRange(startTime, endTime)
+        if batchMode:
+            packets = readMappedBatches(pcap, first, last)
+        elif rawRecords:
+            packets = pcap.records(first, last)
+        else:
+            packets = pcap.packets(first, last)
+    elif isCaptureSet(fname):
+        # A directory or glob of captures, read in time order as one capture
+        pcap = CaptureSet.open(fname, layers=3, cursor=cursor)
+        packets = iter(pcap)
+    elif follow or isLiveSource(fname):
+        pcap = LiveStream.open(fname, layers=3, follow=follow)
+        packets = pcap.records() if rawRecords else iter(pcap)
+    else:
+        pcap = PcapStream.open(fname, layers=3)
+        if batchMode:
+            from batch_parse import readBatches
+            packets = (batch for (batch, timestamps) in readBatches(pcap, names=fieldNames))
+        elif rawRecords:
+            packets = pcap.records()
+        else:
+            packets = iter(pcap)
+
+    # Packets the filter rejects are skipped before they are decoded; see prefilter.py
+    if accept is not None:
+        if pcap.header.ll_type != 1:
+            raise SystemExit("A filter can only be used on an Ethernet capture")
+        pcap.accept = accept
+        if rawRecords:
+            packets = filterRecords(pcap, packets)
 
     print(pcap)
     return pcap
 
 
+# Yield the raw records that pass the filter of pcap, counting the others.  A pcapng
+# capture also filters out the packets of interfaces that are not Ethernet, and a
+# followed file those of a rotated file that is not.
+def filterRecords(pcap, records):
+    accept = pcap.accepted if isinstance(pcap, (PcapngStream, LiveStream)) else pcap.accept
+    for record in records:
+        if accept(record[4]):
+            yield record
+        else:
+            pcap.filtered += 1
+
+
 # Return the next packet from the PCAP file
 def readPacket():
-    global pcap
-    global numPackets, sizePcap
+    global packets
 	
-    if numPackets < sizePcap:
-        return pcap.packets[numPackets]
-    else:
-        print("No more packets in PCAP file")
+    if packets is None:
         return None
+    packet = next(packets, None)
+    if packet is None:
+        if alertSink is not None:
+            alertSink.flush()
+        print("No more packets in PCAP file")
+        packets = None
+    return packet
+
+
+# Yield the packets first up to last of a memory-mapped PCAP file in decoded batches
+def readMappedBatches(pcap, first, last):
+    from batch_parse import decodeMapped
 
+    for start in range(first, last, batchSize):
+        yield decodeMapped(pcap, start, min(start + batchSize, last), fieldNames)
 
-# Parse and return fields from a single layer of a packet
+
+# Parse and return the enabled fields from a single layer of a packet
 def parseFields(layer, protocol):
-    fields = []
-    if protocol == 'IPv4':
-        fields.append(["ip_ver",layer.v])
-        fields.append(["ip_hlen",layer.hl])
-        fields.append(["ip_tos",layer.tos])
-        fields.append(["ip_len",layer.len])
-        fields.append(["ip_id",layer.id])
-        fields.append(["ip_flags",layer.flags])
-        fields.append(["ip_off",layer.off])
-        fields.append(["ip_ttl",layer.ttl])
-        fields.append(["ip_proto",layer.p])
-        fields.append(["ip_src",layer.src])
-        fields.append(["ip_dst",layer.dst])
-    elif protocol == 'TCP':
-        fields.append(["tcp_srcport",layer.src_port])
-        fields.append(["tcp_dstport",layer.dst_port])
-        fields.append(["tcp_seqnum",layer.seqnum])
-        fields.append(["tcp_acknum",layer.acknum])
-        fields.append(["tcp_doff",layer.data_offset])
-        fields.append(["tcp_res",layer.reserved])
-        fields.append(["tcp_flags",layer.flags])
-    elif protocol == 'UDP':
-        fields.append(["udp_srcport",layer.src_port])
-        fields.append(["udp_dstport",layer.dst_port])
-        fields.append(["udp_len",layer.len])
-    elif protocol == 'UDPLITE':
-        fields.append(["udpl_srcport",layer.src_port])
-        fields.append(["udpl_dstport",layer.dst_port])
-        fields.append(["udpl_cover",layer.coverage])
+    extract = fieldExtractors.get(protocol)
+    if extract is None:
+        return []
+    return extract(layer)
 
-    return fields
 
+# The protocol name of each class of decoded layer, taken from the registries of the
+# pypcapfile decoders, e.g. IP -> 'IPv4'.  Protocols registered with
+# register_ethertype or register_protocol before this module is imported are parsed.
+layerProtocols = dict((ctor, name) for (ctor, name) in list(ethertypes.values()) + list(ipProtocols.values()))
 
-# Return a protocol string based on the value of the protocol field of a packet layer
-def getProtocol(protocol):
-    if protocol == 0x0800:
-        return 'IPv4'
-    elif protocol == 0x8100:
-        return 'VLAN'
-    elif protocol == 0x11:
-        return 'UDP'
-    elif protocol == 0x88:
-        return 'UDPLITE'
-    elif protocol == 0x06:
-        return 'TCP'
-    else:
-        return 'unknown'
-  
 
- # Parse and return the fields from layers 2 and 3 of a packet
+# Parse and return the fields from the layers of a packet above the data link layer.
+# The decoded layers are followed down through their payloads (a VLAN tag has no
+# fields of its own) until a payload that was not decoded.  A packet none of whose
+# layers has fields gives an empty list.
 def parsePacket(layer1_packet):
     fields = []
-	
-    protocol = getProtocol(layer1_packet.packet.type)
-    if protocol == 'IPv4':
-        layer2_packet = layer1_packet.packet.payload
-    elif protocol == 'VLAN': # VLAN is between Ethernet and IP
-        vlan_packet = layer1_packet.packet.payload
-        protocol = getProtocol(vlan_packet.protocol) # Get the layer 2 protocol
-        layer2_packet = vlan_packet.payload
-    else:
-        return None
-
-    fields += parseFields(layer2_packet, protocol)
-    layer3_protocol = getProtocol(layer2_packet.p)
-    layer3_packet = layer2_packet.payload
-    fields += parseFields(layer3_packet, layer3_protocol)
+    layer = getattr(layer1_packet.packet, 'payload', None)
+    protocol = layerProtocols.get(type(layer))
+    while protocol is not None:
+        fields += parseFields(layer, protocol)
+        layer = layer.payload
+        protocol = layerProtocols.get(type(layer))
     return fields
 
 
+# Return the capture time of a packet in seconds since the epoch
+def packetTime(packet):
+    return packet.timestamp + packet.timestamp_us * timeScale
+
+
+# Find the Flow of a packet in flow-aware mode and make it the current one
+def setFlow(packet):
+    global currentFlow
+
+    currentFlow = flowTable.lookup(packet.packet, packetTime(packet))
+
+
 # Compute the normalized anomaly score of a field
 def scoreField(fld):
-    global lastSeenIdx, totalSeenIdx
     global numPackets, maxTraining
     global fieldData, valueData
 
-    fldKey = fld[0]
-    fldVal = fld[1]	
-    valKey = str(fldKey) + str(fldVal)
+    fldId = fieldData.ids[fld[0]]
+    (lastSeen, totalSeen) = valueData.state(fldId, fld[1])
 
-    if valKey in valueData.keys():
-        timeScore = numPackets - valueData[valKey][lastSeenIdx]
+    if totalSeen:
+        timeScore = numPackets - lastSeen
         if timeScore > maxTraining:
             timeScore = maxTraining
-        frequencyScore = float(fieldData[fldKey][totalSeenIdx]) / valueData[valKey][totalSeenIdx]
+        frequencyScore = float(fieldData.count[fldId]) / totalSeen
         if frequencyScore > maxTraining:
             frequencyScore = float(maxTraining)
     else:
         timeScore = maxTraining
         frequencyScore = float(maxTraining)
     anomalyScore = timeScore * frequencyScore
+
+    # In flow-aware mode a value that is normal for the flow of the packet is normal,
+    # however rare it is elsewhere
+    if currentFlow is not None:
+        (lastSeen, totalSeen) = currentFlow.state(fldId, fld[1])
+        if totalSeen:
+            timeScore = min(numPackets - lastSeen, maxTraining)
+            frequencyScore = min(float(currentFlow.count[fldId]) / totalSeen, float(maxTraining))
+            anomalyScore = min(anomalyScore, timeScore * frequencyScore)
+
     normalScore = anomalyScore / maxTraining**2
 
     if normalScore > threshold:
@@ -172,74 +287,511 @@ def scoreField(fld):
         return (0, normalScore)
 
 
-# Report an anomalous packet
-def reportAnomaly(score, packet):
-    print("Packet ", numPackets, " had an anomaly score of ", score)
-    print(packet)
+# Compute the normalized anomaly score of a field in decayed mode.  The time score
+# is maxTraining times the staleness of the value and the frequency score is the
+# decayed count of the field over that of the value, so the scores have the same
+# range as those of scoreField.
+def scoreDecayedField(fld):
+    fldId = fieldData.ids[fld[0]]
+    (lastSeen, totalSeen) = valueData.decayedState(fldId, fld[1], currentTime)
+
+    if totalSeen:
+        timeScore = maxTraining * valueData.staleness(currentTime - lastSeen)
+        frequencyScore = valueData.fieldCount(fldId, currentTime) / totalSeen
+        if frequencyScore > maxTraining:
+            frequencyScore = float(maxTraining)
+    else:
+        timeScore = maxTraining
+        frequencyScore = float(maxTraining)
+    normalScore = timeScore * frequencyScore / maxTraining**2
+
+    if normalScore > threshold:
+        return (1, normalScore)
+    else:
+        return (0, normalScore)
+
+
+# Report an anomalous packet.  field is its highest scoring field, if it is known.
+def reportAnomaly(score, packet, field=None):
+    if alertSink is None:
+        print("Packet ", numPackets, " had an anomaly score of ", score)
+        print(packet)
+    else:
+        alertSink.write(Alert(numPackets, score, packet, 1, numPackets, field))
 
 
 # Update the fieldData and valueData tables based on a particular field
 def processField(fld):
-    global lastSeenIdx, totalSeenIdx
     global numPackets, fieldData, valueData
 
-    fldKey = fld[0]
-    fldVal = fld[1]	
-    if fldKey in fieldData.keys():
-        fieldData[fldKey][lastSeenIdx] = numPackets
-        fieldData[fldKey][totalSeenIdx] = fieldData[fldKey][totalSeenIdx] + 1
-    else:
-        fieldData[fldKey] = [numPackets, 1]
+    fldId = fieldData.ids[fld[0]]
+    fieldData.last[fldId] = numPackets
+    fieldData.count[fldId] += 1
 
-    valKey = fldKey + str(fldVal)
-    if valKey in valueData.keys():
-        valueData[valKey][lastSeenIdx] = numPackets
-        valueData[valKey][totalSeenIdx] = valueData[valKey][totalSeenIdx] + 1
-    else:
-        valueData[valKey] = [numPackets, 1]
+    valueData.add(fldId, fld[1], numPackets)
+    if currentFlow is not None:
+        currentFlow.add(fldId, fld[1], numPackets)
+    if fieldSummaries is not None:
+        fieldSummaries.add(fldId, fld[1])
+
+
+# Update the fieldData and valueData tables based on a field in decayed mode
+def processDecayedField(fld):
+    fldId = fieldData.ids[fld[0]]
+    fieldData.last[fldId] = numPackets
+    fieldData.count[fldId] += 1
+
+    valueData.add(fldId, fld[1], currentTime)
+    if fieldSummaries is not None:
+        fieldSummaries.add(fldId, fld[1])
+
+
+# Replace the trained state with the one saved in a snapshot file, so that training
+# can be skipped.  maxPackets counts from the packets the snapshot has already seen.
+def loadSnapshot(path):
+    global fieldData, valueData, numPackets, maxTraining, threshold, maxPackets, resumeCursor
+
+    (fieldData, valueData, numPackets, maxTraining, threshold, resumeCursor) = loadModel(path)
+    maxPackets += numPackets
+    print("Loaded model ", path, " after ", numPackets, " packets (", len(valueData), " values)")
+
+
+# Save the trained state to snapshotPath.  The snapshot is replaced atomically, so a
+# crash loses at most the packets seen since the last one.  When a set of captures
+# is read, the cursor of the reader is saved with it.
+def saveSnapshot():
+    global nextSnapshot
+
+    cursor = pcap.cursor(numPackets) if isinstance(pcap, CaptureSet) else None
+    try:
+        saveModel(snapshotPath, fieldData, valueData, numPackets, maxTraining, threshold, cursor)
+    except OSError as err:
+        print("Could not save model ", snapshotPath, ": ", err)
+    nextSnapshot = time.monotonic() + snapshotInterval
+
+
+# Save a snapshot if snapshotInterval seconds have passed since the last one
+def checkSnapshot():
+    if snapshotPath is not None and time.monotonic() >= nextSnapshot:
+        saveSnapshot()
 
 
 # This function does the training phase of the anomaly detection algorithm.
 def trainData():
-    global numPackets, maxTraining, sizePcap
+    global numPackets, maxTraining, currentTime
 
-    while numPackets < maxTraining and numPackets < sizePcap:
+    while numPackets < maxTraining and not stopping:
         packet = readPacket()
+        if packet is None:
+            break
         fields = parsePacket(packet)
         numPackets += 1
+        if flowTable is not None:
+            setFlow(packet)
+        if decayHalfLife is not None:
+            currentTime = packetTime(packet)
         for field in fields:
             processField(field)
+        checkSnapshot()
 
 
 # After training, this function checks packets for anomalies
 def checkData():
-    global numPackets, maxTraining, sizePcap, totalAnomalies
+    global numPackets, maxTraining, totalAnomalies, currentTime
 
-    # The program exits on an error on packet 887.  I didn't have time to figure it out.
-    while numPackets < maxPackets and numPackets < sizePcap:
-    #while numPackets < maxPackets and numPackets < sizePcap and numPackets < 886:
+    # A capture trimmed at a byte count ends in the middle of a record.  The readers stop
+    # at the last complete record, and trim_capture.py only writes whole records.
+    while numPackets < maxPackets and not stopping:
         packet = readPacket()
+        if packet is None:
+            break
         fields = parsePacket(packet)
         numPackets += 1
-        anomalies = 0
-        anomalyScore = 0
-
-        for field in fields:
-            (anomaly, score) = scoreField(field)
-            anomalies += anomaly
-            if score > anomalyScore:
-                anomalyScore = score
-            processField(field)
+        if flowTable is not None:
+            setFlow(packet)
+        if decayHalfLife is not None:
+            currentTime = packetTime(packet)
+        if loadShedder is not None and not loadShedder.admit(packet, time.monotonic()):
+            # A shed packet is never scored, and in count-only mode is still counted
+            if loadShedder.mode == 'count-only':
+                for field in fields:
+                    processField(field)
+            checkSnapshot()
+            continue
+        (anomalies, anomalyScore, anomalyField) = checkPacket(fields)
         if anomalies > 0:
-            reportAnomaly(anomalyScore, fields)
+            reportAnomaly(anomalyScore, fields, anomalyField)
             totalAnomalies += 1
-
-infile = sys.argv[1]
-pcap = openPcapFile(infile)
-
-trainData()
-#printFieldData()
-checkData()
-print("Total anomalies found = ", totalAnomalies)
+        if packetLatency is not None:
+            latency = time.monotonic() - pcap.arrival
+            packetLatency.add(latency)
+            if anomalies > 0:
+                alertLatency.add(latency)
+        checkSnapshot()
+
+
+# Score the fields of a packet and then add them to the tables.  Returns the number
+# of fields that scored above the threshold, the highest field score and the field
+# that had it.
+def checkPacket(fields):
+    anomalies = 0
+    anomalyScore = 0
+    anomalyField = None
+
+    for field in fields:
+        (anomaly, score) = scoreField(field)
+        anomalies += anomaly
+        if score > anomalyScore:
+            anomalyScore = score
+            anomalyField = field
+        processField(field)
+    return anomalies, anomalyScore, anomalyField
+
+
+# This function trains on and then checks packets the way trainData and checkData do,
+# but decodes and scores whole batches of packets at a time.  Only IPv4 and the TCP,
+# UDP and UDP-Lite headers it carries are decoded (see batch_parse.py), so the
+# results are the same as theirs for IPv4 traffic only: IPv6, ARP and other packets
+# have no fields and are never anomalous.
+def runBatches():
+    global numPackets, totalAnomalies
+    import numpy as np
+    from batch_parse import rowFields
+    from batch_score import BatchScorer
+
+    scorer = BatchScorer(maxTraining, threshold, fieldNames)
+    for batch in packets:
+        batch = batch[:maxPackets - numPackets]
+        numTrain = min(len(batch), max(0, maxTraining - numPackets))
+        scorer.train(batch[:numTrain])
+        batch = batch[numTrain:]
+        first = scorer.numPackets
+        (scores, anomalies) = scorer.score(batch)
+        for i in np.flatnonzero(anomalies):
+            numPackets = first + i + 1
+            reportAnomaly(scores[i], rowFields(batch, i))
+            totalAnomalies += 1
+        numPackets = scorer.numPackets
+        if numPackets >= maxPackets:
+            break
+
+
+# This function trains on and checks packets in several worker processes, each with
+# its own state for the flows it is given; see parallel_detect.py.  Anomalies are
+# reported in packet order.  memoryLimit is the size in bytes of a bounded-memory
+# valueData for each worker, or None.
+def runParallel(workers, memoryLimit=None):
+    global numPackets, totalAnomalies
+    from parallel_detect import ShardedDetector
+
+    settings = {'fields': fieldNames, 'maxTraining': maxTraining, 'threshold': threshold,
+                'memoryLimit': memoryLimit}
+    first = numPackets
+    detector = ShardedDetector(pcap.rawHeader, workers, settings)
+    records = ((number, record[4]) for (number, record) in
+               zip(range(numPackets + 1, maxPackets + 1), packets))
+    for (number, score, fields, field) in detector.run(records):
+        numPackets = number
+        reportAnomaly(score, fields, field)
+        totalAnomalies += 1
+    detector.close()
+    numPackets = first + detector.numRecords
+
+
+# This function trains on and checks packets the way trainData and checkData do, but
+# the packets are decoded by parser processes while the ones decoded before them are
+# scored here; see pipeline_detect.py.  The parsers use the batch decoder, so as in
+# runBatches only IPv4 packets are scored, and the others are never anomalous.
+def runPipeline(parsers):
+    global numPackets, totalAnomalies
+    from pipeline_detect import ParserPool
+
+    pool = ParserPool(pcap, fieldNames, parsers)
+    for fields in pool.fields():
+        numPackets += 1
+        if numPackets <= maxTraining:
+            for field in fields:
+                processField(field)
+        else:
+            (anomalies, anomalyScore, anomalyField) = checkPacket(fields)
+            if anomalies > 0:
+                reportAnomaly(anomalyScore, fields, anomalyField)
+                totalAnomalies += 1
+        checkSnapshot()
+        if numPackets >= maxPackets:
+            break
+    pool.close()
+
+
+# Print the field summaries on SIGUSR1, so they can be looked at while a sensor runs
+def printSummaries(signum, frame):
+    print("Field summaries after ", numPackets, " packets:", file=sys.stderr)
+    print(fieldSummaries.format(fieldData), file=sys.stderr)
+
+
+# Stop a live run or a run over a set of captures on SIGTERM once the packet being
+# processed is done, so the snapshot saved at the end is never of a half-updated
+# model and its cursor is exact.  A live source waiting for data is told to end.
+def stopAfterPacket(signum, frame):
+    global stopping
+
+    stopping = True
+    if isinstance(pcap, LiveStream):
+        pcap.stop()
+
+
+# Split a comma-separated list of field names given on the command line
+def fieldList(text):
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+
+# Compile a filter expression given on the command line; see prefilter.py
+def filterExpression(text):
+    try:
+        return compileFilter(text)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+# Parse the command line
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Detect anomalies in the packets of a PCAP file",
+                                     fromfile_prefix_chars='@',
+                                     epilog="Options can also be read from a file given as @file, one per line.")
+    parser.add_argument("infile", help="PCAP file or named pipe to read, - for standard input, or a directory "
+                                       "or quoted glob of captures to read in time order")
+    parser.add_argument("--follow", action="store_true",
+                        help="keep reading infile as it grows and reopen it when it is rotated, like tail -F; "
+                             "if it does not exist yet, wait for it")
+    parser.add_argument("--fields", type=fieldList,
+                        help="comma-separated fields to score, e.g. 'ip_*,tcp_dstport' (default: all of "
+                             + ','.join(allFields) + ")")
+    parser.add_argument("--exclude-fields", type=fieldList,
+                        help="comma-separated fields not to score, e.g. tcp_seqnum,tcp_acknum")
+    parser.add_argument("--index", action="store_true",
+                        help="memory map the file and keep a record index in infile.idx")
+    parser.add_argument("--start-time", type=float,
+                        help="skip packets captured before this time (seconds since the epoch); implies --index")
+    parser.add_argument("--end-time", type=float,
+                        help="stop at the first packet captured at or after this time; implies --index")
+    parser.add_argument("--filter", type=filterExpression,
+                        help="only look at the packets that match this expression, e.g. 'tcp and not port 22' "
+                             "or 'ip and net 10.0.0.0/8'; the others are skipped before they are decoded "
+                             "(ip, ip6, arp, vlan, ether proto N, tcp, udp, udplite, icmp, icmp6, proto N, "
+                             "[src|dst] port N[-M], [src|dst] host A, [src|dst] net A/BITS, not, and, or)")
+    parser.add_argument("--batch", action="store_true",
+                        help="decode and score packets in NumPy batches (requires NumPy); only IPv4 "
+                             "packets are scored, others are never anomalous")
+    parser.add_argument("--memory-limit", type=float,
+                        help="keep valueData in about this many megabytes using a Count-Min sketch "
+                             "and an evicting last-seen table; scores become approximate")
+    parser.add_argument("--load-model",
+                        help="start from the state saved in this snapshot file instead of training")
+    parser.add_argument("--save-model",
+                        help="save the trained state to this snapshot file periodically and at the end")
+    parser.add_argument("--resume", action="store_true",
+                        help="if the --save-model snapshot exists, start from it and, for a directory or "
+                             "glob, from the file and offset it was saved at")
+    parser.add_argument("--snapshot-interval", type=float, default=snapshotInterval,
+                        help="seconds between snapshots (default %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="detect in this many processes, each keeping the state of its share of "
+                             "the flows (default 1); scores differ from those of a single process")
+    parser.add_argument("--parsers", type=int, default=0,
+                        help="decode packets in this many processes while scoring in this one "
+                             "(requires NumPy; default 0, decode and score in turn); only IPv4 packets "
+                             "are scored, others are never anomalous")
+    parser.add_argument("--flows", choices=['connection', 'host'],
+                        help="also score each packet against the history of its connection (protocol, "
+                             "addresses and ports) or of its source host; a value normal there is normal")
+    parser.add_argument("--max-flows", type=int, default=4096,
+                        help="connections or hosts to keep the history of; the least recently seen "
+                             "makes way for a new one (default %(default)s)")
+    parser.add_argument("--flow-timeout", type=float, default=300.0,
+                        help="forget a connection or host after this many seconds of capture time "
+                             "without packets (default %(default)s)")
+    parser.add_argument("--new-flow-rate", type=float, default=1000.0,
+                        help="start keeping the history of at most this many new connections or hosts "
+                             "per second of capture time (default %(default)s)")
+    parser.add_argument("--decay", type=float, metavar="HALF_LIFE",
+                        help="score by capture time instead of packet counts, with counts that halve "
+                             "every HALF_LIFE seconds, so old traffic stops counting")
+    parser.add_argument("--top-k", type=int, default=0,
+                        help="keep the K most frequent values and a distinct count of each field, "
+                             "reported in the metrics, on SIGUSR1 and at the end (default 0, off)")
+    parser.add_argument("--shed-target", type=float, metavar="SECONDS",
+                        help="on a live source, shed packets of a share of the flows when alerts would "
+                             "come more than this many seconds after their packets arrive")
+    parser.add_argument("--shed-mode", choices=['sample', 'count-only'], default='sample',
+                        help="skip shed packets altogether (sample), or add them to the tables without "
+                             "scoring them (count-only) (default %(default)s)")
+    parser.add_argument("--metrics",
+                        help="write stage timers, counters and latency histograms to this file, "
+                             "or to a socket given as unix:PATH or tcp:HOST:PORT")
+    parser.add_argument("--metrics-format", choices=['json', 'prometheus'], default='json',
+                        help="format of the metrics (default %(default)s)")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="seconds between metrics dumps (default %(default)s)")
+    parser.add_argument("--alerts", default='-',
+                        help="file to write alerts to, or - for standard output (default)")
+    parser.add_argument("--alert-format", choices=['text', 'jsonl', 'csv', 'binary'],
+                        help="format of the alerts (default: from the extension of the --alerts file, "
+                             ".jsonl or .json for jsonl, .csv for csv, .bin or .alerts for binary, "
+                             "otherwise text)")
+    parser.add_argument("--coalesce", type=int, default=0,
+                        help="collapse alerts on the same highest scoring field and value within this "
+                             "many packets into one alert with a count (default 0, off)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.parsers < 0:
+        parser.error("--parsers cannot be negative")
+    if args.parsers and (args.batch or args.workers > 1 or args.index or
+                         args.start_time is not None or args.end_time is not None):
+        parser.error("--parsers cannot be used with --batch, --workers or --index")
+    if (args.follow or isLiveSource(args.infile)) and (args.batch or args.parsers or args.index or
+                                                       args.start_time is not None or args.end_time is not None):
+        parser.error("a live source or --follow cannot be used with --batch, --parsers or --index")
+    if isPcapngFile(args.infile) and (args.batch or args.parsers or args.index or
+                                      args.start_time is not None or args.end_time is not None):
+        parser.error("a pcapng capture cannot be used with --batch, --parsers or --index")
+    if isCaptureSet(args.infile) and (args.batch or args.parsers or args.workers > 1 or args.index or args.follow or
+                                      args.start_time is not None or args.end_time is not None):
+        parser.error("a directory or glob cannot be used with --batch, --parsers, --workers, --index or --follow")
+    if args.resume and (not args.save_model or args.load_model):
+        parser.error("--resume needs --save-model and cannot be used with --load-model")
+    if args.filter and (args.batch or args.parsers):
+        parser.error("--filter cannot be used with --batch or --parsers")
+    if args.workers > 1 and (args.batch or args.load_model or args.save_model):
+        parser.error("--workers cannot be used with --batch, --load-model or --save-model")
+    if args.flows and (args.batch or args.parsers or args.workers > 1):
+        parser.error("--flows cannot be used with --batch, --parsers or --workers")
+    if args.decay is not None and args.decay <= 0:
+        parser.error("--decay must be positive")
+    if args.decay is not None and (args.batch or args.parsers or args.workers > 1 or args.flows or
+                                   args.memory_limit or args.load_model or args.save_model):
+        parser.error("--decay cannot be used with --batch, --parsers, --workers, --flows, --memory-limit, "
+                     "--load-model or --save-model")
+    if args.shed_target is not None:
+        if args.shed_target <= 0:
+            parser.error("--shed-target must be positive")
+        if not (args.follow or isLiveSource(args.infile)) or args.workers > 1:
+            parser.error("--shed-target needs a live source or --follow and cannot be used with --workers")
+    if args.top_k < 0:
+        parser.error("--top-k cannot be negative")
+    if args.top_k and (args.batch or args.workers > 1):
+        parser.error("--top-k cannot be used with --batch or --workers")
+    if args.max_flows < 1:
+        parser.error("--max-flows must be at least 1")
+    if args.batch and args.memory_limit:
+        parser.error("--memory-limit cannot be used with --batch")
+    if args.batch and (args.load_model or args.save_model):
+        parser.error("--load-model and --save-model cannot be used with --batch")
+    try:
+        selectFields(args.fields, args.exclude_fields)
+    except ValueError as err:
+        parser.error(str(err))
+    return args
+
+
+def main():
+    global pcap, valueData, snapshotPath, snapshotInterval, nextSnapshot
+    global maxPackets, packetLatency, alertLatency, alertSink, flowTable, timeScale
+    global decayHalfLife, scoreField, processField, fieldSummaries, loadShedder
+
+    args = parseArgs()
+    setFields(args.fields, args.exclude_fields)
+    if args.decay is not None:
+        # Score with decayed counts; done before the stages are timed so that the
+        # timers wrap the decayed functions
+        decayHalfLife = args.decay
+        valueData = DecayTable(decayHalfLife)
+        (scoreField, processField) = (scoreDecayedField, processDecayedField)
+    if args.memory_limit:
+        valueData = SketchTable.fromMemoryLimit(int(args.memory_limit * 1000000))
+    if args.resume and os.path.exists(args.save_model):
+        args.load_model = args.save_model
+    if args.load_model:
+        try:
+            loadSnapshot(args.load_model)
+        except (OSError, ValueError) as err:
+            raise SystemExit("Could not load model " + args.load_model + ": " + str(err))
+    snapshotPath = args.save_model
+    snapshotInterval = args.snapshot_interval
+    nextSnapshot = time.monotonic() + snapshotInterval
+    try:
+        pcap = openPcapFile(args.infile, args.index, args.start_time, args.end_time, args.batch,
+                            args.workers > 1 or args.parsers > 0, args.follow, resumeCursor, args.filter)
+    except (OSError, pcapfile.Error) as err:
+        raise SystemExit(str(err))
+    alertSink = openSink(args.alerts, args.alert_format, fieldNames, args.coalesce)
+    timeScale = 1e-9 if pcap.header.ns_resolution else 1e-6
+    if args.flows:
+        flowTable = FlowTable(len(allFields) + 1, args.max_flows, args.flow_timeout, args.new_flow_rate,
+                              perHost=args.flows == 'host')
+    if args.top_k:
+        fieldSummaries = FieldSummaries(args.top_k)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, printSummaries)
+    metrics = None
+    if args.metrics:
+        # Time the stages of this module; see instrument.py
+        metrics = Metrics(args.metrics, args.metrics_format, args.metrics_interval)
+        metrics.install(sys.modules[__name__], pcap)
+    live = isinstance(pcap, LiveStream)
+    if live:
+        # A live source is checked until it ends or the program is interrupted
+        maxPackets = sys.maxsize
+        packetLatency = LatencyMeter()
+        alertLatency = LatencyMeter()
+        signal.signal(signal.SIGTERM, stopAfterPacket)
+        if args.shed_target is not None:
+            loadShedder = LoadShedder(pcap, args.shed_target, args.shed_mode)
+    resumable = isinstance(pcap, CaptureSet)
+    if resumable:
+        # Every file of a set is checked, and an interrupted run saves its cursor
+        maxPackets = sys.maxsize
+        signal.signal(signal.SIGTERM, stopAfterPacket)
+
+    try:
+        if args.parsers:
+            runPipeline(args.parsers)
+        elif args.workers > 1:
+            memoryLimit = int(args.memory_limit * 1000000 / args.workers) if args.memory_limit else None
+            runParallel(args.workers, memoryLimit)
+        elif args.batch:
+            runBatches()
+        else:
+            trainData()
+            #printFieldData()
+            checkData()
+    except KeyboardInterrupt:
+        if not (live or resumable):
+            raise
+        print("Interrupted")
+    pcap.close()
+    alertSink.close()
+    if snapshotPath is not None:
+        saveSnapshot()
+    print("Total packets processed = ", numPackets)
+    print("Total anomalies found = ", totalAnomalies)
+    if args.filter:
+        print("Packets filtered out = ", pcap.filtered)
+    if flowTable is not None:
+        print("Flows: ", flowTable)
+    if fieldSummaries is not None:
+        print("Field summaries:")
+        print(fieldSummaries.format(fieldData))
+    if loadShedder is not None:
+        print("Load shedding: ", loadShedder)
+    if live and packetLatency.count:
+        print("Arrival to score latency: ", packetLatency)
+        print("Arrival to alert latency: ", alertLatency)
+    if metrics is not None:
+        metrics.close()
+
+
+if __name__ == '__main__':
+    main()
 			
 
@@ -0,0 +1,198 @@
+# This module decodes the layer 2 and layer 3 headers of many packets at once into a
+# NumPy structured array with one column per field that parseFields in
+# anomaly_detect.py knows about.  Instead of building pypcapfile layer objects and a
+# list of [name, value] pairs for every packet, each column is gathered for the whole
+# batch with vectorized byte-offset arithmetic.  The offset of the IP header is worked
+# out per row from the Ethernet type, so VLAN tagged and untagged frames can be mixed
+# in one batch.
+#
+# The decoded rows follow the same rules as parsePacket: an Ethernet frame carries
+# IPv4 either directly or behind a single VLAN tag, and the TCP, UDP or UDPLITE
+# header that follows is decoded if it was captured in full.  Rows that are not IPv4
+# have the ipv4 column set to False; the l4 column holds the IP protocol number of
+# the transport header that was decoded, or 0 if there was none.
+#
+# Only the columns of the fields asked for are gathered and stored; see fields.py.
+#
+# This module requires NumPy.
+
+import numpy as np
+
+from fields import addressFields, allFields, batchFields, fieldsByName, formatAddress, transportProtocols
+from pcap_stream import recordHeaderSize
+
+columnTypes = {1: np.uint8, 2: np.uint16, 4: np.uint32}
+
+ethHeaderSize = 14
+vlanHeaderSize = 4
+ipv4HeaderSize = 20
+transportHeaderSizes = {'TCP': 20, 'UDP': 8, 'UDPLITE': 8}
+
+
+# Return the dtype of a batch holding the given fields.  Fields of protocols the batch
+# decoder does not decode are left out.
+def batchDtype(names):
+    columns = [('ipv4', np.bool_), ('l4', np.uint8)]
+    for name in batchFields(names):
+        columns.append((name, columnTypes[fieldsByName[name].size]))
+    return np.dtype(columns)
+
+packetDtype = batchDtype(allFields)
+
+
+# Decode the frames found at the given start offsets of buf.  lengths holds the
+# captured length of each frame and names the fields to decode (all of them if
+# None).  Returns a structured array with a column for each field.  If out is given,
+# the rows are decoded into its first len(starts) rows instead of a new array, e.g.
+# to decode straight into shared memory.
+def decodeFrames(buf, starts, lengths, names=None, out=None):
+    names = batchFields(allFields if names is None else names)
+    data = np.frombuffer(buf, dtype=np.uint8)
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if out is None:
+        batch = np.zeros(len(starts), dtype=batchDtype(names))
+    else:
+        batch = out[:len(starts)]
+        batch.fill(0)
+    if len(starts) == 0:
+        return batch
+    last = len(data) - 1
+
+    # Gather helpers: offsets past the end of the buffer are clamped, and the values
+    # read there are masked off by the callers.
+    def u8(offsets):
+        return data[np.minimum(offsets, last)].astype(np.uint32)
+
+    def u16(offsets):
+        return (u8(offsets) << 8) | u8(offsets + 1)
+
+    def u32(offsets):
+        return (u16(offsets) << 16) | u16(offsets + 2)
+
+    readers = {1: u8, 2: u16, 4: u32}
+
+    # Decode the given fields from the headers starting at offsets into rows
+    def extract(protocol, rows, offsets):
+        for name in names:
+            spec = fieldsByName[name]
+            if spec.protocol != protocol:
+                continue
+            values = readers[spec.size](offsets + spec.offset)
+            if spec.shift:
+                values >>= spec.shift
+            if spec.mask is not None:
+                values &= spec.mask
+            if spec.scale != 1:
+                values *= spec.scale
+            batch[name][rows] = values
+
+    # Ethernet and VLAN: find where the IP header starts in each frame
+    etherType = u16(starts + 12)
+    vlan = (etherType == 0x8100) & (lengths >= ethHeaderSize + vlanHeaderSize)
+    etherType = np.where(vlan, u16(starts + 16), etherType)
+    ipStart = ethHeaderSize + vlanHeaderSize * vlan
+    ipOffsets = starts + ipStart
+
+    # IPv4 header
+    verHlen = u8(ipOffsets)
+    hlen = verHlen & 0x0f
+    ipv4 = ((lengths >= ethHeaderSize) & (etherType == 0x0800) &
+            (lengths >= ipStart + ipv4HeaderSize) & ((verHlen >> 4) == 4) & (hlen > 4))
+    batch['ipv4'] = ipv4
+    rows = np.flatnonzero(ipv4)
+    ipOffsets = ipOffsets[rows]
+    extract('IPv4', rows, ipOffsets)
+
+    # Transport header, if it was captured in full
+    proto = u8(ipOffsets + 9)
+    l4Start = ipStart[rows] + 4 * hlen[rows].astype(np.int64)
+    l4Offsets = starts[rows] + l4Start
+    available = lengths[rows] - l4Start
+    for (protocol, number) in transportProtocols.items():
+        present = (proto == number) & (available >= transportHeaderSizes[protocol])
+        batch['l4'][rows[present]] = number
+        extract(protocol, rows[present], l4Offsets[present])
+
+    return batch
+
+
+# Decode a list of raw frames, e.g. the data of the records yielded by
+# PcapStream.records()
+def decodeRecords(frames, names=None):
+    lengths = np.fromiter((len(frame) for frame in frames), dtype=np.int64, count=len(frames))
+    starts = np.zeros(len(frames), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return decodeFrames(b''.join(frames), starts, lengths, names)
+
+
+# Decode packets first up to but not including last of a MappedPcap
+def decodeMapped(pcap, first=0, last=None, names=None):
+    if last is None:
+        last = len(pcap)
+    offsets = np.frombuffer(pcap.offsets, dtype=np.uint64)[first:last].astype(np.int64)
+    # The captured length is the third word of each record header
+    byteOrder = '>' if pcap.header.byteorder == b'big' else '<'
+    raw = np.frombuffer(pcap.map, dtype=np.uint8)
+    words = raw[(offsets + 8)[:, None] + np.arange(4)]
+    lengths = words.view(np.dtype(byteOrder + 'u4')).ravel().astype(np.int64)
+    return decodeFrames(pcap.map, offsets + recordHeaderSize, lengths, names)
+
+
+# Split a block of consecutive PCAP records into the start offsets and captured
+# lengths of their frames.  recordHeader is the struct that unpacks a record header
+# (PcapStream.recordHeader).  Returns the starts, the lengths, the timestamp of each
+# record as (seconds, fraction) pairs, and the offset of the first byte of the block
+# that does not belong to a complete record.
+def splitRecords(block, recordHeader):
+    unpack = recordHeader.unpack_from
+    size = len(block)
+    starts = []
+    lengths = []
+    timestamps = []
+    offset = 0
+    while offset + recordHeaderSize <= size:
+        (seconds, fraction, captureLen, packetLen) = unpack(block, offset)
+        end = offset + recordHeaderSize + captureLen
+        if end > size:
+            break
+        starts.append(offset + recordHeaderSize)
+        lengths.append(captureLen)
+        timestamps.append((seconds, fraction))
+        offset = end
+    return starts, lengths, timestamps, offset
+
+
+# Read a PcapStream in blocks of about blockSize bytes and yield each block decoded
+# into a batch, together with the timestamps of its records.
+def readBatches(stream, blockSize=1 << 22, names=None):
+    read = stream.fp.read
+    leftover = b''
+    while True:
+        chunk = read(blockSize)
+        if not chunk:
+            return
+        block = leftover + chunk if leftover else chunk
+        (starts, lengths, timestamps, used) = splitRecords(block, stream.recordHeader)
+        leftover = block[used:]
+        if starts:
+            yield decodeFrames(block, starts, lengths, names), timestamps
+
+
+# Return the fields of row i of a batch in the [name, value] form that parsePacket
+# returns them.  Addresses are formatted as dotted-quad bytes, like pypcapfile's IP.
+def rowFields(batch, i):
+    row = batch[i]
+    if not row['ipv4']:
+        return None
+    l4 = int(row['l4'])
+    fields = []
+    for name in batch.dtype.names[2:]:
+        protocol = fieldsByName[name].protocol
+        if protocol != 'IPv4' and transportProtocols[protocol] != l4:
+            continue
+        value = int(row[name])
+        if name in addressFields:
+            value = formatAddress(value)
+        fields.append([name, value])
+    return fields
@@ -0,0 +1,155 @@
+# This module scores a whole batch of decoded packets at once.  It gives the same
+# results, bit for bit, as calling scoreField and then processField for every field
+# of every packet in anomaly_detect.py, but works on the columns of a batch from
+# batch_parse.py with array operations instead of per-field dictionary lookups.
+#
+# Scoring a field needs the state of its value as it was just before the packet was
+# seen: the packet the value was last seen in, how many times it had been seen, and
+# how many times the field had been seen.  Within a batch these are found by sorting
+# the (field, value) occurrences by key and then by packet number.  The first
+# occurrence of a key in the batch takes its state from the stored tables, and every
+# later one takes it from the occurrence before it, with counts advanced by its rank
+# in the group.  The stored tables are sorted arrays of keys with parallel arrays of
+# last-seen packet numbers and counts, and are merged with the batch afterwards.
+#
+# This module requires NumPy.
+
+import numpy as np
+
+from fields import allFields, batchFields, fieldsByName, transportProtocols
+
+# A key packs the field id (its position in the scorer's list of names) above the
+# 32 bit value of the field.
+fieldShift = 32
+
+
+# Return the rows of a batch that carry the given field
+def fieldRows(batch, name):
+    protocol = fieldsByName[name].protocol
+    if protocol == 'IPv4':
+        return np.flatnonzero(batch['ipv4'])
+    return np.flatnonzero(batch['l4'] == transportProtocols[protocol])
+
+
+class BatchScorer(object):
+    """
+    Holds the fieldData and valueData state of the detector as arrays and scores or
+    trains on batches of packets.  numPackets counts the packets seen so far, the
+    same way as the global of that name in anomaly_detect.py.
+    """
+
+    def __init__(self, maxTraining, threshold, names=None):
+        self.maxTraining = maxTraining
+        self.threshold = threshold
+        self.names = batchFields(names if names else allFields)
+        self.numPackets = 0
+
+        self.fieldLast = np.zeros(len(self.names), dtype=np.int64)
+        self.fieldCount = np.zeros(len(self.names), dtype=np.int64)
+
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.last = np.empty(0, dtype=np.int64)
+        self.count = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Return the field ids, keys and row numbers of every field occurrence in a batch,
+    # along with the number of times the field had been seen before each occurrence
+    def occurrences(self, batch):
+        fids = []
+        keys = []
+        rows = []
+        fieldBefore = []
+        for (fid, name) in enumerate(self.names):
+            sel = fieldRows(batch, name)
+            if len(sel) == 0:
+                continue
+            fids.append(np.full(len(sel), fid, dtype=np.int64))
+            keys.append((np.uint64(fid) << np.uint64(fieldShift)) | batch[name][sel].astype(np.uint64))
+            rows.append(sel)
+            # A field occurs at most once per packet, so its count before each
+            # occurrence is its stored count plus the occurrences before it here
+            fieldBefore.append(self.fieldCount[fid] + np.arange(len(sel), dtype=np.int64))
+        if not fids:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, np.empty(0, dtype=np.uint64), empty, empty
+        return (np.concatenate(fids), np.concatenate(keys), np.concatenate(rows),
+                np.concatenate(fieldBefore))
+
+    # Update the state with a batch of packets without scoring them, as trainData does
+    def train(self, batch):
+        self.process(batch, False)
+
+    # Score a batch of packets and update the state, as checkData does.  Returns the
+    # anomaly score of each packet (the highest score of its fields) and the number of
+    # its fields that scored above the threshold.
+    def score(self, batch):
+        return self.process(batch, True)
+
+    def process(self, batch, scoring):
+        numRows = len(batch)
+        packetScores = np.zeros(numRows, dtype=np.float64)
+        anomalies = np.zeros(numRows, dtype=np.int64)
+        (fids, keys, rows, fieldBefore) = self.occurrences(batch)
+        if len(keys) == 0:
+            self.numPackets += numRows
+            return packetScores, anomalies
+        packets = self.numPackets + 1 + rows
+
+        # Group the occurrences by key, in packet order within each group
+        order = np.lexsort((packets, keys))
+        keys = keys[order]
+        packets = packets[order]
+        newGroup = np.empty(len(keys), dtype=np.bool_)
+        newGroup[:1] = True
+        np.not_equal(keys[1:], keys[:-1], out=newGroup[1:])
+        groupStarts = np.flatnonzero(newGroup)
+        groupIds = np.cumsum(newGroup) - 1
+        rank = np.arange(len(keys)) - groupStarts[groupIds]
+        groupKeys = keys[groupStarts]
+
+        # Look up the stored state of each key in the batch
+        pos = np.searchsorted(self.keys, groupKeys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == groupKeys[found]
+        storedLast = np.zeros(len(groupKeys), dtype=np.int64)
+        storedCount = np.zeros(len(groupKeys), dtype=np.int64)
+        storedLast[found] = self.last[pos[found]]
+        storedCount[found] = self.count[pos[found]]
+
+        if scoring:
+            maxTraining = self.maxTraining
+            countBefore = storedCount[groupIds] + rank
+            lastBefore = np.where(rank == 0, storedLast[groupIds], np.roll(packets, 1))
+            seen = countBefore > 0
+
+            timeScore = np.minimum(packets - lastBefore, maxTraining)
+            timeScore[~seen] = maxTraining
+            frequencyScore = np.full(len(keys), float(maxTraining))
+            frequencyScore[seen] = np.minimum(fieldBefore[order][seen].astype(np.float64) / countBefore[seen],
+                                              float(maxTraining))
+            normalScore = (timeScore.astype(np.float64) * frequencyScore) / (maxTraining**2)
+
+            sortedRows = rows[order]
+            np.maximum.at(packetScores, sortedRows, normalScore)
+            np.add.at(anomalies, sortedRows, normalScore > self.threshold)
+
+        # Merge the batch into the stored state
+        groupEnds = np.r_[groupStarts[1:], len(keys)] - 1
+        groupLast = packets[groupEnds]
+        groupCount = groupEnds - groupStarts + 1
+        self.last[pos[found]] = groupLast[found]
+        self.count[pos[found]] += groupCount[found]
+        new = ~found
+        self.keys = np.insert(self.keys, pos[new], groupKeys[new])
+        self.last = np.insert(self.last, pos[new], groupLast[new])
+        self.count = np.insert(self.count, pos[new], groupCount[new])
+
+        fieldHits = np.bincount(fids, minlength=len(self.names))
+        self.fieldCount += fieldHits
+        for fid in np.flatnonzero(fieldHits):
+            self.fieldLast[fid] = self.numPackets + 1 + rows[fids == fid].max()
+
+        self.numPackets += numRows
+        return packetScores, anomalies
@@ -0,0 +1,257 @@
+# This script benchmarks the detector end to end: each run opens a capture with
+# openPcapFile, trains with trainData and checks with checkData exactly as
+# anomaly_detect.py does, in a fresh process so that its peak memory can be measured.
+# It runs on the captures bundled in ../pcap and on synthetic captures of the given
+# sizes, which are generated once and kept in --data-dir.
+#
+# For every run it reports packets per second, percentiles of the time taken by each
+# packet (from one readPacket call to the next, so reading, decoding, parsing and
+# scoring are all counted), the peak resident set size, and the time from the start
+# of the run to the first alert.  The results are written as JSON to --output, and a
+# previous results file given with --compare is checked for regressions.
+#
+# Run it with, for example:
+# python benchmark.py --sizes 10000,100000,1000000 --output results.json
+# python benchmark.py --variant=--batch --variant="--parsers 1" --compare results.json
+
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import resource
+import shlex
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+pcapDir = os.path.join(benchDir, '..', 'pcap')
+
+regressionPackets = 10000
+
+
+# Write a synthetic capture of numPackets Ethernet frames.  Most carry TCP, UDP or
+# UDPLITE over IPv4 between a small set of hosts, some are VLAN tagged, and a few
+# come from random addresses, so there is something for the detector to find.
+def writeSyntheticPcap(fname, numPackets, seed=1):
+    rand = random.Random(seed)
+    hosts = [0x0a000001 + i for i in range(20)]
+    mac = b'\x00\x11\x22\x33\x44\x55' * 2
+    ts = 1330000000.0
+    with open(fname + '.tmp', 'wb') as out:
+        out.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for i in range(numPackets):
+            ts += rand.expovariate(1000)
+            proto = rand.choice([6, 6, 6, 17, 0x88])
+            src = rand.choice(hosts) if rand.random() >= 0.005 else rand.getrandbits(32)
+            dst = rand.choice(hosts)
+            srcPort = rand.choice([80, 443, 22, 53]) if rand.random() < 0.5 else rand.randint(1024, 65535)
+            dstPort = rand.choice([80, 443, 22, 53])
+            if proto == 6:
+                l4 = struct.pack('!HHIIBBHHH', srcPort, dstPort, rand.getrandbits(32), rand.getrandbits(32),
+                                 0x50, rand.choice([2, 16, 18, 24]), 8192, 0, 0) + b'x' * rand.randint(0, 100)
+            else:
+                body = b'y' * rand.randint(0, 60)
+                l4 = struct.pack('!HHHH', srcPort, dstPort, 8 + len(body) if proto == 17 else 8, 0) + body
+            ip = struct.pack('!BBHHHBBHII', 0x45, 0, 20 + len(l4), rand.getrandbits(16), 0x4000,
+                             rand.choice([64, 64, 64, 128, 255]), proto, 0, src, dst) + l4
+            if rand.random() < 0.1:
+                frame = mac + struct.pack('!HHH', 0x8100, rand.choice([10, 20]), 0x0800) + ip
+            else:
+                frame = mac + b'\x08\x00' + ip
+            seconds = int(ts)
+            out.write(struct.pack('<IIII', seconds, int((ts - seconds) * 1000000), len(frame), len(frame)))
+            out.write(frame)
+    os.replace(fname + '.tmp', fname)
+
+
+# Return the path of a synthetic capture of numPackets packets in dataDir, writing it
+# first if it does not exist yet
+def syntheticCapture(dataDir, numPackets):
+    fname = os.path.join(dataDir, 'synthetic_%d.pcap' % numPackets)
+    if not os.path.exists(fname):
+        print("Writing ", fname)
+        writeSyntheticPcap(fname, numPackets)
+    return fname
+
+
+# Run the detector on one capture in this process and write the measurements to
+# resultPath.  args are extra anomaly_detect.py options.  Called in a child process.
+def runCase(fname, args, resultPath):
+    import anomaly_detect as ad
+    from instrument import LatencyMeter
+
+    ad.maxPackets = sys.maxsize
+    latency = LatencyMeter()
+    timing = {'last': None, 'firstAlert': None}
+
+    readPacket = ad.readPacket
+    reportAnomaly = ad.reportAnomaly
+
+    def timedReadPacket():
+        now = time.perf_counter()
+        if timing['last'] is not None:
+            latency.add(now - timing['last'])
+        timing['last'] = now
+        return readPacket()
+
+    def timedReportAnomaly(*args):
+        if timing['firstAlert'] is None:
+            timing['firstAlert'] = time.perf_counter() - start
+        reportAnomaly(*args)
+
+    ad.readPacket = timedReadPacket
+    ad.reportAnomaly = timedReportAnomaly
+
+    sys.argv = ['anomaly_detect.py', fname] + args
+    status = 'ok'
+    start = time.perf_counter()
+    try:
+        ad.main()
+    except Exception as err:
+        status = 'error: %s: %s' % (err.__class__.__name__, err)
+    seconds = time.perf_counter() - start
+
+    result = {
+        'status': status,
+        'packets': ad.numPackets,
+        'anomalies': ad.totalAnomalies,
+        'seconds': seconds,
+        'packetsPerSecond': ad.numPackets / seconds if seconds else 0.0,
+        'firstAlertSeconds': timing['firstAlert'],
+        'peakRssKB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'latency': None,
+    }
+    if latency.count:
+        result['latency'] = latency.summary()
+    with open(resultPath, 'w') as fp:
+        json.dump(result, fp)
+
+
+# Run one case in a child process and return its measurements
+def benchmark(fname, variant):
+    (fd, resultPath) = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        command = [sys.executable, os.path.abspath(__file__), '--run-case', fname, '--result', resultPath,
+                   '--variant=' + variant]
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(command, stdout=devnull, cwd=benchDir)
+        with open(resultPath) as fp:
+            text = fp.read()
+        result = json.loads(text) if text else {'status': 'error: the run did not finish'}
+    finally:
+        os.remove(resultPath)
+    result['capture'] = os.path.basename(fname)
+    result['variant'] = variant
+    return result
+
+
+# Return the commit the benchmark was run on, if it was run in a git checkout
+def gitCommit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchDir,
+                                         stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def printResult(result):
+    if result['status'] != 'ok':
+        print('%-34s %-12s %s' % (result['capture'], result['variant'], result['status']))
+        return
+    # Modes that do not call readPacket have no per-packet latencies
+    latency = result['latency']
+    micros = ['-' if latency is None else '%.1f' % (latency[key] * 1e6) for key in ('p50', 'p99', 'max')]
+    firstAlert = result['firstAlertSeconds']
+    print('%-34s %-12s %9d %10.0f %9s %9s %9s %9d %9s' % (
+        result['capture'], result['variant'], result['packets'], result['packetsPerSecond'],
+        micros[0], micros[1], micros[2], result['peakRssKB'] // 1024,
+        '-' if firstAlert is None else '%.3f' % firstAlert))
+
+
+# Compare results with those of a previous run and print the cases whose throughput
+# fell by more than tolerance.  Runs of fewer than regressionPackets packets are too
+# short to time reliably and are listed but never counted as regressions.  Returns
+# the number of regressions.
+def compare(results, previousPath, tolerance):
+    with open(previousPath) as fp:
+        previous = json.load(fp)
+    before = dict(((r['capture'], r['variant']), r) for r in previous['results'])
+    regressions = 0
+    print("Compared with ", previousPath, " (commit ", previous.get('commit'), ")")
+    for result in results:
+        old = before.get((result['capture'], result['variant']))
+        if old is None or old['status'] != 'ok' or result['status'] != 'ok':
+            continue
+        ratio = result['packetsPerSecond'] / old['packetsPerSecond']
+        flag = ''
+        if ratio < 1 - tolerance and result['packets'] >= regressionPackets:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-34s %-12s %6.2fx packets/s, peak RSS %d -> %d MB%s' % (
+            result['capture'], result['variant'], ratio, old['peakRssKB'] // 1024,
+            result['peakRssKB'] // 1024, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the anomaly detector end to end")
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="comma-separated packet counts of synthetic captures (default 10000,100000)")
+    parser.add_argument("--no-bundled", action="store_true", help="skip the captures in ../pcap")
+    parser.add_argument("--variant", action="append",
+                        help="anomaly_detect.py options to benchmark, e.g. --variant=--batch; "
+                             "may be repeated (default: no options)")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), 'anomaly-bench'),
+                        help="where synthetic captures are kept (default %(default)s)")
+    parser.add_argument("--output", default="benchmark.json", help="results file (default %(default)s)")
+    parser.add_argument("--compare", help="results file of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction by which throughput may fall before it is a regression (default 0.1)")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        runCase(args.run_case, shlex.split(args.variant[0] if args.variant else ''), args.result)
+        return
+
+    captures = []
+    if not args.no_bundled:
+        captures += sorted(glob.glob(os.path.join(pcapDir, '*.pcap')))
+    if args.sizes:
+        os.makedirs(args.data_dir, exist_ok=True)
+        captures += [syntheticCapture(args.data_dir, int(float(size))) for size in args.sizes.split(',')]
+
+    print('%-34s %-12s %9s %10s %9s %9s %9s %9s %9s' % ('capture', 'variant', 'packets', 'packets/s',
+                                                        'p50 us', 'p99 us', 'max us', 'RSS MB', '1st alert'))
+    results = []
+    for variant in args.variant or ['']:
+        for fname in captures:
+            result = benchmark(fname, variant)
+            printResult(result)
+            results.append(result)
+
+    report = {
+        'commit': gitCommit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=1)
+    print("Results written to ", args.output)
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+# This module reads a set of capture files, such as a directory of hourly captures
+# written by tcpdump -G, as one stream of packets, so the detector keeps its state
+# from one file to the next.  The set is given as a directory, whose capture files
+# are all read, or as a glob pattern.  The files are read in the order of the
+# timestamp of their first packet; files that are not PCAP or pcapng captures, or
+# that have no packets yet, are left out.  When the last file has been read the set
+# is looked at again, and files that have appeared since are read as well.
+#
+# A file may still be written to after its end has been reached: tcpdump -G, for
+# one, flushes the last packets of a file just before it opens the next.  So before
+# moving on from a file its size is checked again, after the set has been looked at,
+# and if it has grown the records added are read first.  A file that grows after the
+# reader has moved on from it, or after the last file of the set has been read and
+# the run has ended, is not read again in that run; a run resumed from a cursor in
+# that file reads what was added to it.
+#
+# The position of the reader is a cursor: the file being read, the byte offset of
+# the record after the last packet yielded, and the number of packets yielded from
+# the whole set.  anomaly_detect.py saves the cursor with each snapshot of its state,
+# so after a restart a CaptureSet opened with that cursor leaves out the files read
+# before it and seeks straight to the offset instead of reading them again.
+#
+# Timestamps are given in the resolution of the first file, whatever that of each
+# file is.  A pcapng file is resumed with the interfaces of its first section.
+
+import glob
+import os
+
+from pcapfile import InvalidHeader, UnknownMagicNumber
+from pcapfile.structs import pcap_packet
+from pcap_stream import PcapStream
+
+
+# Return True if fname names a set of captures: a directory or a glob pattern
+def isCaptureSet(fname):
+    if os.path.isdir(fname):
+        return True
+    return glob.has_magic(fname) and not os.path.exists(fname)
+
+
+# Return the paths of the regular files of a directory or matching a glob pattern
+def listFiles(spec):
+    if os.path.isdir(spec):
+        paths = [os.path.join(spec, name) for name in os.listdir(spec)]
+    else:
+        paths = glob.glob(spec)
+    return [path for path in paths if os.path.isfile(path)]
+
+
+# Return the timestamp in nanoseconds of the first packet of a capture, or None if
+# it is not a capture or has no packets
+def firstTimestamp(path):
+    try:
+        stream = PcapStream.open(path, layers=0)
+    except (OSError, InvalidHeader, UnknownMagicNumber, EOFError):
+        return None
+    try:
+        record = next(stream.records(), None)
+    except (OSError, InvalidHeader):
+        record = None
+    finally:
+        stream.close()
+    if record is None:
+        return None
+    (seconds, fraction) = record[:2]
+    return seconds * 1000000000 + (fraction if stream.header.ns_resolution else fraction * 1000)
+
+
+class CaptureSet(object):
+    """
+    Iterates over the packets of a set of captures in the order of the timestamps of
+    their first packets.  spec is a directory or a glob pattern.  If cursor is given,
+    reading starts where the set was when cursor() returned it.  header, rawHeader
+    and decoder are those of the first file read.  accept and filtered are as in
+    PcapStream.
+    """
+
+    accept = None
+    filtered = 0
+
+    def __init__(self, spec, layers=3, zeroCopy=True, cursor=None):
+        self.spec = spec
+        self.layers = layers
+        self.zeroCopy = zeroCopy
+        # The paths read or being read, and the (first timestamp, path) of the file
+        # before which every file was read in an earlier run
+        self.done = set()
+        self.resumeKey = None
+        self.resumeOffset = None
+        self.packetIndex = 0
+        if cursor is not None:
+            self.resumeKey = (cursor['time'], cursor['file'])
+            self.resumeOffset = cursor['offset']
+            self.packetIndex = cursor['packet']
+        self.files = self.newFiles()
+        if not self.files:
+            raise InvalidHeader("No captures with packets in " + spec)
+
+        (self.key, self.stream) = self.openFile(self.files.pop(0))
+        first = self.stream
+        self.header = first.header
+        self.headerPointer = first.headerPointer
+        self.rawHeader = first.rawHeader
+        self.recordHeader = first.recordHeader
+        self.decoder = self.firstDecoder = first.decoder
+        self.position = self.recordStart = first.fp.tell()
+        self.fname = self.key[1]
+
+    @classmethod
+    def open(cls, spec, layers=3, zeroCopy=True, cursor=None):
+        return cls(spec, layers, zeroCopy, cursor)
+
+    # Return the (first timestamp, path) of the files of the set that have not been
+    # read, in order
+    def newFiles(self):
+        files = []
+        for path in listFiles(self.spec):
+            if path in self.done:
+                continue
+            timestamp = firstTimestamp(path)
+            if timestamp is None:
+                continue
+            key = (timestamp, path)
+            if self.resumeKey is not None and key < self.resumeKey:
+                continue
+            files.append(key)
+        return sorted(files)
+
+    # Open the file of key, seeking to the resume offset if it is the file of the
+    # cursor.  Returns the key and the stream.
+    def openFile(self, key):
+        path = key[1]
+        self.done.add(path)
+        print("PCAP file is ", path)
+        stream = PcapStream.open(path, self.layers, self.zeroCopy)
+        if key == self.resumeKey:
+            stream.fp.seek(self.resumeOffset)
+            print("Resuming at byte ", self.resumeOffset, " of ", path, " after ", self.packetIndex, " packets")
+        return key, stream
+
+    # Return the cursor after the packet last yielded: a dictionary of the file, the
+    # timestamp of its first packet, the offset of the next record and the number of
+    # packets yielded.  If only processed packets were taken care of, because the
+    # last one was interrupted before it was counted, the cursor is that of the
+    # packet before, so the last one is read again.
+    def cursor(self, processed=None):
+        if processed is not None and processed < self.packetIndex:
+            return {'file': self.key[1], 'time': self.key[0], 'offset': self.recordStart, 'packet': processed}
+        return {'file': self.key[1], 'time': self.key[0], 'offset': self.position, 'packet': self.packetIndex}
+
+    # Yield each packet of each file decoded into a pcap_packet
+    def __iter__(self):
+        layers = self.layers - 1
+        zeroCopy = self.zeroCopy
+        setNs = self.header.ns_resolution
+        setLinkType = self.header.ll_type
+        accept = self.accept
+        while self.stream is not None:
+            stream = self.stream
+            tell = stream.fp.tell
+            fileNs = stream.header.ns_resolution
+            for (seconds, fraction, captureLen, packetLen, data) in stream.records():
+                # A pcapng stream has a link type and decoder per interface
+                interface = getattr(stream, 'interface', None)
+                # The filter reads frames at the offsets of the set's link type, so
+                # packets of any other link type are filtered out
+                if accept is not None and not ((interface.linkType if interface else stream.header.ll_type)
+                                               == setLinkType and accept(data)):
+                    self.filtered += 1
+                    self.position = tell()
+                    continue
+                # The first file's decoder is the set's, which anomaly_detect.py may
+                # have wrapped
+                decoder = (interface or stream).decoder
+                if decoder is self.firstDecoder:
+                    decoder = self.decoder
+                if layers >= 0 and decoder:
+                    if zeroCopy and not isinstance(data, memoryview):
+                        data = memoryview(data)
+                    packet = decoder(data, layers=layers)
+                else:
+                    packet = bytes(data)
+                if fileNs != setNs:
+                    fraction = fraction // 1000 if fileNs else fraction * 1000
+                (self.recordStart, self.position) = (self.position, tell())
+                self.packetIndex += 1
+                yield pcap_packet(self.headerPointer, seconds, fraction, captureLen, packetLen, packet)
+            self.nextFile(os.path.getsize(self.key[1]))
+
+    # Close the file read and open the next one, looking for new files when the
+    # last one known has been read.  If the file read has grown beyond size, its
+    # size when its end was reached, it is read on from its last whole record
+    # instead.
+    def nextFile(self, size):
+        if not self.files:
+            self.files = self.newFiles()
+        if os.path.getsize(self.key[1]) > size:
+            self.stream.fp.seek(self.position)
+            return
+        self.stream.close()
+        self.stream = None
+        if self.files:
+            (self.key, self.stream) = self.openFile(self.files.pop(0))
+            self.position = self.recordStart = self.stream.fp.tell()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+    def __repr__(self):
+        return 'capture set %s, %d files to read after the first\n%r' % (self.spec, len(self.files), self.stream)
@@ -0,0 +1,95 @@
+# This module holds the state of the decayed scoring mode of anomaly_detect.py.  In
+# that mode recency and frequency are measured in capture time instead of in packets:
+# a value's time score grows with the seconds since it was last seen, and its
+# frequency score is the share of the recent occurrences of its field that it had,
+# where every occurrence counts for less the older it is.  A burst of packets then
+# no longer makes every other value look stale, and traffic that stopped long ago
+# stops counting.
+#
+# Each count is decayed exponentially with a half-life of halfLife seconds, so it
+# needs no history: a count c last updated at time t is worth c * exp(-rate * (now - t))
+# at time now.  The counts are only decayed when they are read or added to, so
+# updating and scoring a value costs the same however long the detector has run.
+#
+# DecayTable is a ValueTable whose last array holds the capture time each value was
+# last seen and whose count array holds its count as it was then, both as doubles.
+# The decayed count of each field is kept the same way in two arrays indexed by field
+# id.
+
+import array
+import math
+
+from state_store import ValueTable, maxLoad
+
+
+class DecayTable(ValueTable):
+    """
+    ValueTable of decayed counts.  last holds the capture time, in seconds, each value
+    was last seen, and count its count decayed to that time.  halfLife is in seconds.
+    decayedState and fieldCount return the counts decayed to a given time.
+    """
+
+    def __init__(self, halfLife, capacity=1 << 16):
+        self.halfLife = halfLife
+        self.rate = math.log(2) / halfLife
+        self.fieldCounts = array.array('d', [0.0])
+        self.fieldTimes = array.array('d', [0.0])
+        super(DecayTable, self).__init__(capacity)
+
+    def allocate(self, bits):
+        slots = 1 << bits
+        self.shift = 64 - bits
+        self.mask = slots - 1
+        self.limit = int(slots * maxLoad)
+        self.keys = array.array('Q', bytes(8 * slots))
+        self.last = array.array('d', bytes(8 * slots))
+        self.count = array.array('d', bytes(8 * slots))
+
+    # Return a count decayed over elapsed seconds.  Packets out of time order do not
+    # make it grow.
+    def decay(self, count, elapsed):
+        if elapsed > 0:
+            return count * math.exp(-self.rate * elapsed)
+        return count
+
+    # Return the fraction of the way a value last seen elapsed seconds ago is to
+    # being forgotten: 0 if it was just seen, 1/2 after a half-life, and close to 1
+    # long after that
+    def staleness(self, elapsed):
+        if elapsed > 0:
+            return 1.0 - math.exp(-self.rate * elapsed)
+        return 0.0
+
+    # Return the time a value of the field with id fid was last seen and its count
+    # decayed to time now, or (0.0, 0.0) if it has not been seen
+    def decayedState(self, fid, value, now):
+        (last, count) = self.state(fid, value)
+        return last, self.decay(count, now - last)
+
+    # Return the count of the field with id fid decayed to time now
+    def fieldCount(self, fid, now):
+        if fid >= len(self.fieldCounts):
+            return 0.0
+        return self.decay(self.fieldCounts[fid], now - self.fieldTimes[fid])
+
+    # Record that a value of the field with id fid was seen at time now, adding the
+    # value to the table if it is new, and count the field.  Returns the value's slot.
+    def add(self, fid, value, now):
+        (counts, times) = (self.fieldCounts, self.fieldTimes)
+        while fid >= len(counts):
+            counts.append(0.0)
+            times.append(now)
+        counts[fid] = self.decay(counts[fid], now - times[fid]) + 1.0
+        times[fid] = max(now, times[fid])
+
+        i = self.find(fid, value)
+        if i < 0:
+            return self.insert(self.key(fid, value), now, 1.0)
+        last = self.last[i]
+        self.count[i] = self.decay(self.count[i], now - last) + 1.0
+        self.last[i] = max(now, last)
+        return i
+
+    # Return the number of bytes used by the slot arrays and the field counts
+    def memoryUsage(self):
+        return super(DecayTable, self).memoryUsage() + 8 * (len(self.fieldCounts) + len(self.fieldTimes))
@@ -0,0 +1,189 @@
+# This module summarizes the values of each field as the detector adds them to its
+# tables: which values dominate the field and how many distinct values it has.
+# Both summaries take a fixed amount of memory per field however many packets are
+# seen, and are updated in constant time, so they can stay on in a long-running
+# sensor and be read while it runs.
+#
+# The heavy hitters are kept by the Space-Saving algorithm (Metwally, Agrawal and El
+# Abbadi, "Efficient Computation of Frequent and Top-k Elements in Data Streams"):
+# k counters, and a value that has no counter takes over the one with the lowest
+# count and inherits that count as its possible overcount.  Every value seen more
+# than count / k times holds a counter.  The counters are kept in buckets of equal
+# count, so finding the lowest one costs O(1).
+#
+# The distinct counts are HyperLogLog estimates (Flajolet et al.) with 2**12 one byte
+# registers per field, about 1.6% standard error.
+#
+# A field with about as many distinct values as occurrences (a sequence number, a
+# checksum) adds a valueData entry for nearly every packet and never scores as
+# normal; report() flags those fields.
+
+import math
+
+# Fields with more than this fraction of distinct values among at least
+# minHighCardinality occurrences are flagged
+highCardinalityRatio = 0.5
+minHighCardinality = 1000
+
+registerBits = 12
+mask64 = (1 << 64) - 1
+
+
+# Return a well mixed 64 bit hash of a value (the splitmix64 finalizer of hash())
+def hash64(value):
+    h = hash(value) & mask64
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & mask64
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & mask64
+    return h ^ (h >> 31)
+
+
+class SpaceSaving(object):
+    """
+    The k most frequent values of a stream and their counts.  A count may exceed the
+    true count by at most the error kept with it.
+    """
+
+    __slots__ = ('k', 'counts', 'errors', 'buckets', 'minCount')
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        # Values by count, and the lowest count held
+        self.buckets = {}
+        self.minCount = 0
+
+    def add(self, value):
+        counts = self.counts
+        count = counts.get(value)
+        if count is None:
+            if len(counts) < self.k:
+                (count, error) = (0, 0)
+            else:
+                # Take over a counter with the lowest count
+                count = self.minCount
+                bucket = self.buckets[count]
+                victim = bucket.pop()
+                del counts[victim]
+                del self.errors[victim]
+                if not bucket:
+                    del self.buckets[count]
+                error = count
+            self.errors[value] = error
+        else:
+            bucket = self.buckets[count]
+            bucket.discard(value)
+            if not bucket:
+                del self.buckets[count]
+        count += 1
+        counts[value] = count
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = set()
+        bucket.add(value)
+        # The lowest count only changes if it is a new value's or its bucket emptied,
+        # and then it is the count just set
+        if count == 1 or self.minCount not in self.buckets:
+            self.minCount = count
+
+    # Return up to n (value, count, error) tuples, highest count first
+    def top(self, n=None):
+        ranked = sorted(self.counts.items(), key=lambda item: -item[1])
+        return [(value, count, self.errors[value]) for (value, count) in ranked[:n]]
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values of a stream with 2**registerBits
+    registers.
+    """
+
+    __slots__ = ('registers',)
+
+    def __init__(self):
+        self.registers = bytearray(1 << registerBits)
+
+    def add(self, value):
+        h = hash64(value)
+        index = h >> (64 - registerBits)
+        rank = 64 - registerBits - (h & ((1 << (64 - registerBits)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def __len__(self):
+        return int(self.estimate() + 0.5)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * m:
+            # Linear counting is more accurate for small counts
+            zeros = self.registers.count(0)
+            if zeros:
+                return m * math.log(m / zeros)
+        return estimate
+
+
+class FieldSummaries(object):
+    """
+    A SpaceSaving summary of the k most frequent values and a HyperLogLog distinct
+    count for each field id.  add is called with every field processField adds to
+    the tables.
+    """
+
+    def __init__(self, k=10):
+        self.k = k
+        self.heavy = {}
+        self.distinct = {}
+
+    def add(self, fid, value):
+        heavy = self.heavy.get(fid)
+        if heavy is None:
+            heavy = self.heavy[fid] = SpaceSaving(self.k)
+            self.distinct[fid] = HyperLogLog()
+        heavy.add(value)
+        self.distinct[fid].add(value)
+
+    # Return the summary of each field of fieldData that has been seen, by name: its
+    # count, its estimated number of distinct values, whether that is so high the
+    # field is flagged, and its top values as [value, count, error] lists.  Values
+    # are given as JSON-friendly ints or strings.
+    def report(self, fieldData):
+        fields = {}
+        for (fid, heavy) in sorted(self.heavy.items()):
+            count = fieldData.count[fid]
+            distinct = len(self.distinct[fid])
+            fields[fieldData.names[fid]] = {
+                'count': count,
+                'distinct': distinct,
+                'highCardinality': count >= minHighCardinality and distinct > highCardinalityRatio * count,
+                'top': [[reportValue(value), n, error] for (value, n, error) in heavy.top()],
+            }
+        return fields
+
+    # Return the names of the flagged fields in a report
+    @staticmethod
+    def highCardinality(report):
+        return [name for (name, summary) in sorted(report.items()) if summary['highCardinality']]
+
+    # Return a report as text, one field per line
+    def format(self, fieldData):
+        report = self.report(fieldData)
+        lines = []
+        for (name, summary) in report.items():
+            top = ', '.join('%s: %d' % (value, count) + (' (+/- %d)' % error if error else '')
+                            for (value, count, error) in summary['top'])
+            lines.append('%s: %d seen, about %d distinct%s; top %s' % (
+                name, summary['count'], summary['distinct'],
+                ' (high cardinality)' if summary['highCardinality'] else '', top))
+        return '\n'.join(lines)
+
+
+# Return a value as a JSON number or string
+def reportValue(value):
+    if value.__class__ is int or value.__class__ is float:
+        return value
+    if value.__class__ is bytes:
+        return value.decode('ascii', 'replace')
+    return str(value)
@@ -0,0 +1,164 @@
+# This module lists the packet fields the detector knows about and compiles a chosen
+# subset of them into the code that extracts them.  A deployment names the fields it
+# wants (and the ones it does not), for example to leave out tcp_seqnum and
+# tcp_acknum, which are different in nearly every packet.  Fields that are left out
+# are never unpacked, stored or scored.
+#
+# Each field is described once, with both the attribute that holds it in the
+# pypcapfile layer objects (used by parseFields in anomaly_detect.py) and where it
+# sits in the raw header (used by the batch decoder in batch_parse.py): its byte
+# offset from the start of the header, its size in bytes, and the shift, mask and
+# scale that turn those bytes into the value.
+#
+# The layer objects and the batch decoder hold IP addresses as integers.  The
+# detector stores and reports them as text in bytes, which the extractors make with
+# formatAddress and formatAddress6.
+#
+# The batch decoder only decodes IPv4 and the transport headers carried by IPv4, so
+# the IPv6 and ARP fields, and the transport fields of IPv6 packets, are only found by
+# the per-packet decoders.
+
+import collections
+import fnmatch
+import socket
+
+FieldSpec = collections.namedtuple('FieldSpec', 'name protocol attr offset size shift mask scale')
+
+fieldSpecs = [
+    FieldSpec('ip_ver', 'IPv4', 'v', 0, 1, 4, 0x0f, 1),
+    FieldSpec('ip_hlen', 'IPv4', 'hl', 0, 1, 0, 0x0f, 1),
+    FieldSpec('ip_tos', 'IPv4', 'tos', 1, 1, 0, None, 1),
+    FieldSpec('ip_len', 'IPv4', 'len', 2, 2, 0, None, 1),
+    FieldSpec('ip_id', 'IPv4', 'id', 4, 2, 0, None, 1),
+    FieldSpec('ip_flags', 'IPv4', 'flags', 6, 2, 13, None, 1),
+    FieldSpec('ip_off', 'IPv4', 'off', 6, 2, 0, 0x1fff, 1),
+    FieldSpec('ip_ttl', 'IPv4', 'ttl', 8, 1, 0, None, 1),
+    FieldSpec('ip_proto', 'IPv4', 'p', 9, 1, 0, None, 1),
+    FieldSpec('ip_src', 'IPv4', 'src', 12, 4, 0, None, 1),
+    FieldSpec('ip_dst', 'IPv4', 'dst', 16, 4, 0, None, 1),
+    FieldSpec('ip6_tclass', 'IPv6', 'tc', 0, 2, 4, 0xff, 1),
+    FieldSpec('ip6_flow', 'IPv6', 'flow', 1, 3, 0, 0xfffff, 1),
+    FieldSpec('ip6_plen', 'IPv6', 'len', 4, 2, 0, None, 1),
+    FieldSpec('ip6_next', 'IPv6', 'nxt', 6, 1, 0, None, 1),
+    FieldSpec('ip6_hlim', 'IPv6', 'hlim', 7, 1, 0, None, 1),
+    FieldSpec('ip6_src', 'IPv6', 'src', 8, 16, 0, None, 1),
+    FieldSpec('ip6_dst', 'IPv6', 'dst', 24, 16, 0, None, 1),
+    FieldSpec('arp_op', 'ARP', 'op', 6, 2, 0, None, 1),
+    FieldSpec('arp_sha', 'ARP', 'sha', 8, 6, 0, None, 1),
+    FieldSpec('arp_spa', 'ARP', 'spa', 14, 4, 0, None, 1),
+    FieldSpec('arp_tha', 'ARP', 'tha', 18, 6, 0, None, 1),
+    FieldSpec('arp_tpa', 'ARP', 'tpa', 24, 4, 0, None, 1),
+    FieldSpec('tcp_srcport', 'TCP', 'src_port', 0, 2, 0, None, 1),
+    FieldSpec('tcp_dstport', 'TCP', 'dst_port', 2, 2, 0, None, 1),
+    FieldSpec('tcp_seqnum', 'TCP', 'seqnum', 4, 4, 0, None, 1),
+    FieldSpec('tcp_acknum', 'TCP', 'acknum', 8, 4, 0, None, 1),
+    FieldSpec('tcp_doff', 'TCP', 'data_offset', 12, 1, 4, None, 4),
+    FieldSpec('tcp_res', 'TCP', 'reserved', 12, 1, 0, 0x0f, 1),
+    FieldSpec('tcp_flags', 'TCP', 'flags', 13, 1, 0, None, 1),
+    FieldSpec('udp_srcport', 'UDP', 'src_port', 0, 2, 0, None, 1),
+    FieldSpec('udp_dstport', 'UDP', 'dst_port', 2, 2, 0, None, 1),
+    FieldSpec('udp_len', 'UDP', 'len', 4, 2, 0, None, 1),
+    FieldSpec('udpl_srcport', 'UDPLITE', 'src_port', 0, 2, 0, None, 1),
+    FieldSpec('udpl_dstport', 'UDPLITE', 'dst_port', 2, 2, 0, None, 1),
+    FieldSpec('udpl_cover', 'UDPLITE', 'coverage', 4, 2, 0, None, 1),
+]
+
+fieldsByName = dict((spec.name, spec) for spec in fieldSpecs)
+allFields = [spec.name for spec in fieldSpecs]
+
+# Protocols that have fields, in the order of fieldSpecs
+protocols = list(collections.OrderedDict((spec.protocol, None) for spec in fieldSpecs))
+
+# IP protocol numbers of the transport protocols that have fields
+transportProtocols = {'TCP': 0x06, 'UDP': 0x11, 'UDPLITE': 0x88}
+
+# Protocols the batch decoder in batch_parse.py decodes
+batchProtocols = ('IPv4',) + tuple(transportProtocols)
+
+# Fields that hold IPv4 addresses, and fields that hold IPv6 addresses
+addressFields = ('ip_src', 'ip_dst', 'arp_spa', 'arp_tpa')
+address6Fields = ('ip6_src', 'ip6_dst')
+
+# Text of the addresses formatted lately, by address.  The caches are emptied when
+# they reach maxCachedAddresses, so a scan of many addresses cannot make them grow
+# without bound.
+addressCache = {}
+address6Cache = {}
+maxCachedAddresses = 1 << 16
+
+
+# Return an IPv4 address held as an integer as dotted-quad bytes, the way pypcapfile's
+# parse_ipv4 formats it.  Addresses that are already bytes are returned as they are.
+def formatAddress(address):
+    text = addressCache.get(address)
+    if text is None:
+        if not isinstance(address, int):
+            return address
+        if len(addressCache) >= maxCachedAddresses:
+            addressCache.clear()
+        text = addressCache[address] = ('%d.%d.%d.%d' % (address >> 24, (address >> 16) & 0xff,
+                                                         (address >> 8) & 0xff, address & 0xff)).encode('ascii')
+    return text
+
+
+# Return an IPv6 address held as an integer as bytes in the usual colon notation, the
+# way pypcapfile's parse_ipv6 formats it
+def formatAddress6(address):
+    text = address6Cache.get(address)
+    if text is None:
+        if not isinstance(address, int):
+            return address
+        if len(address6Cache) >= maxCachedAddresses:
+            address6Cache.clear()
+        text = address6Cache[address] = socket.inet_ntop(socket.AF_INET6,
+                                                         address.to_bytes(16, 'big')).encode('ascii')
+    return text
+
+
+# Return the names of the given fields that the batch decoder decodes
+def batchFields(names):
+    return [name for name in names if fieldsByName[name].protocol in batchProtocols]
+
+
+# Return the names of the fields matching any of the include patterns and none of
+# the exclude patterns, in the order of fieldSpecs.  Patterns are field names or
+# shell-style wildcards such as tcp_*.  include=None selects every field.
+def selectFields(include=None, exclude=None):
+    for pattern in (include or []) + (exclude or []):
+        if not fnmatch.filter(allFields, pattern):
+            raise ValueError("Unknown field: " + pattern)
+
+    names = []
+    for name in allFields:
+        if include is not None and not any(fnmatch.fnmatchcase(name, p) for p in include):
+            continue
+        if exclude and any(fnmatch.fnmatchcase(name, p) for p in exclude):
+            continue
+        names.append(name)
+    return names
+
+
+# Compile an extractor for each protocol with enabled fields.  Returns a dictionary
+# from protocol name to a function that takes a pypcapfile layer object and returns
+# its enabled fields as [name, value] lists, e.g.
+#     def extract(layer):
+#         return [["ip_ttl", layer.ttl], ["ip_src", formatAddress(layer.src)]]
+def compileExtractors(names):
+    extractors = {}
+    for protocol in protocols:
+        specs = [fieldsByName[name] for name in names if fieldsByName[name].protocol == protocol]
+        if not specs:
+            continue
+        items = []
+        for spec in specs:
+            if spec.name in addressFields:
+                items.append('[%r, formatAddress(layer.%s)]' % (spec.name, spec.attr))
+            elif spec.name in address6Fields:
+                items.append('[%r, formatAddress6(layer.%s)]' % (spec.name, spec.attr))
+            else:
+                items.append('[%r, layer.%s]' % (spec.name, spec.attr))
+        source = 'def extract(layer):\n    return [%s]\n' % ', '.join(items)
+        namespace = {'formatAddress': formatAddress, 'formatAddress6': formatAddress6}
+        exec(compile(source, '<%s fields>' % protocol, 'exec'), namespace)
+        extractors[protocol] = namespace['extract']
+    return extractors
@@ -0,0 +1,177 @@
+# This module keeps per-flow state for the flow-aware mode of anomaly_detect.py.  In
+# that mode every packet is scored against the history of its own flow (or host) as
+# well as the global fieldData and valueData, and a value counts as normal if it is
+# normal in either, so a port that is rare on the network but that one host uses all
+# the time is not reported for that host.
+#
+# A flow is the connection of a packet (its protocol and its two address and port
+# pairs, in an order that does not depend on the direction of the packet) or, per
+# host, its source address.  Each flow keeps a count per field id, like
+# fieldData.count, and a small ValueTable of its values.  Values that are not small
+# integers are hashed instead of interned, and a flow stops adding values once it
+# holds maxFlowValues of them, so no flow grows without bound.
+#
+# The flows live in an OrderedDict in order of last use, so a lookup, a move to the
+# end, and the eviction of the flow that has been idle longest are all O(1).  Flows
+# idle for longer than idleTimeout seconds of capture time are dropped, and when
+# maxFlows flows are held the least recently used one makes way for a new one.  New
+# flows are admitted at no more than newFlowRate per second (a token bucket in capture
+# time), so a scan of many addresses cannot churn the table; packets of flows that
+# were refused are scored against the global state only.
+
+import array
+import collections
+
+from pcapfile.protocols.linklayer.vlan import VLAN
+from pcapfile.protocols.network.ip import IP
+from pcapfile.protocols.network.ipv6 import IPv6
+from state_store import ValueTable, valueLimit
+
+# Values a flow holds at most, and the slots its table starts with
+maxFlowValues = 256
+flowValueSlots = 16
+
+
+# Return a value as an integer a ValueTable stores without interning it
+def flowValue(value):
+    if value.__class__ is int and 0 <= value < valueLimit:
+        return value
+    return hash(value) & (valueLimit - 1)
+
+
+# Return the key of the flow of a decoded packet: its protocol and its two address and
+# port pairs in order, or if perHost is set its source address.  Returns None if the
+# packet is not IP.  The key is made of integers, so its hash() is the same in every
+# run.
+def flowKey(frame, perHost=False):
+    layer = getattr(frame, 'payload', None)
+    while layer.__class__ is VLAN:
+        layer = layer.payload
+    if layer.__class__ is not IP and layer.__class__ is not IPv6:
+        return None
+    if perHost:
+        return layer.src
+    transport = layer.payload
+    src = (layer.src, getattr(transport, 'src_port', 0))
+    dst = (layer.dst, getattr(transport, 'dst_port', 0))
+    return (layer.p, src, dst) if src <= dst else (layer.p, dst, src)
+
+
+class Flow(object):
+    """
+    The state of one flow: the number of times each field has been seen, indexed by
+    field id, a ValueTable of its values, and the capture time it was last seen.
+    """
+
+    __slots__ = ('count', 'values', 'lastSeen')
+
+    def __init__(self, numFields, now):
+        self.count = array.array('Q', bytes(8 * numFields))
+        self.values = ValueTable(flowValueSlots)
+        self.lastSeen = now
+
+    # Return the packet a value of the field with id fid was last seen in by this
+    # flow and the number of times the flow has seen it
+    def state(self, fid, value):
+        return self.values.state(fid, flowValue(value))
+
+    # Record that the flow saw a value of the field with id fid in packet
+    def add(self, fid, value, packet):
+        self.count[fid] += 1
+        values = self.values
+        value = flowValue(value)
+        if values.size < maxFlowValues:
+            values.add(fid, value, packet)
+        else:
+            slot = values.find(fid, value)
+            if slot >= 0:
+                values.last[slot] = packet
+                values.count[slot] += 1
+
+
+class FlowTable(object):
+    """
+    The flows of the flow-aware mode.  numFields is one more than the highest field
+    id.  If perHost is set, flows are keyed by source address instead of by
+    connection.  idleTimeout and newFlowRate are in seconds of capture time.
+    """
+
+    def __init__(self, numFields, maxFlows=4096, idleTimeout=300.0, newFlowRate=1000.0, perHost=False):
+        self.numFields = numFields
+        self.maxFlows = maxFlows
+        self.idleTimeout = idleTimeout
+        self.newFlowRate = newFlowRate
+        self.perHost = perHost
+        self.flows = collections.OrderedDict()
+        self.tokens = max(newFlowRate, 1.0)
+        self.lastRefill = None
+
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.refused = 0
+
+    # Return the key of the flow of a decoded packet, or None if it is not IP
+    def key(self, frame):
+        return flowKey(frame, self.perHost)
+
+    # Return the Flow of a decoded packet captured at time now, creating it if it is
+    # new, or None if the packet has no flow or its flow was refused
+    def lookup(self, frame, now):
+        key = self.key(frame)
+        if key is None:
+            return None
+        flows = self.flows
+        self.expire(now)
+        flow = flows.get(key)
+        if flow is not None:
+            flows.move_to_end(key)
+            flow.lastSeen = now
+            return flow
+
+        if not self.admit(now):
+            self.refused += 1
+            return None
+        if len(flows) >= self.maxFlows:
+            flows.popitem(last=False)
+            self.evicted += 1
+        flow = flows[key] = Flow(self.numFields, now)
+        self.created += 1
+        return flow
+
+    # Drop the flows that have been idle for longer than idleTimeout.  The flows are
+    # in order of last use, so only the oldest ones are looked at.
+    def expire(self, now):
+        flows = self.flows
+        while flows:
+            oldest = next(iter(flows.values()))
+            if now - oldest.lastSeen <= self.idleTimeout:
+                break
+            flows.popitem(last=False)
+            self.expired += 1
+
+    # Take a token for a new flow at time now.  Returns False if there is none left.
+    def admit(self, now):
+        if self.lastRefill is not None and now > self.lastRefill:
+            self.tokens = min(self.tokens + (now - self.lastRefill) * self.newFlowRate, max(self.newFlowRate, 1.0))
+        self.lastRefill = now if self.lastRefill is None else max(now, self.lastRefill)
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+    def __len__(self):
+        return len(self.flows)
+
+    def stats(self):
+        return {
+            'flows': len(self.flows),
+            'created': self.created,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'refused': self.refused,
+        }
+
+    def __repr__(self):
+        return '%d flows held, %d created, %d expired, %d evicted, %d new flows refused' % (
+            len(self.flows), self.created, self.expired, self.evicted, self.refused)
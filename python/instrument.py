@@ -0,0 +1,288 @@
+# This module measures where the time of the detector goes.  When instrumentation is
+# turned on, install() replaces the stage functions of anomaly_detect.py (readPacket,
+# parsePacket, scoreField, processField and reportAnomaly) and the link layer decoder
+# of the open capture with wrappers that add up the time spent in each call.  The
+# functions are looked up by name each time they are called, so the wrappers are used
+# without changing the code that calls them, and when instrumentation is off nothing
+# is wrapped and nothing is measured.
+#
+# Besides the stage timers, Metrics keeps the packet, field and anomaly counts, the
+# size of the fieldData and valueData tables, and a histogram of the time each packet
+# takes from one readPacket call to the next.  If the detector keeps field summaries,
+# they are included too, with the fields whose distinct values are flagged as too
+# many; see field_summary.py.  Metrics are written every interval
+# seconds and at the end of the run, as JSON or in the Prometheus text format, to a
+# file (replaced atomically, so a reader never sees half a dump) or to a socket given
+# as unix:PATH or tcp:HOST:PORT.
+
+import json
+import os
+import socket
+import time
+
+from field_summary import FieldSummaries
+
+
+class LatencyMeter(object):
+    """
+    Summarizes latencies in seconds with a histogram in the manner of an HDR
+    histogram: every power of two of nanoseconds is split into 2**subBits buckets, so
+    percentiles are known to within one part in 2**subBits, and the histogram takes
+    the same memory however long a sensor runs.
+    """
+
+    subBits = 3
+
+    def __init__(self):
+        self.buckets = [0] * (66 << self.subBits)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, latency):
+        ns = int(latency * 1000000000)
+        shift = max(ns.bit_length() - self.subBits - 1, 0)
+        self.buckets[(shift << self.subBits) + (ns >> shift)] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.maximum:
+            self.maximum = latency
+
+    # Return the upper bound in nanoseconds of the values in a bucket
+    def bucketLimit(self, index):
+        shift = max((index >> self.subBits) - 1, 0)
+        return ((index - (shift << self.subBits)) + 1) << shift
+
+    # Return the upper bound in seconds of the bucket holding the given fraction of
+    # the latencies
+    def percentile(self, fraction):
+        seen = 0
+        for (index, count) in enumerate(self.buckets):
+            seen += count
+            if count and seen >= fraction * self.count:
+                return min(self.bucketLimit(index), self.maximum * 1e9 + 1) / 1e9
+        return self.maximum
+
+    # Yield the upper bound in seconds and the cumulative count of every bucket that
+    # holds latencies
+    def cumulative(self):
+        seen = 0
+        for (index, count) in enumerate(self.buckets):
+            if count:
+                seen += count
+                yield self.bucketLimit(index) / 1e9, seen
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'p999': self.percentile(0.999),
+            'max': self.maximum,
+        }
+
+    def __repr__(self):
+        if not self.count:
+            return 'no packets'
+        return 'count %d mean %.6fs p50 %.6fs p99 %.6fs max %.6fs' % (
+            self.count, self.total / self.count, self.percentile(0.5), self.percentile(0.99), self.maximum)
+
+
+# The anomaly_detect.py functions that are timed, in the order of the stages of a packet
+stageFunctions = ['readPacket', 'parsePacket', 'scoreField', 'processField', 'reportAnomaly']
+
+
+class Metrics(object):
+    """
+    Stage timers, counters and histograms of a detector run.  target is where dumps
+    go (a file name, unix:PATH or tcp:HOST:PORT), form is 'json' or 'prometheus' and
+    interval the number of seconds between dumps.
+    """
+
+    def __init__(self, target, form='json', interval=10.0):
+        self.target = target
+        self.form = form
+        self.interval = interval
+        self.started = time.time()
+        self.nextDump = time.monotonic() + interval
+        self.detector = None
+        # Nanoseconds and calls of each stage
+        self.timers = {}
+        self.packetLatency = LatencyMeter()
+        self.lastPacket = None
+        self.sock = None
+
+    # Wrap the stage functions of a detector module, and the decoder of its open
+    # capture if it has one
+    def install(self, detector, pcap=None):
+        self.detector = detector
+        for name in stageFunctions:
+            wrap = self.timePackets if name == 'readPacket' else self.timeCalls
+            setattr(detector, name, wrap(name, getattr(detector, name)))
+        if pcap is not None and getattr(pcap, 'decoder', None) is not None:
+            pcap.decoder = self.timeCalls('decode', pcap.decoder)
+
+    # Return a wrapper of function that adds its time to the timer of stage
+    def timeCalls(self, stage, function):
+        timer = self.timers.setdefault(stage, [0, 0])
+        clock = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            start = clock()
+            result = function(*args, **kwargs)
+            timer[0] += clock() - start
+            timer[1] += 1
+            return result
+        return timed
+
+    # Return a wrapper of readPacket that also times whole packets and dumps the
+    # metrics when they are due
+    def timePackets(self, stage, function):
+        timer = self.timers.setdefault(stage, [0, 0])
+        clock = time.perf_counter_ns
+
+        def timed():
+            start = clock()
+            if self.lastPacket is not None:
+                self.packetLatency.add((start - self.lastPacket) / 1e9)
+            self.lastPacket = start
+            result = function()
+            timer[0] += clock() - start
+            timer[1] += 1
+            if time.monotonic() >= self.nextDump:
+                self.dump()
+            return result
+        return timed
+
+    # Return the seconds spent in each stage.  Decoding happens inside readPacket, so
+    # it is taken out of the read stage.
+    def stageSeconds(self):
+        seconds = dict((stage, timer[0] / 1e9) for (stage, timer) in self.timers.items())
+        if 'decode' in seconds and 'readPacket' in seconds:
+            seconds['readPacket'] -= seconds['decode']
+        return seconds
+
+    # Return the metrics as a dictionary
+    def snapshot(self):
+        detector = self.detector
+        calls = dict((stage, timer[1]) for (stage, timer) in self.timers.items())
+        summaries = None
+        if detector.fieldSummaries is not None:
+            summaries = detector.fieldSummaries.report(detector.fieldData)
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'packets': detector.numPackets,
+            'fields': calls.get('processField', 0),
+            'anomalies': detector.totalAnomalies,
+            'filtered': getattr(detector.pcap, 'filtered', 0),
+            'fieldTableSize': len(detector.fieldData),
+            'valueTableSize': len(detector.valueData),
+            'valueTableBytes': detector.valueData.memoryUsage(),
+            'stages': dict((stage, {'seconds': seconds, 'calls': calls[stage]})
+                           for (stage, seconds) in self.stageSeconds().items()),
+            'packetLatency': self.packetLatency.summary(),
+            'flows': detector.flowTable.stats() if detector.flowTable is not None else None,
+            'shedding': detector.loadShedder.stats() if detector.loadShedder is not None else None,
+            'fieldSummaries': summaries,
+            'highCardinalityFields': FieldSummaries.highCardinality(summaries) if summaries is not None else None,
+        }
+
+    # Return the metrics in the Prometheus text exposition format
+    def prometheus(self):
+        data = self.snapshot()
+        lines = []
+
+        def metric(name, kind, helpText, samples):
+            lines.append('# HELP anomaly_%s %s' % (name, helpText))
+            lines.append('# TYPE anomaly_%s %s' % (name, kind))
+            for (labels, value) in samples:
+                lines.append('anomaly_%s%s %r' % (name, labels, value))
+
+        metric('packets_total', 'counter', 'Packets read.', [('', data['packets'])])
+        metric('fields_total', 'counter', 'Fields added to the tables.', [('', data['fields'])])
+        metric('anomalies_total', 'counter', 'Anomalous packets reported.', [('', data['anomalies'])])
+        metric('filtered_total', 'counter', 'Packets skipped by the filter.', [('', data['filtered'])])
+        metric('field_table_entries', 'gauge', 'Fields in fieldData.', [('', data['fieldTableSize'])])
+        metric('value_table_entries', 'gauge', 'Values in valueData.', [('', data['valueTableSize'])])
+        metric('value_table_bytes', 'gauge', 'Bytes used by valueData.', [('', data['valueTableBytes'])])
+        if data['fieldSummaries'] is not None:
+            summaries = sorted(data['fieldSummaries'].items())
+            metric('field_distinct_values', 'gauge', 'Estimated distinct values of each field.',
+                   [('{field="%s"}' % name, summary['distinct']) for (name, summary) in summaries])
+            metric('field_high_cardinality', 'gauge', 'Whether a field has too many distinct values.',
+                   [('{field="%s"}' % name, int(summary['highCardinality'])) for (name, summary) in summaries])
+        if data['shedding'] is not None:
+            metric('shed_packets_total', 'counter', 'Packets shed under overload, not scored.',
+                   [('', data['shedding']['shed'])])
+            metric('shed_level', 'gauge', 'Packets of 1/2**level of the flows are kept.',
+                   [('', data['shedding']['level'])])
+        stages = sorted(data['stages'].items())
+        metric('stage_seconds_total', 'counter', 'Time spent in each stage.',
+               [('{stage="%s"}' % stage, values['seconds']) for (stage, values) in stages])
+        metric('stage_calls_total', 'counter', 'Calls of each stage.',
+               [('{stage="%s"}' % stage, values['calls']) for (stage, values) in stages])
+
+        latency = self.packetLatency
+        samples = [('_bucket{le="%r"}' % limit, count) for (limit, count) in latency.cumulative()]
+        samples.append(('_bucket{le="+Inf"}', latency.count))
+        samples.append(('_sum', latency.total))
+        samples.append(('_count', latency.count))
+        lines.append('# HELP anomaly_packet_seconds Time taken by each packet.')
+        lines.append('# TYPE anomaly_packet_seconds histogram')
+        for (suffix, value) in samples:
+            lines.append('anomaly_packet_seconds%s %r' % (suffix, value))
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics to the target
+    def dump(self):
+        self.nextDump = time.monotonic() + self.interval
+        if self.form == 'prometheus':
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot()) + '\n'
+        try:
+            if self.target.startswith('unix:') or self.target.startswith('tcp:'):
+                self.send(text.encode('utf-8'))
+            else:
+                tmpPath = self.target + '.tmp'
+                with open(tmpPath, 'w') as fp:
+                    fp.write(text)
+                os.replace(tmpPath, self.target)
+        except OSError as err:
+            print("Could not write metrics to ", self.target, ": ", err)
+
+    # Send a dump to the socket target, connecting first if need be
+    def send(self, data):
+        if self.sock is None:
+            if self.target.startswith('unix:'):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                address = self.target[5:]
+            else:
+                (host, port) = self.target[4:].rsplit(':', 1)
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                address = (host, int(port))
+            sock.settimeout(1.0)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            # Reconnect on the next dump
+            self.sock.close()
+            self.sock = None
+            raise
+
+    def close(self):
+        self.dump()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
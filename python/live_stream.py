@@ -0,0 +1,231 @@
+# This module reads PCAP records as they arrive instead of from a finished file: from
+# standard input (tcpdump -w - | python anomaly_detect.py -), from a named pipe, or from
+# a capture file that is still being written, which is followed the way tail -f
+# follows a log and reopened when it is rotated.
+#
+# The input is read with non-blocking reads of at most chunkSize bytes whenever
+# select reports data, and every complete record in what has been read is handed on
+# at once, so a packet waits neither for a buffer to fill nor for more than one chunk
+# of the packets before it.  The time each chunk arrived is kept in the arrival
+# attribute, so the time from arrival to alert can be measured, and queued returns the
+# number of bytes waiting to be read, so a LoadShedder can tell how far behind the
+# reader is; see load_shed.py.
+#
+# Standard input is made non-blocking for the select loop, and its mode is put back
+# by close, since the shell and whatever wrote to it share the same open file.  A
+# followed file that does not exist yet is waited for, as tail -F does.
+#
+# A rotated file may have been written with another link type or timestamp
+# precision.  The stream keeps the header and decoder of the first file, which
+# anomaly_detect.py may have wrapped, and converts the timestamps of a later file
+# to its precision.  A later file of another link type is decoded with its own
+# decoder, and when a filter is set its packets are filtered out, since the filter
+# reads the frame at the offsets of the first file's link type.
+
+import fcntl
+import os
+import struct
+import termios
+import select
+import stat
+import sys
+import time
+
+from pcapfile import InvalidHeader, linklayer
+from pcapfile.structs import pcap_packet
+from pcap_stream import PcapStream, parseHeader, pcapHeaderSize, recordHeaderSize
+
+chunkSize = 1 << 14
+
+# Seconds to wait for a followed file to grow before looking again
+pollInterval = 0.2
+
+
+# Return True if fname names a live source: standard input or a named pipe
+def isLiveSource(fname):
+    if fname == '-':
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(fname).st_mode)
+    except OSError:
+        return False
+
+
+class LiveStream(PcapStream):
+    """
+    A PcapStream over a source that is still being written.  fname is a file name,
+    a named pipe, or - for standard input.  If follow is set, reaching the end of a
+    regular file waits for it to grow instead of ending the stream, and a file that
+    has been replaced or truncated is reopened from its start.  After stop() the
+    stream ends at the next wait for data.
+    """
+
+    def __init__(self, fname, layers=3, zeroCopy=True, follow=False):
+        self.fname = fname
+        self.follow = follow
+        self.layers = layers
+        self.zeroCopy = zeroCopy
+        self.fd = None
+        self.stdinBlocking = None
+        self.stopped = False
+        self.arrival = time.monotonic()
+        self.pending = bytearray()
+        self.header = None
+        if not self.openSource():
+            raise InvalidHeader("Live source ended before the PCAP header")
+
+    @classmethod
+    def open(cls, fname, layers=3, zeroCopy=True, follow=False):
+        return cls(fname, layers, zeroCopy, follow)
+
+    # Open the source, or reopen a rotated file, and read its global header.  Returns
+    # False if the stream ended before the header was read.
+    def openSource(self):
+        if self.fd is not None and self.fname != '-':
+            os.close(self.fd)
+            self.fd = None
+        if self.fname == '-':
+            self.fd = sys.stdin.buffer.fileno()
+            if self.stdinBlocking is None:
+                self.stdinBlocking = os.get_blocking(self.fd)
+        else:
+            self.fd = self.openFile()
+        os.set_blocking(self.fd, False)
+        self.regular = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.position = 0
+        self.pending = bytearray()
+
+        while len(self.pending) < pcapHeaderSize:
+            if not self.readChunk():
+                return False
+        rawHeader = bytes(self.pending[:pcapHeaderSize])
+        del self.pending[:pcapHeaderSize]
+        if self.header is None:
+            self.setHeader(rawHeader)
+            self.fileHeader = self.header
+        else:
+            (self.fileHeader, self.recordHeader) = parseHeader(rawHeader)
+        self.sameLinkType = self.fileHeader.ll_type == self.header.ll_type
+        self.fileDecoder = None if self.sameLinkType else linklayer.clookup(self.fileHeader.ll_type)
+        return True
+
+    # Open the file or named pipe and return its descriptor.  A followed file that does
+    # not exist is waited for.
+    def openFile(self):
+        waiting = False
+        while True:
+            try:
+                # Opening a named pipe waits here for a writer
+                return os.open(self.fname, os.O_RDONLY)
+            except FileNotFoundError:
+                if not self.follow:
+                    raise
+            if not waiting:
+                print("Waiting for ", self.fname, " to be created")
+                waiting = True
+            time.sleep(pollInterval)
+
+    # Wait until data can be read and append it to pending.  Returns False at the end
+    # of the stream, which never comes for a followed regular file unless the stream
+    # is stopped.
+    def readChunk(self):
+        while not self.stopped:
+            (readable, writable, failed) = select.select([self.fd], [], [], pollInterval)
+            if readable:
+                try:
+                    chunk = os.read(self.fd, chunkSize)
+                except BlockingIOError:
+                    continue
+                if chunk:
+                    self.arrival = time.monotonic()
+                    self.position += len(chunk)
+                    self.pending += chunk
+                    return True
+                if not (self.follow and self.regular):
+                    return False
+            if self.follow and self.regular:
+                if self.rotated():
+                    return self.openSource()
+                time.sleep(pollInterval)
+        return False
+
+    # End the stream the next time it waits for data.  Safe to call from a signal
+    # handler.
+    def stop(self):
+        self.stopped = True
+
+    # Return True if the followed file has been replaced by a new file or truncated
+    def rotated(self):
+        try:
+            current = os.stat(self.fname)
+        except OSError:
+            # Between the rename of the old file and the creation of the new one
+            return False
+        opened = os.fstat(self.fd)
+        return current.st_ino != opened.st_ino or current.st_size < self.position
+
+    # Yield the header fields and raw bytes of each record as soon as it is complete.
+    # Timestamps are in the precision of the first file.
+    def records(self):
+        setNs = self.header.ns_resolution
+        while True:
+            pending = self.pending
+            offset = 0
+            unpack = self.recordHeader.unpack_from
+            fileNs = self.fileHeader.ns_resolution
+            while len(pending) - offset >= recordHeaderSize:
+                (seconds, fraction, captureLen, packetLen) = unpack(pending, offset)
+                end = offset + recordHeaderSize + captureLen
+                if end > len(pending):
+                    break
+                data = bytes(pending[offset + recordHeaderSize:end])
+                offset = end
+                if fileNs != setNs:
+                    fraction = fraction // 1000 if fileNs else fraction * 1000
+                yield seconds, fraction, captureLen, packetLen, data
+            del pending[:offset]
+            if not self.readChunk():
+                return
+
+    # Return True if the packet last read, whose frame is data, passes the filter
+    def accepted(self, data):
+        return self.sameLinkType and self.accept(data)
+
+    # Yield each record decoded into a pcap_packet with the decoder of its file
+    def __iter__(self):
+        layers = self.layers - 1
+        zeroCopy = self.zeroCopy
+        accept = self.accept
+        for (seconds, fraction, captureLen, packetLen, data) in self.records():
+            if accept is not None and not self.accepted(data):
+                self.filtered += 1
+                continue
+            decoder = self.decoder if self.sameLinkType else self.fileDecoder
+            if layers >= 0 and decoder:
+                if zeroCopy:
+                    data = memoryview(data)
+                packet = decoder(data, layers=layers)
+            else:
+                packet = data
+            yield pcap_packet(self.headerPointer, seconds, fraction, captureLen, packetLen, packet)
+
+    # Return the number of bytes read but not yet handed on, plus those waiting in the
+    # pipe or written to the followed file but not read
+    def queued(self):
+        waiting = len(self.pending)
+        try:
+            if self.regular:
+                waiting += max(os.fstat(self.fd).st_size - self.position, 0)
+            else:
+                waiting += struct.unpack('i', fcntl.ioctl(self.fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+        except OSError:
+            pass
+        return waiting
+
+    def close(self):
+        if self.fname == '-':
+            os.set_blocking(self.fd, self.stdinBlocking)
+        elif self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
@@ -0,0 +1,107 @@
+# This module keeps a live detector from falling ever further behind its input.  When
+# packets arrive faster than checkData can score them, the queue of packets waiting
+# to be read grows and so does the time from the arrival of a packet to its alert.
+# A LoadShedder watches both and, when the delay a new packet can expect exceeds the
+# target, sheds a share of the packets until it is back under it.
+#
+# The delay is estimated every interval seconds as the longest lag seen since the
+# last estimate (the time from the arrival of a packet to its scoring) plus the time
+# it takes to work through the bytes waiting in the queue at the rate they were
+# consumed.  Above the target the shedding level goes up by one; below half of it,
+# it goes down by one for each interval since the last estimate.  At level n a packet
+# is kept if the hash of its flow (see flowKey in flow_state.py) falls in the lowest
+# 2**-n of the hash range, so whole connections are kept or shed, the same ones in
+# every run, and the flows kept at a level are among those kept at every lower level.
+# Packets that are not IP are always kept.
+#
+# A shed packet is either not looked at any further ('sample') or added to the
+# tables without being scored ('count-only'), which keeps the state of the detector
+# whole but saves only the scoring.  Either way it cannot raise an alert, and it is
+# counted, so the share of the traffic that was not checked is known exactly.
+
+import time
+
+from flow_state import flowKey
+from pcap_stream import recordHeaderSize
+
+# Fibonacci hashing, as in state_store.py
+hashMultiplier = 0x9E3779B97F4A7C15
+mask64 = (1 << 64) - 1
+
+maxLevel = 16
+
+
+class LoadShedder(object):
+    """
+    Decides which packets of a live stream to shed so that alerts come no more than
+    target seconds after their packets arrive.  stream is a LiveStream.  mode is
+    'sample' or 'count-only'.  admit is called with each packet to be checked.
+    """
+
+    def __init__(self, stream, target, mode='sample', interval=0.1):
+        self.stream = stream
+        self.target = target
+        self.mode = mode
+        self.interval = interval
+        self.level = 0
+        self.shift = 64
+        self.checked = 0
+        self.shed = 0
+        self.peakLevel = 0
+
+        self.worstLag = 0.0
+        self.consumed = 0
+        self.lastAdjust = time.monotonic()
+        self.nextAdjust = self.lastAdjust + interval
+
+    # Return True if the packet is to be scored, or False if it is shed
+    def admit(self, packet, now):
+        lag = now - self.stream.arrival
+        if lag > self.worstLag:
+            self.worstLag = lag
+        self.consumed += recordHeaderSize + packet.capture_len
+        if now >= self.nextAdjust:
+            self.adjust(now)
+        self.checked += 1
+        if not self.level:
+            return True
+        key = flowKey(packet.packet)
+        if key is None or ((hash(key) * hashMultiplier) & mask64) >> self.shift == 0:
+            return True
+        self.shed += 1
+        return False
+
+    # Estimate the delay and change the level if need be
+    def adjust(self, now):
+        elapsed = now - self.lastAdjust
+        rate = self.consumed / elapsed if elapsed > 0 else 0.0
+        queued = self.stream.queued()
+        delay = self.worstLag + (queued / rate if rate else 0.0)
+        if delay > self.target and self.level < maxLevel:
+            self.setLevel(self.level + 1)
+        elif delay < self.target / 2 and self.level > 0:
+            # After a pause in the input, come down by a level for each interval of it
+            self.setLevel(max(self.level - max(int(elapsed / self.interval), 1), 0))
+        self.worstLag = 0.0
+        self.consumed = 0
+        self.lastAdjust = now
+        self.nextAdjust = now + self.interval
+
+    def setLevel(self, level):
+        self.level = level
+        self.shift = 64 - level
+        self.peakLevel = max(self.peakLevel, level)
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'level': self.level,
+            'peakLevel': self.peakLevel,
+            'checked': self.checked,
+            'shed': self.shed,
+        }
+
+    def __repr__(self):
+        share = 100.0 * self.shed / self.checked if self.checked else 0.0
+        return '%d of %d packets (%.2f%%) shed (%s), now keeping 1/%d of flows, at most 1/%d' % (
+            self.shed, self.checked, share, self.mode, 1 << self.level, 1 << self.peakLevel)
@@ -0,0 +1,181 @@
+# This module saves the trained state of the detector (fieldData, valueData,
+# numPackets, maxTraining and threshold) to a snapshot file and loads it back, so a
+# sensor that restarts can go straight back to checking packets instead of training
+# on the first maxTraining packets again.
+#
+# A snapshot is a header followed by tagged sections.  Most sections are the typed
+# arrays of the fieldData and valueData tables written as they are in memory, each
+# padded to a multiple of 8 bytes.  When a snapshot is loaded the file is memory
+# mapped copy-on-write and the tables use views of those sections instead of arrays,
+# so loading costs almost nothing however large the tables are; pages are only read
+# (and copied) as the values on them are looked up or changed.
+#
+# A snapshot of a run over a set of captures also holds the cursor of the reader, as
+# JSON in a CURS section, so the run can be resumed where the snapshot was taken; see
+# capture_set.py.
+#
+# Snapshots are written to a temporary file which then replaces the old snapshot, so
+# a crash while saving leaves the previous snapshot in place.
+
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+from sketch_store import SketchTable
+from state_store import FieldTable, ValueTable
+
+snapshotMagic = b'ADSN'
+snapshotVersion = 2
+
+# magic, version, byte order of the arrays (b'<' or b'>'), kind of valueData table,
+# number of sections, numPackets, maxTraining, threshold
+snapshotHeader = struct.Struct('<4sIcxxxIIQQd')
+
+# tag, length of the data that follows (without the padding)
+sectionHeader = struct.Struct('<4sQ')
+
+# Kinds of valueData table
+exactTable = 0
+sketchTable = 1
+
+# The sections a snapshot of each kind must have, and the size of the items of each
+# section of typed items
+requiredSections = {
+    exactTable: (b'FNAM', b'FLST', b'FCNT', b'VKEY', b'VLST', b'VLEN', b'VCNT', b'VIDS'),
+    sketchTable: (b'FNAM', b'FLST', b'FCNT', b'VKEY', b'VLST', b'VLEN', b'SKCT'),
+}
+itemSizes = {b'FLST': 8, b'FCNT': 8, b'VKEY': 8, b'VLST': 8, b'VLEN': 8, b'VCNT': 8, b'SKCT': 4}
+
+nativeOrder = b'<' if sys.byteorder == 'little' else b'>'
+
+# Type tags of the interned (non-integer) values of a ValueTable
+valueTypes = {bytes: b'b', str: b's'}
+
+
+# Pack the interned values of a ValueTable, in the order of their ids, as a type tag
+# and a length in front of each value
+def packValues(valueIds):
+    values = sorted(valueIds, key=valueIds.get)
+    parts = []
+    for value in values:
+        tag = valueTypes.get(value.__class__)
+        if tag is None:
+            raise TypeError("Cannot save a field value of type " + value.__class__.__name__)
+        data = value if tag == b'b' else value.encode('utf-8')
+        parts.append(struct.pack('<cI', tag, len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+# Unpack the interned values of a ValueTable into a dictionary from value to id.
+# Raises ValueError if the data is cut short.
+def unpackValues(data):
+    valueIds = {}
+    offset = 0
+    while offset < len(data):
+        if offset + 5 > len(data):
+            raise ValueError("Interned values are truncated")
+        (tag, length) = struct.unpack_from('<cI', data, offset)
+        offset += 5
+        if offset + length > len(data):
+            raise ValueError("Interned values are truncated")
+        value = bytes(data[offset:offset + length])
+        if tag == b's':
+            value = value.decode('utf-8')
+        valueIds[value] = len(valueIds)
+        offset += length
+    return valueIds
+
+
+# Write a snapshot of the detector state to path
+def saveModel(path, fieldData, valueData, numPackets, maxTraining, threshold, cursor=None):
+    sections = [
+        (b'FNAM', '\n'.join(fieldData.names[1:]).encode('utf-8')),
+        (b'FLST', fieldData.last),
+        (b'FCNT', fieldData.count),
+        (b'VKEY', valueData.keys),
+        (b'VLST', valueData.last),
+        (b'VLEN', struct.pack('<Q', len(valueData))),
+    ]
+    if isinstance(valueData, SketchTable):
+        kind = sketchTable
+        sections.append((b'SKCT', valueData.counters))
+    else:
+        kind = exactTable
+        sections.append((b'VCNT', valueData.count))
+        sections.append((b'VIDS', packValues(valueData.valueIds)))
+    if cursor is not None:
+        sections.append((b'CURS', json.dumps(cursor).encode('utf-8')))
+
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as fp:
+        fp.write(snapshotHeader.pack(snapshotMagic, snapshotVersion, nativeOrder, kind, len(sections),
+                                     numPackets, maxTraining, threshold))
+        for (tag, data) in sections:
+            data = memoryview(data).cast('B')
+            fp.write(sectionHeader.pack(tag, len(data)))
+            fp.write(data)
+            fp.write(bytes(-len(data) % 8))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmpPath, path)
+
+
+# Load a snapshot written by saveModel.  Returns the fieldData and valueData tables,
+# the saved numPackets, maxTraining and threshold, and the cursor (None if there is
+# none).  Raises ValueError if the file is not a snapshot this version can read or
+# is truncated.
+def loadModel(path):
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size < snapshotHeader.size:
+            raise ValueError("Snapshot " + path + " is too short")
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+    (magic, version, byteOrder, kind, numSections,
+     numPackets, maxTraining, threshold) = snapshotHeader.unpack_from(data)
+    if magic != snapshotMagic:
+        raise ValueError(path + " is not a snapshot")
+    if version != snapshotVersion:
+        raise ValueError("Snapshot " + path + " has unsupported version %d" % version)
+    if byteOrder != nativeOrder:
+        raise ValueError("Snapshot " + path + " was written on a machine with a different byte order")
+    if kind not in requiredSections:
+        raise ValueError("Snapshot " + path + " has an unknown kind of table %d" % kind)
+
+    view = memoryview(data)
+    sections = {}
+    offset = snapshotHeader.size
+    for i in range(numSections):
+        if offset + sectionHeader.size > len(data):
+            raise ValueError("Snapshot " + path + " is truncated")
+        (tag, length) = sectionHeader.unpack_from(data, offset)
+        offset += sectionHeader.size
+        if offset + length > len(data):
+            raise ValueError("Snapshot " + path + " is truncated")
+        if length % itemSizes.get(tag, 1):
+            raise ValueError("Snapshot " + path + " has a damaged " + tag.decode('ascii', 'replace') + " section")
+        sections[tag] = view[offset:offset + length]
+        offset += length + (-length % 8)
+    for tag in requiredSections[kind]:
+        if tag not in sections:
+            raise ValueError("Snapshot " + path + " has no " + tag.decode('ascii') + " section")
+
+    fieldData = FieldTable()
+    names = bytes(sections[b'FNAM']).decode('utf-8')
+    for name in names.split('\n') if names else []:
+        fieldData.add(name)
+    # The field arrays are small and grow as new fields are seen, so they are copied
+    fieldData.last = array.array('Q', sections[b'FLST'].cast('Q'))
+    fieldData.count = array.array('Q', sections[b'FCNT'].cast('Q'))
+
+    (size,) = struct.unpack('<Q', sections[b'VLEN'])
+    if kind == sketchTable:
+        valueData = SketchTable.fromArrays(sections[b'SKCT'].cast('I'), sections[b'VKEY'].cast('Q'),
+                                           sections[b'VLST'].cast('Q'), size)
+    else:
+        valueData = ValueTable.fromArrays(sections[b'VKEY'].cast('Q'), sections[b'VLST'].cast('Q'),
+                                          sections[b'VCNT'].cast('Q'), size, unpackValues(sections[b'VIDS']))
+    cursor = json.loads(bytes(sections[b'CURS']).decode('utf-8')) if b'CURS' in sections else None
+    return fieldData, valueData, numPackets, maxTraining, threshold, cursor
@@ -0,0 +1,246 @@
+# This module runs the detector of anomaly_detect.py in several worker processes at
+# once.  The main process only reads the raw records of the capture and deals them
+# out by flow: the addresses and ports of each IPv4 or IPv6 packet are hashed, in an
+# order that does not depend on the direction of the packet, and the hash picks the
+# worker.  Packets that are neither, such as ARP, all go to the first worker.
+# All the packets of a flow therefore go to the same worker, which decodes, trains
+# on and scores them with its own fieldData and valueData.
+#
+# Packets keep their numbers in the whole capture, so time scores are measured in
+# packets of the capture, and each worker trains on its share of the first
+# maxTraining packets.  Frequency scores are relative to the packets a worker has
+# seen, so the scores differ from those of a single detector; that is the price of
+# not sharing state between workers.
+#
+# Records are sent to the workers in rounds of roundSize packets, each worker getting
+# one block with its share of the round.  The anomalies of a round are reported, in
+# packet order, once every worker has finished it.  At most maxRounds rounds are in
+# flight, so a slow worker holds back the reader instead of letting blocks pile up.
+#
+# A worker that fails sends its exception to the main process, which stops the other
+# workers and raises it, as a single detector would.  A worker that dies without
+# sending one (killed, say) is noticed by polling, and the run fails the same way.
+
+import array
+import ctypes
+import multiprocessing
+import queue
+import zlib
+
+import anomaly_detect as ad
+from fields import compileExtractors
+from pcapfile import linklayer
+from pcapfile.structs import pcap_packet
+from pcap_stream import parseHeader
+from sketch_store import SketchTable
+
+roundSize = 4096
+maxRounds = 4
+
+# Seconds to wait on a queue before checking that the workers are alive
+pollInterval = 1.0
+
+# Ethernet types of IPv4, IPv6 and a VLAN tag, as they appear in the frame
+ethernetIPv4 = b'\x08\x00'
+ethernetIPv6 = b'\x86\xdd'
+ethernetVLAN = b'\x81\x00'
+
+# IP protocols whose headers start with a source and a destination port
+portProtocols = (0x06, 0x11, 0x88)
+
+
+# Return the worker, out of workers, that handles the flow of a raw Ethernet frame.
+# Frames that are neither IPv4 nor IPv6 all go to worker 0.  The ports of IPv6 are
+# those just after the fixed header; extension headers are not followed.
+def flowShard(data, workers):
+    offset = 12
+    etherType = data[offset:offset + 2]
+    while etherType == ethernetVLAN:
+        offset += 4
+        etherType = data[offset:offset + 2]
+    ip = offset + 2
+    if etherType == ethernetIPv4 and len(data) >= ip + 20:
+        src = bytes(data[ip + 12:ip + 16])
+        dst = bytes(data[ip + 16:ip + 20])
+        (protocol, l4) = (data[ip + 9], ip + (data[ip] & 0x0f) * 4)
+    elif etherType == ethernetIPv6 and len(data) >= ip + 40:
+        src = bytes(data[ip + 8:ip + 24])
+        dst = bytes(data[ip + 24:ip + 40])
+        (protocol, l4) = (data[ip + 6], ip + 40)
+    else:
+        return 0
+
+    if protocol in portProtocols:
+        src += data[l4:l4 + 2]
+        dst += data[l4 + 2:l4 + 4]
+    if src > dst:
+        (src, dst) = (dst, src)
+    return zlib.crc32(src + dst) % workers
+
+
+# Body of a worker process.  Sets up the detector in this process, then decodes and
+# scores the blocks it is sent until it is sent None.  For each block it puts the
+# round number and the (packet number, score, fields, highest scoring field) of the
+# anomalous packets on outbox.  If it fails, it puts None and the exception instead.
+def worker(rawHeader, settings, inbox, outbox):
+    try:
+        runWorker(rawHeader, settings, inbox, outbox)
+    except Exception as err:
+        outbox.put((None, err))
+        raise
+
+
+def runWorker(rawHeader, settings, inbox, outbox):
+    header = parseHeader(rawHeader)[0]
+    headerPointer = ctypes.pointer(header)
+    decoder = linklayer.clookup(header.ll_type)
+
+    ad.fieldNames = settings['fields']
+    ad.fieldExtractors = compileExtractors(ad.fieldNames)
+    ad.maxTraining = settings['maxTraining']
+    ad.threshold = settings['threshold']
+    if settings['memoryLimit']:
+        ad.valueData = SketchTable.fromMemoryLimit(settings['memoryLimit'])
+
+    while True:
+        block = inbox.get()
+        if block is None:
+            break
+        (roundNumber, numbers, offsets, data) = block
+        numbers = array.array('Q', numbers)
+        offsets = array.array('Q', offsets)
+        view = memoryview(data)
+        anomalies = []
+        for i in range(len(numbers)):
+            record = view[offsets[i]:offsets[i + 1]]
+            # parsePacket only looks at the decoded layers, not the timestamp
+            packet = pcap_packet(headerPointer, 0, 0, len(record), len(record), decoder(record, layers=2))
+            fields = ad.parsePacket(packet)
+            ad.numPackets = numbers[i]
+            if ad.numPackets <= ad.maxTraining:
+                for field in fields:
+                    ad.processField(field)
+            else:
+                (count, score, field) = ad.checkPacket(fields)
+                if count > 0:
+                    anomalies.append((numbers[i], score, fields, field))
+        outbox.put((roundNumber, anomalies))
+
+
+class ShardedDetector(object):
+    """
+    Runs the detector in the given number of worker processes for a capture whose
+    24 byte PCAP header is rawHeader.  settings holds the fields, maxTraining,
+    threshold and memoryLimit (bytes per worker, or None) of the workers.
+    """
+
+    def __init__(self, rawHeader, workers, settings):
+        self.workers = workers
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = []
+        self.processes = []
+        for i in range(workers):
+            inbox = multiprocessing.Queue(maxRounds)
+            process = multiprocessing.Process(target=worker, args=(rawHeader, settings, inbox, self.outbox))
+            process.daemon = True
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+
+        self.numRecords = 0
+        self.sentRounds = 0
+        self.nextRound = 0
+        self.results = {}
+
+    # Deal one round of (packet number, raw record) pairs out to the workers
+    def send(self, records):
+        blocks = [(array.array('Q'), array.array('Q', [0]), bytearray()) for i in range(self.workers)]
+        for (number, data) in records:
+            (numbers, offsets, buf) = blocks[flowShard(data, self.workers)]
+            numbers.append(number)
+            buf += data
+            offsets.append(len(buf))
+        for (inbox, (numbers, offsets, buf)) in zip(self.inboxes, blocks):
+            self.put(inbox, (self.sentRounds, numbers.tobytes(), offsets.tobytes(), bytes(buf)))
+        self.numRecords += len(records)
+        self.sentRounds += 1
+
+    # Wait for the next round to be finished by every worker and return its
+    # anomalies in packet order
+    def receive(self):
+        while len(self.results.get(self.nextRound, ())) < self.workers:
+            try:
+                (roundNumber, anomalies) = self.outbox.get(timeout=pollInterval)
+            except queue.Empty:
+                self.checkWorkers()
+                continue
+            self.addResult(roundNumber, anomalies)
+        merged = sorted(anomaly for anomalies in self.results.pop(self.nextRound) for anomaly in anomalies)
+        self.nextRound += 1
+        return merged
+
+    # Keep the anomalies of a round a worker finished, or raise the error it sent
+    def addResult(self, roundNumber, anomalies):
+        if roundNumber is None:
+            self.terminate()
+            raise anomalies
+        self.results.setdefault(roundNumber, []).append(anomalies)
+
+    # Put an item on the inbox of a worker, checking that the workers are alive while
+    # it is full
+    def put(self, inbox, item):
+        while True:
+            try:
+                inbox.put(item, timeout=pollInterval)
+                return
+            except queue.Full:
+                self.checkWorkers()
+
+    # Fail if a worker has exited.  The error it sent, if any, is raised.
+    def checkWorkers(self):
+        dead = [process for process in self.processes if not process.is_alive()]
+        if not dead:
+            return
+        while True:
+            try:
+                self.addResult(*self.outbox.get(timeout=pollInterval))
+            except queue.Empty:
+                break
+        self.terminate()
+        raise RuntimeError("Worker process %d exited with code %s" % (dead[0].pid, dead[0].exitcode))
+
+    # Stop every worker that is still running.  Blocks not yet taken from the inboxes
+    # are dropped, so that exiting does not wait to flush them.
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        for inbox in self.inboxes:
+            inbox.cancel_join_thread()
+
+    # Send records, given as (packet number, raw record) pairs, to the workers and
+    # yield the (packet number, score, fields, highest scoring field) of every anomaly
+    # in packet order
+    def run(self, records):
+        pending = []
+        for record in records:
+            pending.append(record)
+            if len(pending) == roundSize:
+                self.send(pending)
+                pending = []
+                if self.sentRounds - self.nextRound >= maxRounds:
+                    for anomaly in self.receive():
+                        yield anomaly
+        if pending:
+            self.send(pending)
+        while self.nextRound < self.sentRounds:
+            for anomaly in self.receive():
+                yield anomaly
+
+    def close(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
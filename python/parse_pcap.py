@@ -5,7 +5,7 @@
 # The first 3 sample PCAP files were downloaded from https://wiki.wireshark.org/SampleCaptures#TCP.  
 # The last PCAP file is a trimmed down version of a PCAP file found on 
 # https://www.netresec.com/?page=MACCDC.  To create maccdc2012_00000_trim2.pcap run:
-# python trim_file.py maccdc2012_00000.pcap maccdc2012_00000_trim2.pcap 10000
+# python trim_capture.py maccdc2012_00000.pcap maccdc2012_00000_trim2.pcap --bytes 10000
 #
 # The output of this script can be compared with the data packets viewed with Wireshark.
 
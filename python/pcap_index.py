@@ -0,0 +1,199 @@
+# This module gives random access to the packets of a PCAP file.  The file is memory
+# mapped and an index of the offset and timestamp of every record is built the first
+# time the file is opened.  The index is saved next to the capture (fname + '.idx') so
+# that opening the same capture again only costs loading the index: the number of
+# packets is known without parsing, packet N can be read directly, and a time range
+# can be found with a binary search.
+#
+# The index holds two array('Q') columns, so it takes 16 bytes per packet.  Timestamps
+# are stored in nanoseconds whatever the resolution of the capture.  If the capture
+# has grown since the index was saved, only the new records are indexed.
+
+import array
+import bisect
+import ctypes
+import mmap
+import os
+import struct
+
+from pcapfile import linklayer, InvalidHeader
+from pcapfile.structs import pcap_packet
+from pcap_stream import parseHeader, pcapHeaderSize, recordHeaderSize
+
+indexMagic = b'PCIX'
+indexVersion = 1
+
+# magic, version, number of records, offset just past the last indexed record,
+# followed by a copy of the 24 byte PCAP header the index was built for
+indexHeader = struct.Struct('<4sIQQ')
+
+
+class MappedPcap(object):
+    """
+    A memory-mapped PCAP file with a record-offset index.  Packets are decoded in
+    zero-copy mode, so their payloads are views into the mapping; drop them before
+    calling close().  accept and filtered are as in PcapStream.
+    """
+
+    accept = None
+    filtered = 0
+
+    def __init__(self, fname, layers=3, indexPath=None, writeIndex=True):
+        self.fname = fname
+        self.layers = layers
+        self.indexPath = indexPath if indexPath else fname + '.idx'
+
+        self.fp = open(fname, 'rb')
+        # An empty file cannot be mapped, so a file too short for a header is
+        # rejected before mapping, as PcapStream rejects it
+        if os.fstat(self.fp.fileno()).st_size < pcapHeaderSize:
+            self.fp.close()
+            raise InvalidHeader("PCAP file is too short to hold a header")
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.rawHeader = self.map[:pcapHeaderSize]
+        self.header, self.recordHeader = parseHeader(self.rawHeader)
+        self.headerPointer = ctypes.pointer(self.header)
+        self.decoder = linklayer.clookup(self.header.ll_type)
+        self.tsScale = 1 if self.header.ns_resolution else 1000
+
+        self.offsets = array.array('Q')
+        self.timestamps = array.array('Q')
+        self.endOffset = pcapHeaderSize
+        loaded = self.loadIndex()
+        extended = self.extendIndex()
+        if writeIndex and (extended or not loaded):
+            self.saveIndex()
+
+    @classmethod
+    def open(cls, fname, layers=3):
+        return cls(fname, layers)
+
+    # Load a saved index if it was built for this capture.  Returns True on success.
+    def loadIndex(self):
+        try:
+            with open(self.indexPath, 'rb') as fp:
+                raw = fp.read(indexHeader.size + pcapHeaderSize)
+                if len(raw) != indexHeader.size + pcapHeaderSize:
+                    return False
+                (magic, version, count, endOffset) = indexHeader.unpack(raw[:indexHeader.size])
+                if magic != indexMagic or version != indexVersion:
+                    return False
+                if raw[indexHeader.size:] != self.rawHeader or endOffset > len(self.map):
+                    return False
+                offsets = array.array('Q')
+                timestamps = array.array('Q')
+                offsets.fromfile(fp, count)
+                timestamps.fromfile(fp, count)
+        except (OSError, EOFError):
+            return False
+
+        self.offsets = offsets
+        self.timestamps = timestamps
+        self.endOffset = endOffset
+        return True
+
+    # Index any records past the end of the current index.  Returns True if records
+    # were added.
+    def extendIndex(self):
+        data = self.map
+        size = len(data)
+        unpack = self.recordHeader.unpack_from
+        scale = self.tsScale
+        offsets = self.offsets
+        timestamps = self.timestamps
+        offset = self.endOffset
+        count = len(offsets)
+
+        while offset + recordHeaderSize <= size:
+            (seconds, fraction, captureLen, packetLen) = unpack(data, offset)
+            if offset + recordHeaderSize + captureLen > size:
+                # The last record was cut short; leave it for a later extension
+                break
+            offsets.append(offset)
+            timestamps.append(seconds * 1000000000 + fraction * scale)
+            offset += recordHeaderSize + captureLen
+
+        self.endOffset = offset
+        return len(offsets) != count
+
+    # Write the index next to the capture.  The index is written to a temporary file
+    # first so a reader never sees a partial index.
+    def saveIndex(self):
+        tmpPath = self.indexPath + '.tmp'
+        try:
+            with open(tmpPath, 'wb') as fp:
+                fp.write(indexHeader.pack(indexMagic, indexVersion, len(self.offsets), self.endOffset))
+                fp.write(self.rawHeader)
+                self.offsets.tofile(fp)
+                self.timestamps.tofile(fp)
+            os.replace(tmpPath, self.indexPath)
+        except OSError as err:
+            print("Could not save PCAP index ", self.indexPath, ": ", err)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Return the header fields and a view of the raw bytes of record n
+    def record(self, n):
+        offset = self.offsets[n]
+        (seconds, fraction, captureLen, packetLen) = self.recordHeader.unpack_from(self.map, offset)
+        start = offset + recordHeaderSize
+        return seconds, fraction, captureLen, packetLen, self.view[start:start + captureLen]
+
+    # Yield the header fields and a view of the raw bytes of the records numbered
+    # start up to but not including stop
+    def records(self, start=0, stop=None):
+        if stop is None or stop > len(self.offsets):
+            stop = len(self.offsets)
+        for n in range(start, stop):
+            yield self.record(n)
+
+    # Return record n decoded into a pcap_packet
+    def packet(self, n):
+        (seconds, fraction, captureLen, packetLen, data) = self.record(n)
+        if self.layers > 0 and self.decoder:
+            data = self.decoder(data, layers=self.layers - 1)
+        return pcap_packet(self.headerPointer, seconds, fraction, captureLen, packetLen, data)
+
+    # Yield the decoded packets numbered start up to but not including stop.  Those
+    # rejected by accept, if it is set, are counted in filtered and not decoded.
+    def packets(self, start=0, stop=None):
+        if stop is None or stop > len(self.offsets):
+            stop = len(self.offsets)
+        accept = self.accept
+        for n in range(start, stop):
+            if accept is not None and not accept(self.record(n)[4]):
+                self.filtered += 1
+                continue
+            yield self.packet(n)
+
+    def __iter__(self):
+        return self.packets()
+
+    # Return the number of the first packet captured at or after the given time in
+    # seconds since the epoch
+    def seekTime(self, seconds):
+        return bisect.bisect_left(self.timestamps, int(seconds * 1000000000))
+
+    # Return the range of packet numbers captured from startTime up to endTime.
+    # Either end can be None to leave that side of the range open.
+    def timeRange(self, startTime=None, endTime=None):
+        start = 0 if startTime is None else self.seekTime(startTime)
+        stop = len(self.offsets) if endTime is None else self.seekTime(endTime)
+        return start, max(start, stop)
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.fp.close()
+
+    def __repr__(self):
+        string = '%s-endian capture file version %d.%d\n'
+        string += '%ssecond time resolution\n'
+        string += 'snapshot length: %d\n'
+        string += 'linklayer type: %s\nnumber of packets: %d\n'
+        return string % (self.header.byteorder.decode(), self.header.major, self.header.minor,
+                         "nano" if self.header.ns_resolution else "micro",
+                         self.header.snaplen, linklayer.lookup(self.header.ll_type),
+                         len(self.offsets))
@@ -0,0 +1,133 @@
+# This module reads a PCAP file one record at a time.  The pypcapfile function
+# savefile.load_savefile parses every packet of a capture into the list pcap.packets
+# before returning, so memory grows with the size of the file and nothing can be
+# scored until the whole file has been parsed.  A PcapStream instead yields one
+# decoded packet at a time from a generator, so memory use stays constant and the
+# first packet is available as soon as its record has been read.
+#
+# The packets yielded are the same pcap_packet objects that load_savefile builds,
+# so code written against pcap.packets (such as parsePacket in anomaly_detect.py)
+# works on them unchanged.  By default the layers are decoded in zero-copy mode:
+# each layer is handed a memoryview of the record instead of a hexified copy of
+# its payload, so only the few bytes of each header are ever unpacked.
+#
+# If accept is set to a filter compiled by prefilter.py, records it rejects are
+# counted in filtered and skipped before they are decoded.
+#
+# Captures with nanosecond timestamps (magic number 0xa1b23c4d) are read as well, and
+# PcapStream.open reads pcapng captures with the PcapngStream of pcapng_stream.py.
+
+import ctypes
+import struct
+
+from pcapfile import linklayer, InvalidHeader, UnknownMagicNumber
+from pcapfile.structs import __pcap_header__, pcap_packet
+
+MAGIC_NUMBER = 0xa1b2c3d4
+MAGIC_NUMBER_NS = 0xa1b23c4d
+
+pcapHeaderSize = 24
+recordHeaderSize = 16
+
+# Size of the read buffer used when a PcapStream opens a file by name
+readBufferSize = 1 << 20
+
+
+# Parse the global header at the start of a PCAP file.  Returns the header and the
+# struct used to unpack the 16 byte header in front of every record.
+def parseHeader(raw):
+    if len(raw) != pcapHeaderSize:
+        raise InvalidHeader("PCAP file is too short to hold a header")
+
+    if raw[:4] in (struct.pack('>I', MAGIC_NUMBER), struct.pack('>I', MAGIC_NUMBER_NS)):
+        byteOrder = '>'
+    elif raw[:4] in (struct.pack('<I', MAGIC_NUMBER), struct.pack('<I', MAGIC_NUMBER_NS)):
+        byteOrder = '<'
+    else:
+        raise UnknownMagicNumber("No supported Magic Number found")
+
+    (magic, major, minor, tzOff, tsAcc, snaplen, llType) = struct.unpack(byteOrder + 'IhhIIII', raw)
+    header = __pcap_header__(magic, major, minor, tzOff, tsAcc, snaplen, llType,
+                             ctypes.c_char_p(b'big' if byteOrder == '>' else b'little'),
+                             magic == MAGIC_NUMBER_NS)
+    return header, struct.Struct(byteOrder + 'IIII')
+
+
+class PcapStream(object):
+    """
+    Iterates over the packets of a PCAP file without holding more than one of them
+    in memory.  layers has the same meaning as in savefile.load_savefile.  If
+    zeroCopy is False, payloads are hexified the way load_savefile stores them.
+    """
+
+    # The filter of the raw records, if any, and the number of records it rejected
+    accept = None
+    filtered = 0
+
+    def __init__(self, fp, layers=3, zeroCopy=True):
+        self.fp = fp
+        self.layers = layers
+        self.zeroCopy = zeroCopy
+        self.setHeader(fp.read(pcapHeaderSize))
+
+    # Open a capture by name.  A pcapng capture is read by a PcapngStream instead.
+    @classmethod
+    def open(cls, fname, layers=3, zeroCopy=True):
+        fp = open(fname, 'rb', buffering=readBufferSize)
+        if cls is PcapStream:
+            from pcapng_stream import PcapngStream, isPcapng
+            if isPcapng(fp.peek(4)):
+                return PcapngStream(fp, layers, zeroCopy)
+        return cls(fp, layers, zeroCopy)
+
+    # Parse the global header of the capture and pick the decoder for its link type
+    def setHeader(self, rawHeader):
+        self.rawHeader = rawHeader
+        self.header, self.recordHeader = parseHeader(rawHeader)
+        self.headerPointer = ctypes.pointer(self.header)
+        self.decoder = linklayer.clookup(self.header.ll_type)
+
+    # Yield the header fields and raw bytes of each record without decoding them
+    def records(self):
+        read = self.fp.read
+        unpack = self.recordHeader.unpack
+        while True:
+            raw = read(recordHeaderSize)
+            if len(raw) != recordHeaderSize:
+                return
+            (seconds, fraction, captureLen, packetLen) = unpack(raw)
+            data = read(captureLen)
+            if len(data) != captureLen:
+                # The last record was cut short, e.g. by a byte-count trim of the file
+                return
+            yield seconds, fraction, captureLen, packetLen, data
+
+    # Yield each record decoded into a pcap_packet, as load_savefile would build it
+    def __iter__(self):
+        layers = self.layers - 1
+        decoder = self.decoder
+        zeroCopy = self.zeroCopy
+        accept = self.accept
+        for (seconds, fraction, captureLen, packetLen, data) in self.records():
+            if accept is not None and not accept(data):
+                self.filtered += 1
+                continue
+            if layers >= 0 and decoder:
+                if zeroCopy:
+                    data = memoryview(data)
+                packet = decoder(data, layers=layers)
+            else:
+                packet = data
+            yield pcap_packet(self.headerPointer, seconds, fraction, captureLen, packetLen, packet)
+
+    def close(self):
+        self.fp.close()
+
+    def __repr__(self):
+        string = '%s-endian capture file version %d.%d\n'
+        string += '%ssecond time resolution\n'
+        string += 'snapshot length: %d\n'
+        string += 'linklayer type: %s\n'
+        return string % (self.header.byteorder.decode(), self.header.major, self.header.minor,
+                         "nano" if self.header.ns_resolution else "micro",
+                         self.header.snaplen, linklayer.lookup(self.header.ll_type))
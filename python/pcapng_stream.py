@@ -0,0 +1,220 @@
+# This module reads pcapng captures one packet at a time, the way pcap_stream.py
+# reads classic PCAP files, so captures written as pcapng no longer have to be
+# converted before they can be scored.
+#
+# A pcapng file is a sequence of blocks.  A Section Header Block starts each section
+# and gives its byte order, an Interface Description Block describes each interface
+# the section captured on (its link type, snapshot length and timestamp resolution),
+# and the packets are in Enhanced Packet Blocks, which name their interface, or
+# Simple Packet Blocks, which belong to the first interface.  Every other kind of
+# block is skipped.
+#
+# Each packet is decoded with the link layer decoder of its own interface.  Its data
+# is a memoryview of the block it was read in, so in zero-copy mode nothing is copied
+# after the read.  Timestamps are converted to seconds and nanoseconds whatever the
+# resolution of the interface.
+
+import ctypes
+import os
+import struct
+
+from pcapfile import linklayer, InvalidHeader
+from pcapfile.structs import __pcap_header__, pcap_packet
+from pcap_stream import MAGIC_NUMBER_NS, PcapStream
+
+sectionHeaderBlock = 0x0A0D0D0A
+interfaceBlock = 0x00000001
+simplePacketBlock = 0x00000003
+enhancedPacketBlock = 0x00000006
+
+byteOrderMagic = 0x1A2B3C4D
+
+# Option code of the timestamp resolution of an interface
+tsresolOption = 9
+
+
+# Return True if raw, the first bytes of a file, start a pcapng capture
+def isPcapng(raw):
+    return raw[:4] == struct.pack('<I', sectionHeaderBlock)
+
+
+# Return True if the file fname is a pcapng capture.  Only regular files are looked
+# at, since reading the start of a named pipe would take it from the reader.
+def isPcapngFile(fname):
+    if not os.path.isfile(fname):
+        return False
+    try:
+        with open(fname, 'rb') as fp:
+            return isPcapng(fp.read(4))
+    except OSError:
+        return False
+
+
+class Interface(object):
+    """
+    An interface of a pcapng section: its link type and decoder, its snapshot
+    length, a classic PCAP header describing it (for pcap_packet), and the number
+    of timestamp units in a second.
+    """
+
+    def __init__(self, linkType, snaplen, unitsPerSecond, byteOrder):
+        self.linkType = linkType
+        self.snaplen = snaplen
+        self.unitsPerSecond = unitsPerSecond
+        self.decoder = linklayer.clookup(linkType)
+        self.header = __pcap_header__(MAGIC_NUMBER_NS, 2, 4, 0, 0, snaplen, linkType,
+                                      ctypes.c_char_p(b'big' if byteOrder == '>' else b'little'), True)
+        self.headerPointer = ctypes.pointer(self.header)
+
+    # Split a timestamp in the interface's units into seconds and nanoseconds
+    def timestamp(self, units):
+        (seconds, rest) = divmod(units, self.unitsPerSecond)
+        return seconds, rest * 1000000000 // self.unitsPerSecond
+
+
+# Return the timestamp units per second given by the options of an interface block
+def timestampUnits(options, byteOrder):
+    unpack = struct.Struct(byteOrder + 'HH').unpack_from
+    offset = 0
+    while offset + 4 <= len(options):
+        (code, length) = unpack(options, offset)
+        if code == 0:
+            break
+        if code == tsresolOption and length >= 1:
+            value = options[offset + 4]
+            if value & 0x80:
+                return 1 << (value & 0x7f)
+            return 10 ** value
+        offset += 4 + ((length + 3) & ~3)
+    return 1000000
+
+
+class PcapngStream(PcapStream):
+    """
+    Iterates over the packets of a pcapng file without holding more than one of them
+    in memory.  It yields the same pcap_packet objects as PcapStream, each with a
+    header describing the interface it was captured on, and its timestamp in seconds
+    and nanoseconds.  header, rawHeader and decoder describe the first interface, for
+    code that handles one link type only.
+    """
+
+    def __init__(self, fp, layers=3, zeroCopy=True):
+        self.fp = fp
+        self.layers = layers
+        self.zeroCopy = zeroCopy
+        self.interfaces = []
+        self.interface = None
+        self.byteOrder = '<'
+        if not isPcapng(fp.peek(4) if hasattr(fp, 'peek') else b''):
+            raise InvalidHeader("Not a pcapng file")
+
+        # Read blocks up to the first interface description
+        while not self.interfaces:
+            block = self.readBlock()
+            if block is None:
+                raise InvalidHeader("pcapng file has no interface description")
+            self.handleBlock(*block)
+
+        first = self.interfaces[0]
+        self.header = first.header
+        self.headerPointer = first.headerPointer
+        self.decoder = first.decoder
+        self.rawHeader = struct.pack(self.byteOrder + 'IHHiIII', MAGIC_NUMBER_NS, 2, 4, 0, 0,
+                                     first.snaplen, first.linkType)
+        self.recordHeader = struct.Struct(self.byteOrder + 'IIII')
+
+    # Read the next block.  Returns its type and body, or None at the end of the file
+    # or of the last complete block.
+    def readBlock(self):
+        read = self.fp.read
+        raw = read(8)
+        if len(raw) < 8:
+            return None
+        if struct.unpack('<I', raw[:4])[0] == sectionHeaderBlock:
+            # The byte order of a section is given by its header block
+            magic = read(4)
+            if len(magic) < 4:
+                return None
+            self.byteOrder = '<' if struct.unpack('<I', magic)[0] == byteOrderMagic else '>'
+            (blockType, length) = struct.unpack(self.byteOrder + 'II', raw)
+            body = magic + read(length - 16)
+            if len(read(4)) < 4:
+                return None
+            return blockType, body
+        (blockType, length) = struct.unpack(self.byteOrder + 'II', raw)
+        if length < 12:
+            raise InvalidHeader("pcapng block with a length of %d" % length)
+        body = read(length - 12)
+        if len(body) < length - 12 or len(read(4)) < 4:
+            # The last block was cut short
+            return None
+        return blockType, body
+
+    # Take note of a block that is not a packet.  Returns True if it was one.
+    def handleBlock(self, blockType, body):
+        if blockType == sectionHeaderBlock:
+            self.interfaces = []
+        elif blockType == interfaceBlock:
+            (linkType, reserved, snaplen) = struct.unpack_from(self.byteOrder + 'HHI', body)
+            self.interfaces.append(Interface(linkType, snaplen, timestampUnits(body[8:], self.byteOrder),
+                                             self.byteOrder))
+        else:
+            return False
+        return True
+
+    # Yield the header fields and raw bytes of each packet without decoding them.
+    # Timestamps are in seconds and nanoseconds.  The interface of the packet last
+    # yielded is in the interface attribute.
+    def records(self):
+        while True:
+            block = self.readBlock()
+            if block is None:
+                return
+            (blockType, body) = block
+            if blockType == enhancedPacketBlock:
+                (interfaceId, high, low, captureLen, packetLen) = struct.unpack_from(self.byteOrder + 'IIIII', body)
+                interface = self.interfaces[interfaceId]
+                (seconds, fraction) = interface.timestamp((high << 32) | low)
+                data = memoryview(body)[20:20 + captureLen]
+            elif blockType == simplePacketBlock:
+                packetLen = struct.unpack_from(self.byteOrder + 'I', body)[0]
+                interface = self.interfaces[0]
+                captureLen = min(packetLen, len(body) - 4)
+                if interface.snaplen:
+                    captureLen = min(captureLen, interface.snaplen)
+                (seconds, fraction) = (0, 0)
+                data = memoryview(body)[4:4 + captureLen]
+            else:
+                self.handleBlock(blockType, body)
+                continue
+            self.interface = interface
+            yield seconds, fraction, captureLen, packetLen, data
+
+    # Return True if the packet last read, whose frame is data, passes the filter.
+    # The filter reads the frame at the offsets of the link type of the first
+    # interface, so packets of interfaces of any other link type are filtered out.
+    def accepted(self, data):
+        return self.interface.linkType == self.header.ll_type and self.accept(data)
+
+    # Yield each packet decoded with the decoder of its interface into a pcap_packet
+    def __iter__(self):
+        layers = self.layers - 1
+        zeroCopy = self.zeroCopy
+        accept = self.accept
+        for (seconds, fraction, captureLen, packetLen, data) in self.records():
+            if accept is not None and not self.accepted(data):
+                self.filtered += 1
+                continue
+            interface = self.interface
+            if layers >= 0 and interface.decoder:
+                packet = interface.decoder(data if zeroCopy else bytes(data), layers=layers)
+            else:
+                packet = bytes(data)
+            yield pcap_packet(interface.headerPointer, seconds, fraction, captureLen, packetLen, packet)
+
+    def __repr__(self):
+        string = 'pcapng capture file, %s-endian\n' % ('big' if self.byteOrder == '>' else 'little')
+        for (i, interface) in enumerate(self.interfaces):
+            string += 'interface %d: linklayer type %s, snapshot length %d, %d timestamp units per second\n' % (
+                i, linklayer.lookup(interface.linkType), interface.snaplen, interface.unitsPerSecond)
+        return string
@@ -0,0 +1,220 @@
+# This module overlaps the decoding of packets with their scoring.  Parser processes
+# decode blocks of raw PCAP records with the batch decoder of batch_parse.py, straight
+# into slots of shared memory, while the process that reads the file scores the
+# packets of the blocks already decoded with the same scoreField and processField as
+# the rest of anomaly_detect.py.  Only the raw bytes of a block and the number of the
+# slot to decode it into pass through a queue; the decoded columns never do.
+#
+# Blocks are numbered as they are read and scored in that order, whichever parser
+# finishes first.  Every block in flight holds a slot, so the number of slots bounds
+# how far reading and parsing can run ahead of scoring.
+#
+# The fields of each packet are handed to the scorer in the [name, value] form that
+# parsePacket returns, with addresses as dotted-quad bytes, so for IPv4 traffic the
+# scores, the reports and saved models are the same as those of the per-packet mode.
+# The batch decoder only decodes IPv4, so other packets have no fields and are never
+# anomalous.
+#
+# A parser that fails sends its exception back, and the pool stops the other parsers
+# and raises it from nextBatch; a parser that dies without sending one is noticed by
+# polling, and the run fails the same way.
+#
+# This module requires NumPy.
+
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from batch_parse import batchDtype, decodeFrames, splitRecords
+from fields import addressFields, batchFields, fieldsByName, formatAddress, transportProtocols
+from pcap_stream import recordHeaderSize
+
+blockSize = 1 << 20
+
+# Seconds to wait on a queue before checking that the parsers are still running
+pollInterval = 1.0
+
+
+# Body of a parser process.  Decodes the blocks it is sent into their slots until it
+# is sent None, and puts the block number, slot and number of packets of each on done.
+# If it fails, it puts None, None and the exception instead.
+def parser(recordHeader, names, slots, tasks, done):
+    try:
+        runParser(recordHeader, names, slots, tasks, done)
+    except Exception as err:
+        done.put((None, None, err))
+        raise
+
+
+def runParser(recordHeader, names, slots, tasks, done):
+    dtype = batchDtype(names)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (blockNumber, slot, block) = task
+        (starts, lengths, timestamps, used) = splitRecords(block, recordHeader)
+        out = np.ndarray(len(starts), dtype=dtype, buffer=slots[slot].buf)
+        decodeFrames(block, starts, lengths, names, out)
+        done.put((blockNumber, slot, len(starts)))
+
+
+class ParserPool(object):
+    """
+    Reads a PcapStream in blocks and decodes them in the given number of parser
+    processes.  fields() yields the fields of each packet in order.
+    """
+
+    def __init__(self, stream, names, parsers=1, slots=None):
+        self.stream = stream
+        self.names = batchFields(names)
+        self.dtype = batchDtype(names)
+        # A block holds at most one packet per record header
+        slotSize = (blockSize // recordHeaderSize) * self.dtype.itemsize
+        self.slots = [shared_memory.SharedMemory(create=True, size=slotSize)
+                      for i in range(slots if slots else 2 * parsers + 2)]
+        self.freeSlots = list(range(len(self.slots)))
+
+        self.tasks = multiprocessing.Queue(len(self.slots))
+        self.done = multiprocessing.Queue()
+        self.processes = []
+        for i in range(parsers):
+            process = multiprocessing.Process(target=parser, args=(stream.recordHeader, names, self.slots,
+                                                                  self.tasks, self.done))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        self.leftover = b''
+        self.eof = False
+        self.sentBlocks = 0
+        self.nextBlock = 0
+        self.ready = {}
+
+        # Names of the fields of each layer
+        self.ipNames = [name for name in names if fieldsByName[name].protocol == 'IPv4']
+        self.transportNames = dict((number, [name for name in names if fieldsByName[name].protocol == protocol])
+                                   for (protocol, number) in transportProtocols.items())
+
+    # Read the next block of whole records and send it to the parsers in a free slot.
+    # Returns False at the end of the file.
+    def sendBlock(self):
+        while not self.eof:
+            chunk = self.stream.fp.read(blockSize - len(self.leftover))
+            if not chunk:
+                self.eof = True
+                break
+            block = self.leftover + chunk if self.leftover else chunk
+            used = splitRecords(block, self.stream.recordHeader)[3]
+            self.leftover = block[used:]
+            if used:
+                self.put((self.sentBlocks, self.freeSlots.pop(), block[:used]))
+                self.sentBlocks += 1
+                return True
+            if len(self.leftover) >= blockSize:
+                # A record that does not fit in a block; the capture is damaged
+                self.eof = True
+        return False
+
+    # Return the decoded batch of the next block, or None after the last block.  The
+    # batch is a view of its slot, which is reused once the next batch is asked for.
+    def nextBatch(self):
+        while self.freeSlots and self.sendBlock():
+            pass
+        if self.nextBlock == self.sentBlocks:
+            return None
+        while self.nextBlock not in self.ready:
+            try:
+                (blockNumber, slot, count) = self.done.get(timeout=pollInterval)
+            except queue.Empty:
+                self.checkParsers()
+                continue
+            self.addResult(blockNumber, slot, count)
+        (slot, count) = self.ready.pop(self.nextBlock)
+        self.nextBlock += 1
+        self.freeSlots.append(slot)
+        return np.ndarray(count, dtype=self.dtype, buffer=self.slots[slot].buf)
+
+    # Keep the slot and packet count of a block a parser finished, or raise the error
+    # it sent
+    def addResult(self, blockNumber, slot, count):
+        if blockNumber is None:
+            self.terminate()
+            raise count
+        self.ready[blockNumber] = (slot, count)
+
+    # Put an item on the task queue, checking that the parsers are alive while it is
+    # full
+    def put(self, item):
+        while True:
+            try:
+                self.tasks.put(item, timeout=pollInterval)
+                return
+            except queue.Full:
+                self.checkParsers()
+
+    # Fail if a parser has exited.  The error it sent, if any, is raised.
+    def checkParsers(self):
+        dead = [process for process in self.processes if not process.is_alive()]
+        if not dead:
+            return
+        while True:
+            try:
+                self.addResult(*self.done.get(timeout=pollInterval))
+            except queue.Empty:
+                break
+        self.terminate()
+        raise RuntimeError("Parser process %d exited with code %s" % (dead[0].pid, dead[0].exitcode))
+
+    # Stop every parser that is still running and free the slots.  Blocks not yet
+    # taken from the task queue are dropped, so that exiting does not wait to flush
+    # them.
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        self.tasks.cancel_join_thread()
+        self.freeMemory()
+
+    # Yield the fields of every packet in the [name, value] form parsePacket returns
+    # them; packets that are not IPv4 have no fields
+    def fields(self):
+        while True:
+            batch = self.nextBatch()
+            if batch is None:
+                return
+            columns = dict((name, batch[name].tolist()) for name in self.names)
+            for name in addressFields:
+                if name in columns:
+                    columns[name] = [formatAddress(address) for address in columns[name]]
+            ipColumns = [(name, columns[name]) for name in self.ipNames]
+            transportColumns = dict((number, [(name, columns[name]) for name in names])
+                                    for (number, names) in self.transportNames.items())
+            ipv4 = batch['ipv4'].tolist()
+            l4 = batch['l4'].tolist()
+            del batch
+            for i in range(len(ipv4)):
+                if not ipv4[i]:
+                    yield []
+                    continue
+                fields = [[name, column[i]] for (name, column) in ipColumns]
+                if l4[i]:
+                    fields += [[name, column[i]] for (name, column) in transportColumns[l4[i]]]
+                yield fields
+
+    def close(self):
+        for process in self.processes:
+            self.put(None)
+        for process in self.processes:
+            process.join()
+        self.freeMemory()
+
+    def freeMemory(self):
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+        self.slots = []
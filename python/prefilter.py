@@ -0,0 +1,238 @@
+# This module compiles a filter expression into a function that decides from the raw
+# bytes of an Ethernet frame whether the packet is looked at at all.  The readers call
+# it before decoding, so a packet that is filtered out costs a comparison or two of
+# header bytes instead of a decode of every layer, and frames the detector cannot
+# decode (PPPoE, for example) can be left out before they are decoded.
+#
+# The language is a small part of the one of tcpdump:
+#
+#   ip, ip6, arp, vlan          the ethertype (after one VLAN tag, if there is one)
+#   ether proto N               any other ethertype
+#   tcp, udp, udplite, icmp,
+#   icmp6, proto N              the IP protocol (of IPv4, or the next header of IPv6)
+#   [src|dst] port N[-M]        a TCP, UDP or UDP-Lite port or range of ports
+#   [src|dst] host ADDRESS      an IPv4 or IPv6 address
+#   [src|dst] net ADDRESS/BITS  an IPv4 or IPv6 network
+#
+# combined with not, and, or (or !, &&, ||) and parentheses.  Without src or dst a
+# port, host or net matches either.  Numbers may be given in hex as 0x...
+#
+# An expression is translated to the source of a Python function that reads the
+# ethertype and the offset of the network header and then tests the header bytes at
+# fixed offsets from there, with the and/or of the expression short-circuiting.  The
+# IPv6 protocol is the next header field, and the ports the ones just after the
+# fixed header; extension headers are not followed.  IPv4 fragments after the first
+# have no ports.  A frame too short to hold a field that is tested is filtered out.
+
+import ipaddress
+import re
+import struct
+
+# The values of the names of ethertypes and IP protocols
+ethertypeNames = {'ip': 0x0800, 'arp': 0x0806, 'ip6': 0x86DD}
+protocolNames = {'icmp': 1, 'tcp': 6, 'udp': 17, 'icmp6': 58, 'udplite': 136}
+
+# The IP protocols that have ports, and the ethertype of a VLAN tag
+portProtocols = (6, 17, 136)
+vlanType = 0x8100
+
+tokenPattern = re.compile(r'\s*(\(|\)|&&|\|\||!|[^\s()!&|]+)')
+
+# The function header and the code that reads the ethertype and network header offset,
+# and the code that reads the IP protocol and the transport header offset
+prologue = '''def accept(d):
+    try:
+        et = d[12] << 8 | d[13]
+        o = 14
+        if et == %d:
+            et = d[16] << 8 | d[17]
+            o = 18
+''' % vlanType
+transportPrologue = '''        if et == 0x0800:
+            p = d[o + 9]
+            t = -1 if d[o + 6] & 0x1f or d[o + 7] else o + (d[o] & 15) * 4
+        elif et == 0x86DD:
+            p = d[o + 6]
+            t = o + 40
+        else:
+            p = t = -1
+'''
+epilogue = '''        return %s
+    except (IndexError, struct.error):
+        return False
+'''
+
+
+# Return the IPv6 address at an offset of a frame as an integer.  A slice does not
+# fail the way u32 does on a frame that is too short, so the length is checked.
+def u128(d, offset):
+    if len(d) < offset + 16:
+        raise IndexError("Frame too short for an IPv6 address")
+    return int.from_bytes(d[offset:offset + 16], 'big')
+
+
+# Split an expression into tokens
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = tokenPattern.match(text, position)
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+# Return the value of a number given in decimal or hex
+def number(token):
+    try:
+        return int(token, 0)
+    except ValueError:
+        raise ValueError("Expected a number in filter, found " + repr(token))
+
+
+class Compiler(object):
+    """
+    Translates the tokens of a filter expression to a Python expression over the
+    frame d, its ethertype et and network header offset o, and, if usesTransport is
+    set, its IP protocol p and transport header offset t.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.usesTransport = False
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("Filter ends too soon")
+        self.position += 1
+        return token
+
+    def compile(self):
+        if not self.tokens:
+            raise ValueError("Filter is empty")
+        code = self.orExpression()
+        if self.peek() is not None:
+            raise ValueError("Unexpected " + repr(self.peek()) + " in filter")
+        return code
+
+    def orExpression(self):
+        terms = [self.andExpression()]
+        while self.peek() in ('or', '||'):
+            self.take()
+            terms.append(self.andExpression())
+        return terms[0] if len(terms) == 1 else '(' + ' or '.join(terms) + ')'
+
+    def andExpression(self):
+        terms = [self.notExpression()]
+        while self.peek() in ('and', '&&'):
+            self.take()
+            terms.append(self.notExpression())
+        return terms[0] if len(terms) == 1 else '(' + ' and '.join(terms) + ')'
+
+    def notExpression(self):
+        token = self.peek()
+        if token in ('not', '!'):
+            self.take()
+            return '(not ' + self.notExpression() + ')'
+        if token == '(':
+            self.take()
+            code = self.orExpression()
+            if self.take() != ')':
+                raise ValueError("Missing ) in filter")
+            return code
+        return self.primitive()
+
+    def primitive(self):
+        token = self.take()
+        if token in ethertypeNames:
+            return '(et == 0x%04x)' % ethertypeNames[token]
+        if token == 'vlan':
+            return '(o == 18)'
+        if token == 'ether':
+            if self.take() != 'proto':
+                raise ValueError("Expected 'proto' after 'ether' in filter")
+            return '(et == 0x%04x)' % number(self.take())
+        if token in protocolNames or token == 'proto':
+            self.usesTransport = True
+            protocol = protocolNames[token] if token in protocolNames else self.protocol(self.take())
+            return '(p == %d)' % protocol
+
+        direction = None
+        if token in ('src', 'dst'):
+            (direction, token) = (token, self.take())
+        if token == 'port':
+            return self.port(direction, self.take())
+        if token in ('host', 'net'):
+            return self.address(direction, token, self.take())
+        raise ValueError("Unknown filter primitive " + repr(token))
+
+    def protocol(self, token):
+        return protocolNames[token] if token in protocolNames else number(token)
+
+    # Return the test of a port or range of ports
+    def port(self, direction, token):
+        self.usesTransport = True
+        (low, dash, high) = token.partition('-')
+        (low, high) = (number(low), number(high) if dash else number(low))
+        if not 0 <= low <= high <= 0xffff:
+            raise ValueError("Bad port range " + repr(token) + " in filter")
+        tests = []
+        for offset in (['t'] if direction != 'dst' else []) + (['t + 2'] if direction != 'src' else []):
+            value = 'd[%s] << 8 | d[%s + 1]' % (offset, offset)
+            if low == high:
+                tests.append('(%s) == %d' % (value, low))
+            else:
+                tests.append('%d <= (%s) <= %d' % (low, value, high))
+        test = tests[0] if len(tests) == 1 else '(' + ' or '.join(tests) + ')'
+        return '(t >= 0 and p in %r and %s)' % (portProtocols, test)
+
+    # Return the test of an IPv4 or IPv6 host or network
+    def address(self, direction, kind, token):
+        try:
+            network = ipaddress.ip_network(token, strict=False)
+        except ValueError:
+            raise ValueError("Bad address " + repr(token) + " in filter")
+        if kind == 'host' and network.num_addresses != 1:
+            raise ValueError("Use 'net' for the network " + repr(token) + " in filter")
+        (net, mask) = (int(network.network_address), int(network.netmask))
+        if network.version == 4:
+            (ethertype, offsets, value) = (0x0800, (12, 16), 'u32(d, o + %d)[0]')
+        else:
+            (ethertype, offsets, value) = (0x86DD, (8, 24), 'u128(d, o + %d)')
+        if direction == 'src':
+            offsets = offsets[:1]
+        elif direction == 'dst':
+            offsets = offsets[1:]
+        tests = []
+        for offset in offsets:
+            field = value % offset
+            if mask == (1 << network.max_prefixlen) - 1:
+                tests.append('%s == %d' % (field, net))
+            else:
+                tests.append('%s & %d == %d' % (field, mask, net))
+        test = tests[0] if len(tests) == 1 else '(' + ' or '.join(tests) + ')'
+        return '(et == 0x%04x and %s)' % (ethertype, test)
+
+
+# Return the source of the function a filter expression compiles to
+def filterSource(text):
+    compiler = Compiler(tokenize(text))
+    code = compiler.compile()
+    return prologue + (transportPrologue if compiler.usesTransport else '') + epilogue % code
+
+
+# Compile a filter expression into a function that takes the raw bytes of an Ethernet
+# frame and returns True if the packet passes the filter.  Raises ValueError if the
+# expression is not valid.
+def compileFilter(text):
+    namespace = {'struct': struct, 'u32': struct.Struct('!I').unpack_from, 'u128': u128}
+    exec(compile(filterSource(text), '<filter>', 'exec'), namespace)
+    accept = namespace['accept']
+    accept.expression = text
+    return accept
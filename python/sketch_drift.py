@@ -0,0 +1,78 @@
+# This script measures how far the scores of the bounded-memory mode of
+# anomaly_detect.py (--memory-limit) drift from the scores of the exact mode.  Each
+# PCAP file is scored twice, once with the exact ValueTable and once with a
+# SketchTable of the given size, and the per-packet anomaly scores are compared.
+#
+# Run it on the sample captures with, for example:
+# python sketch_drift.py --memory-limit 0.02 --max-training 100 ../pcap/*.pcap
+
+import argparse
+
+import anomaly_detect as ad
+from pcap_stream import PcapStream
+from sketch_store import SketchTable
+from state_store import FieldTable, ValueTable
+
+
+# Train on and check the packets of a PCAP file with the given valueData table.
+# Returns the (anomalies, anomaly score) pair of every packet checked after training.
+def scoreCapture(fname, valueData):
+    ad.fieldData = FieldTable()
+    ad.valueData = valueData
+    ad.numPackets = 0
+
+    results = []
+    pcap = PcapStream.open(fname)
+    for packet in pcap:
+        fields = ad.parsePacket(packet)
+        ad.numPackets += 1
+        if ad.numPackets <= ad.maxTraining:
+            for field in fields:
+                ad.processField(field)
+        else:
+            results.append(ad.checkPacket(fields))
+        if ad.numPackets >= ad.maxPackets:
+            break
+    pcap.close()
+    return results
+
+
+# Score a PCAP file in both modes and print how the bounded scores differ
+def compare(fname, memoryLimit):
+    exactTable = ValueTable()
+    exact = scoreCapture(fname, exactTable)
+    boundedTable = SketchTable.fromMemoryLimit(memoryLimit)
+    bounded = scoreCapture(fname, boundedTable)
+
+    diffs = [abs(e[1] - b[1]) for (e, b) in zip(exact, bounded)]
+    exactFlags = [e[0] > 0 for e in exact]
+    boundedFlags = [b[0] > 0 for b in bounded]
+    missed = sum(1 for (e, b) in zip(exactFlags, boundedFlags) if e and not b)
+    extra = sum(1 for (e, b) in zip(exactFlags, boundedFlags) if b and not e)
+
+    print(fname)
+    print("  packets checked = ", len(exact))
+    print("  anomalies exact = ", sum(exactFlags), " bounded = ", sum(boundedFlags),
+          " missed = ", missed, " extra = ", extra)
+    if diffs:
+        print("  score drift mean = %.6f max = %.6f" % (sum(diffs) / len(diffs), max(diffs)))
+    print("  valueData bytes exact = ", exactTable.memoryUsage(), " bounded = ", boundedTable.memoryUsage(),
+          " values exact = ", len(exactTable), " evictions = ", boundedTable.evictions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare bounded-memory scores with exact scores")
+    parser.add_argument("infiles", nargs='+', help="PCAP files to score")
+    parser.add_argument("--memory-limit", type=float, default=0.02,
+                        help="megabytes for the bounded-memory valueData (default 0.02)")
+    parser.add_argument("--max-training", type=int, default=ad.maxTraining,
+                        help="number of packets to train on (default %d)" % ad.maxTraining)
+    args = parser.parse_args()
+
+    ad.maxTraining = args.max_training
+    for fname in args.infiles:
+        compare(fname, int(args.memory_limit * 1000000))
+
+
+if __name__ == '__main__':
+    main()
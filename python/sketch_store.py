@@ -0,0 +1,155 @@
+# This module holds the valueData state of the detector in a fixed amount of memory,
+# for sensors that run long enough for the exact ValueTable in state_store.py to grow
+# without bound (every distinct ip_id, sequence number and address adds an entry).
+#
+# The count of each value comes from a Count-Min sketch: a few rows of counters, each
+# indexed by a different hash of the key, where a value's count is the smallest of
+# its counters.  Counts can only be overestimated, by collisions with other keys;
+# conservative update (raising only the counters that are at the minimum) keeps the
+# overestimate small.  The counters are 32 bits wide to fit twice as many in the same
+# memory, and stop at 2**32 - 1 instead of wrapping; a value seen that often is
+# normal whatever its exact count.
+#
+# The packet each value was last seen in is kept in a set-associative table: a key
+# can only live in one of the ways of the bucket its hash picks, and when a bucket is
+# full the entry that was seen longest ago is evicted.  A value that has been evicted
+# looks as if it was last seen at packet 0, so its time score is the maximum, which is
+# what it would be anyway once it has not been seen for maxTraining packets.
+#
+# SketchTable has the same state() and add() methods as ValueTable, so scoreField and
+# processField in anomaly_detect.py work with either.
+
+import array
+import zlib
+
+from state_store import fieldShift, hashMultiplier, internBit, mask64, valueLimit
+
+# A second multiplier for double hashing: row j of the sketch uses h1 + j * h2
+hashMultiplier2 = 0xC2B2AE3D27D4EB4F
+
+sketchDepth = 4
+counterLimit = (1 << 32) - 1
+tableWays = 4
+
+
+class SketchTable(object):
+    """
+    Bounded-memory replacement for ValueTable.  sketchWidth is the number of counters
+    in each row of the Count-Min sketch and tableBuckets the number of buckets of the
+    last-seen table; both are rounded up to powers of two.
+    """
+
+    def __init__(self, sketchWidth, tableBuckets):
+        self.widthBits = max(sketchWidth - 1, 1).bit_length()
+        self.widthMask = (1 << self.widthBits) - 1
+        self.counters = array.array('I', bytes(4 * sketchDepth << self.widthBits))
+
+        bucketBits = max(tableBuckets - 1, 1).bit_length()
+        self.bucketShift = 64 - bucketBits
+        self.keys = array.array('Q', bytes(8 * tableWays << bucketBits))
+        self.last = array.array('Q', bytes(8 * tableWays << bucketBits))
+        self.size = 0
+        self.evictions = 0
+
+    # Make a table holding size values from existing arrays (or memoryviews cast to
+    # the same types), e.g. those of a saved snapshot
+    @classmethod
+    def fromArrays(cls, counters, keys, last, size):
+        table = cls.__new__(cls)
+        table.widthBits = (len(counters) // sketchDepth).bit_length() - 1
+        table.widthMask = (1 << table.widthBits) - 1
+        table.counters = counters
+        table.bucketShift = 64 - ((len(keys) // tableWays).bit_length() - 1)
+        (table.keys, table.last) = (keys, last)
+        table.size = size
+        table.evictions = 0
+        return table
+
+    # Size the sketch and the table to use about memoryLimit bytes in total, half for
+    # each
+    @classmethod
+    def fromMemoryLimit(cls, memoryLimit):
+        width = max(memoryLimit // 2 // (4 * sketchDepth), 2)
+        buckets = max(memoryLimit // 2 // (16 * tableWays), 2)
+        # Round down so the limit is not exceeded
+        return cls(1 << (width.bit_length() - 1), 1 << (buckets.bit_length() - 1))
+
+    # Return the key of a value of the field with id fid.  Values that are not small
+    # integers are hashed instead of numbered, so no table of them has to be kept.
+    # The hash is a CRC rather than hash(), which changes from one run to the next,
+    # so that the keys of a saved snapshot still match after a restart.
+    def key(self, fid, value):
+        if value.__class__ is int and 0 <= value < valueLimit:
+            return (fid << fieldShift) | value
+        if value.__class__ is not bytes:
+            value = repr(value).encode('utf-8')
+        return (fid << fieldShift) | internBit | zlib.crc32(value)
+
+    # Return the offsets of a key's counters in the sketch
+    def counterOffsets(self, key):
+        h1 = (key * hashMultiplier) & mask64
+        h2 = ((key * hashMultiplier2) & mask64) | 1
+        bits = self.widthBits
+        mask = self.widthMask
+        return [(j << bits) | (((h1 + j * h2) >> 32) & mask) for j in range(sketchDepth)]
+
+    # Return the ways of the bucket a key belongs in
+    def bucket(self, key):
+        start = (((key * hashMultiplier2) & mask64) >> self.bucketShift) * tableWays
+        return range(start, start + tableWays)
+
+    # Return the packet a value of field fid was last seen in (0 if it is not in the
+    # table) and the estimated number of times it has been seen
+    def state(self, fid, value):
+        key = self.key(fid, value)
+        counters = self.counters
+        count = min(counters[i] for i in self.counterOffsets(key))
+        if not count:
+            return 0, 0
+        keys = self.keys
+        for i in self.bucket(key):
+            if keys[i] == key:
+                return self.last[i], count
+        return 0, count
+
+    # Record that a value of the field with id fid was seen in packet last
+    def add(self, fid, value, last):
+        key = self.key(fid, value)
+
+        # Conservative update of the sketch
+        counters = self.counters
+        offsets = self.counterOffsets(key)
+        count = min(counters[i] for i in offsets) + 1
+        if count <= counterLimit:
+            for i in offsets:
+                if counters[i] < count:
+                    counters[i] = count
+
+        # Update the key's entry, or replace the empty or oldest entry of its bucket
+        keys = self.keys
+        lastSeen = self.last
+        oldest = -1
+        for i in self.bucket(key):
+            k = keys[i]
+            if k == key:
+                lastSeen[i] = last
+                return
+            if not k:
+                oldest = i
+                break
+            if oldest < 0 or lastSeen[i] < lastSeen[oldest]:
+                oldest = i
+        if keys[oldest]:
+            self.evictions += 1
+        else:
+            self.size += 1
+        keys[oldest] = key
+        lastSeen[oldest] = last
+
+    # Number of values in the last-seen table
+    def __len__(self):
+        return self.size
+
+    # Return the number of bytes used by the sketch and the table
+    def memoryUsage(self):
+        return sum(a.itemsize * len(a) for a in (self.counters, self.keys, self.last))
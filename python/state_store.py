@@ -0,0 +1,217 @@
+# This module holds the fieldData and valueData state of the detector in compact
+# integer-keyed tables instead of dictionaries keyed by strings.
+#
+# Every field name gets a small integer id, and a value of a field is identified by
+# one 64 bit key that packs the field id above the value.  Building a key costs a
+# shift and an or instead of the string str(fldKey) + str(fldVal), and two fields can
+# no longer collide the way "ip_ttl" + "64" could with a field name ending in a digit.
+#
+# Key layout: bits 48-63 hold the field id, bits 0-46 hold the value.  Values that
+# are not integers below 2**47 (for example addresses given as dotted-quad bytes) are
+# numbered as they are first seen and stored with bit 47 set.
+#
+# ValueTable is an open-addressing hash table with linear probing.  The keys, the
+# packet each value was last seen in and the number of times it has been seen are
+# kept in three parallel arrays of 64 bit integers, so each value costs 24 bytes per
+# slot (35-70 bytes per value, as the table is kept between 35% and 70% full)
+# instead of a string, a list and its integers.  A value that is interned also keeps
+# its object and an entry in the Python dictionary valueIds, typically 100 bytes or
+# more per distinct value on top of its slot.
+
+import array
+
+fieldShift = 48
+internBit = 1 << 47
+valueLimit = 1 << 47
+
+# Fibonacci hashing: multiply by 2**64 / golden ratio and keep the top bits
+hashMultiplier = 0x9E3779B97F4A7C15
+mask64 = (1 << 64) - 1
+
+# The table doubles when more than this fraction of its slots are in use
+maxLoad = 0.7
+
+
+class FieldIds(dict):
+    """
+    Dictionary from field names to ids that gives a new name the next id the first
+    time it is looked up, so ids[name] never raises KeyError.
+    """
+
+    def __init__(self, table):
+        super(FieldIds, self).__init__()
+        self.table = table
+
+    def __missing__(self, name):
+        return self.table.add(name)
+
+
+class FieldTable(object):
+    """
+    Maps field names to small integer ids and keeps the packet each field was last
+    seen in and the number of times it has been seen, indexed by id.  Ids start at 1
+    so that no key is ever 0.  ids[name] returns the id of a name.
+    """
+
+    def __init__(self):
+        self.ids = FieldIds(self)
+        self.names = [None]
+        self.last = array.array('Q', [0])
+        self.count = array.array('Q', [0])
+
+    # Give a new field name the next id and return it
+    def add(self, name):
+        fid = len(self.names)
+        self.ids[name] = fid
+        self.names.append(name)
+        self.last.append(0)
+        self.count.append(0)
+        return fid
+
+    def __len__(self):
+        return len(self.names) - 1
+
+    # Yield (name, last seen, count) for every field that has been seen
+    def items(self):
+        for fid in range(1, len(self.names)):
+            if self.count[fid]:
+                yield self.names[fid], self.last[fid], self.count[fid]
+
+
+class ValueTable(object):
+    """
+    Open-addressing hash table from 64 bit (field id, value) keys to the packet the
+    value was last seen in and the number of times it has been seen.  A key of 0
+    marks an empty slot.  find returns the slot of a value, and the caller reads
+    the last and count arrays at that slot; state returns both at once.
+    """
+
+    def __init__(self, capacity=1 << 16):
+        self.size = 0
+        self.valueIds = {}
+        self.allocate(max(capacity - 1, 1).bit_length())
+
+    # Make a table holding size values from existing slot arrays (or memoryviews cast
+    # to the same types) and the dictionary of interned values, e.g. those of a saved
+    # snapshot
+    @classmethod
+    def fromArrays(cls, keys, last, count, size, valueIds):
+        table = cls.__new__(cls)
+        bits = len(keys).bit_length() - 1
+        table.shift = 64 - bits
+        table.mask = len(keys) - 1
+        table.limit = int(len(keys) * maxLoad)
+        (table.keys, table.last, table.count) = (keys, last, count)
+        table.size = size
+        table.valueIds = valueIds
+        return table
+
+    def allocate(self, bits):
+        slots = 1 << bits
+        self.shift = 64 - bits
+        self.mask = slots - 1
+        self.limit = int(slots * maxLoad)
+        self.keys = array.array('Q', bytes(8 * slots))
+        self.last = array.array('Q', bytes(8 * slots))
+        self.count = array.array('Q', bytes(8 * slots))
+
+    # Return the key of a value of the field with id fid
+    def key(self, fid, value):
+        if value.__class__ is int and 0 <= value < valueLimit:
+            return (fid << fieldShift) | value
+        vid = self.valueIds.get(value)
+        if vid is None:
+            vid = len(self.valueIds)
+            self.valueIds[value] = vid
+        return (fid << fieldShift) | internBit | vid
+
+    # Return the slot holding a value of the field with id fid, or -1 if the value
+    # is not in the table
+    def find(self, fid, value):
+        if value.__class__ is int and 0 <= value < valueLimit:
+            key = (fid << fieldShift) | value
+        else:
+            key = self.key(fid, value)
+        keys = self.keys
+        i = ((key * hashMultiplier) & mask64) >> self.shift
+        k = keys[i]
+        while k != key:
+            if not k:
+                return -1
+            i = (i + 1) & self.mask
+            k = keys[i]
+        return i
+
+    # Return the packet a value of the field with id fid was last seen in and the
+    # number of times it has been seen, or (0, 0) if it has not been seen
+    def state(self, fid, value):
+        if value.__class__ is int and 0 <= value < valueLimit:
+            key = (fid << fieldShift) | value
+        else:
+            key = self.key(fid, value)
+        keys = self.keys
+        i = ((key * hashMultiplier) & mask64) >> self.shift
+        k = keys[i]
+        while k != key:
+            if not k:
+                return 0, 0
+            i = (i + 1) & self.mask
+            k = keys[i]
+        return self.last[i], self.count[i]
+
+    # Record that a value of the field with id fid was seen in packet last, adding
+    # the value to the table if it is new.  Returns its slot.
+    def add(self, fid, value, last):
+        if value.__class__ is int and 0 <= value < valueLimit:
+            key = (fid << fieldShift) | value
+        else:
+            key = self.key(fid, value)
+        keys = self.keys
+        i = ((key * hashMultiplier) & mask64) >> self.shift
+        k = keys[i]
+        while k != key:
+            if not k:
+                return self.insert(key, last, 1)
+            i = (i + 1) & self.mask
+            k = keys[i]
+        self.last[i] = last
+        self.count[i] += 1
+        return i
+
+    # Add a key that is not in the table and return its slot
+    def insert(self, key, last, count):
+        if self.size >= self.limit:
+            self.grow()
+        keys = self.keys
+        mask = self.mask
+        i = ((key * hashMultiplier) & mask64) >> self.shift
+        while keys[i]:
+            i = (i + 1) & mask
+        keys[i] = key
+        self.last[i] = last
+        self.count[i] = count
+        self.size += 1
+        return i
+
+    # Double the number of slots and rehash every key
+    def grow(self):
+        (keys, last, count) = (self.keys, self.last, self.count)
+        self.allocate(64 - self.shift + 1)
+        self.size = 0
+        for i in range(len(keys)):
+            if keys[i]:
+                self.insert(keys[i], last[i], count[i])
+
+    def __len__(self):
+        return self.size
+
+    # Yield (key, last seen, count) for every value in the table
+    def items(self):
+        keys = self.keys
+        for i in range(len(keys)):
+            if keys[i]:
+                yield keys[i], self.last[i], self.count[i]
+
+    # Return the number of bytes used by the slot arrays
+    def memoryUsage(self):
+        return sum(a.itemsize * len(a) for a in (self.keys, self.last, self.count))
@@ -0,0 +1,185 @@
+# This script trims a PCAP capture that is too big to work with, such as
+# maccdc2012_00000.pcap from https://www.netresec.com/?page=MACCDC, or splits one into
+# shards that can be checked in parallel.  It replaces trim_file.py, which copied a
+# given number of bytes 100 at a time and so usually cut the last record in two.
+#
+# The capture is memory mapped and only the 16 byte record headers are read to find
+# the records to keep.  The records kept by a trim, or those of a shard, are always
+# consecutive, so each output file is the PCAP header followed by one range of the
+# input, which is copied with os.sendfile (or in large chunks where that is not
+# available).  Every output file ends on a record boundary.
+#
+# Run it with, for example:
+# python trim_capture.py big.pcap small.pcap --packets 10000
+# python trim_capture.py big.pcap small.pcap --bytes 10000000
+# python trim_capture.py big.pcap hour.pcap --start-time 1331900000 --end-time 1331903600
+# python trim_capture.py big.pcap shard.pcap --split 4
+
+import argparse
+import mmap
+import os
+
+from pcap_stream import parseHeader, pcapHeaderSize, recordHeaderSize
+
+# Bytes copied at a time when os.sendfile cannot be used
+copyChunkSize = 1 << 24
+
+
+# Yield the offset, the end offset and the timestamp in nanoseconds of every complete
+# record of a mapped capture
+def scanRecords(data, recordHeader, tsScale):
+    unpack = recordHeader.unpack_from
+    size = len(data)
+    offset = pcapHeaderSize
+    while offset + recordHeaderSize <= size:
+        (seconds, fraction, captureLen, packetLen) = unpack(data, offset)
+        end = offset + recordHeaderSize + captureLen
+        if end > size:
+            # The last record was cut short
+            return
+        yield offset, end, seconds * 1000000000 + fraction * tsScale
+        offset = end
+
+
+# Return the start and end offsets and the number of the records to keep: those
+# captured from startTime up to endTime, less the first skip of them, and then at
+# most numPackets of them, or as many as fit in a file of maxBytes bytes.  Records
+# are expected in time order, as they are in the captures tcpdump writes.
+def selectRecords(data, recordHeader, tsScale, skip=0, numPackets=None, maxBytes=None, startTime=None,
+                  endTime=None):
+    startNs = None if startTime is None else int(startTime * 1000000000)
+    endNs = None if endTime is None else int(endTime * 1000000000)
+    start = end = pcapHeaderSize
+    count = 0
+    for (offset, recordEnd, timestamp) in scanRecords(data, recordHeader, tsScale):
+        if startNs is not None and timestamp < startNs:
+            continue
+        if endNs is not None and timestamp >= endNs:
+            break
+        if skip > 0:
+            skip -= 1
+            continue
+        if numPackets is not None and count >= numPackets:
+            break
+        if count == 0:
+            start = offset
+        if maxBytes is not None and pcapHeaderSize + recordEnd - start > maxBytes:
+            break
+        end = recordEnd
+        count += 1
+    if count == 0:
+        start = end
+    return start, end, count
+
+
+# Return the start and end offsets and the number of records of each of shards
+# shards of about the same size.  A capture with fewer records than shards has
+# fewer shards.
+def splitRecords(data, recordHeader, shards):
+    size = len(data)
+    ranges = []
+    start = end = pcapHeaderSize
+    count = 0
+    for (offset, recordEnd, timestamp) in scanRecords(data, recordHeader, 1):
+        limit = pcapHeaderSize + (size - pcapHeaderSize) * (len(ranges) + 1) // shards
+        if count and offset >= limit and len(ranges) < shards - 1:
+            ranges.append((start, end, count))
+            (start, count) = (offset, 0)
+        end = recordEnd
+        count += 1
+    if count:
+        ranges.append((start, end, count))
+    return ranges
+
+
+# Copy the bytes from start up to end of the file infp to the end of the file outfp
+def copyRange(infp, outfp, start, end):
+    outfp.flush()
+    try:
+        while start < end:
+            sent = os.sendfile(outfp.fileno(), infp.fileno(), start, end - start)
+            if sent == 0:
+                raise EOFError("Capture ended while it was being copied")
+            start += sent
+        return
+    except (AttributeError, OSError):
+        # No sendfile, or not between these files: copy in chunks from where it stopped
+        outfp.seek(0, os.SEEK_END)
+    infp.seek(start)
+    while start < end:
+        chunk = infp.read(min(copyChunkSize, end - start))
+        if not chunk:
+            raise EOFError("Capture ended while it was being copied")
+        outfp.write(chunk)
+        start += len(chunk)
+
+
+# Write the PCAP header rawHeader and the bytes of infp from start up to end to fname
+def writeCapture(fname, rawHeader, infp, start, end):
+    with open(fname, 'wb') as outfp:
+        outfp.write(rawHeader)
+        copyRange(infp, outfp, start, end)
+
+
+# Return the name of shard n: outfile with %d replaced by n, or with _n added before
+# its extension
+def shardName(outfile, n):
+    if '%d' in outfile:
+        return outfile % n
+    (base, extension) = os.path.splitext(outfile)
+    return '%s_%d%s' % (base, n, extension)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Trim a PCAP capture, or split it into shards, "
+                                                 "on record boundaries")
+    parser.add_argument("infile", help="capture to read")
+    parser.add_argument("outfile", help="capture to write; with --split, the name of the shards, with %%d "
+                                        "replaced by the shard number or _N added before the extension")
+    parser.add_argument("--skip", type=int, default=0, help="leave out this many packets first")
+    parser.add_argument("--packets", type=int, help="keep at most this many packets")
+    parser.add_argument("--bytes", type=int, help="keep as many packets as fit in a file of this many bytes")
+    parser.add_argument("--start-time", type=float,
+                        help="keep packets captured at or after this time, in seconds since the epoch")
+    parser.add_argument("--end-time", type=float,
+                        help="keep packets captured before this time, in seconds since the epoch")
+    parser.add_argument("--split", type=int, help="split the whole capture into this many shards")
+    args = parser.parse_args()
+    if args.split is not None:
+        if args.split < 1:
+            parser.error("--split must be at least 1")
+        if (args.skip or args.packets is not None or args.bytes is not None or
+                args.start_time is not None or args.end_time is not None):
+            parser.error("--split cannot be used with --skip, --packets, --bytes or a time range")
+    if args.bytes is not None and args.bytes < pcapHeaderSize:
+        parser.error("--bytes must leave room for the %d byte PCAP header" % pcapHeaderSize)
+    return args
+
+
+def main():
+    args = parseArgs()
+    print("infile = ", args.infile, " outfile = ", args.outfile)
+
+    with open(args.infile, 'rb') as infp:
+        data = mmap.mmap(infp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            rawHeader = data[:pcapHeaderSize]
+            (header, recordHeader) = parseHeader(rawHeader)
+            if args.split is not None:
+                ranges = splitRecords(data, recordHeader, args.split)
+                for (n, (start, end, count)) in enumerate(ranges):
+                    fname = shardName(args.outfile, n)
+                    writeCapture(fname, rawHeader, infp, start, end)
+                    print("Wrote ", count, " packets (", pcapHeaderSize + end - start, " bytes) to ", fname)
+            else:
+                tsScale = 1 if header.ns_resolution else 1000
+                (start, end, count) = selectRecords(data, recordHeader, tsScale, args.skip, args.packets,
+                                                    args.bytes, args.start_time, args.end_time)
+                writeCapture(args.outfile, rawHeader, infp, start, end)
+                print("Wrote ", count, " packets (", pcapHeaderSize + end - start, " bytes) to ", args.outfile)
+        finally:
+            data.close()
+
+
+if __name__ == '__main__':
+    main()